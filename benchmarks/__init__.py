@@ -0,0 +1,9 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the notifications service.
+
+Run the benchmarks from the top of the source tree as modules.
+
+  python -m benchmarks.jsonpath_bench
+"""
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compare the stored size and CPU time of the event log codecs."""
+from timeit import timeit
+from pacifica.notifications.orm import EventLog
+from .events import large_event, sample_event
+
+CODECS = ['json', 'zlib', 'lzma']
+
+
+def main(number=10):
+    """Print the stored size and encode and decode time of each codec."""
+    for label, event_obj in [('sample event', sample_event()), ('10000 file event', large_event(10000))]:
+        print('{}, {} runs, msec per call'.format(label, number))
+        print('{:8} {:>12} {:>8} {:>10} {:>10}'.format('codec', 'bytes', 'ratio', 'encode', 'decode'))
+        plain_size = None
+        for codec in CODECS:
+            fields = EventLog.encode(event_obj, codec)
+            size = len(fields['payload']) if fields['payload'] is not None else len(fields['jsondata'].encode('utf8'))
+            plain_size = plain_size or size
+            event_log = EventLog(**fields)
+            encode = timeit(lambda codec=codec: EventLog.encode(event_obj, codec), number=number) * 1000 / number
+            decode = timeit(event_log.event_obj, number=number) * 1000 / number
+            print('{:8} {:12d} {:8.2f} {:10.3f} {:10.3f}'.format(codec, size, plain_size / size, encode, decode))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Generate CloudEvents payloads for benchmarking."""
+from copy import deepcopy
+from json import loads
+from os.path import join, dirname
+
+EVENT_FILE = join(dirname(dirname(__file__)), 'tests', 'test_files', 'events.json')
+
+
+def sample_event():
+    """Return the sample ingest event used by the tests."""
+    with open(EVENT_FILE) as event_fd:
+        return loads(event_fd.read())
+
+
+def large_event(num_files=10000):
+    """Return the sample ingest event with num_files file entries."""
+    event_obj = sample_event()
+    file_objs = [obj for obj in event_obj['data'] if obj['destinationTable'] == 'Files']
+    others = [obj for obj in event_obj['data'] if obj['destinationTable'] != 'Files']
+    files = []
+    for index in range(num_files):
+        file_obj = deepcopy(file_objs[index % len(file_objs)])
+        file_obj['_id'] = index
+        file_obj['name'] = 'file-{:08d}.txt'.format(index)
+        file_obj['subdir'] = 'a/b/{}/'.format(index % 100)
+        files.append(file_obj)
+    event_obj['data'] = others + files
+    return event_obj
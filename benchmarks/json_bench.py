@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compare the JSON cost of each event stage with every installed backend."""
+from timeit import timeit
+from pacifica.notifications.jsoncodec import BACKENDS
+from .events import large_event, sample_event
+
+EVENTMATCH_FIELDS = ['{"subscription": "value"}', '{"type": "basic", "basic": {"username": "u", "password": "p"}}']
+
+
+def _stages(event_obj):
+    """Return the (stage, function of the backend) pairs for the event."""
+    body = BACKENDS['stdlib'][0](event_obj)
+    return [
+        ('receive loads', lambda dumps_bytes, loads: loads(body)),
+        ('eventlog dumps', lambda dumps_bytes, loads: dumps_bytes(event_obj).decode('utf8')),
+        ('dispatch loads', lambda dumps_bytes, loads: loads(body.decode('utf8'))),
+        ('policy dumps', lambda dumps_bytes, loads: dumps_bytes(event_obj)),
+        ('route dumps', lambda dumps_bytes, loads: dumps_bytes(dict(event_obj, extensions={'a': 1}))),
+        ('to_hash loads', lambda dumps_bytes, loads: [loads(field) for field in EVENTMATCH_FIELDS]),
+    ]
+
+
+def main(number=100):
+    """Print the usec per call of each stage and backend."""
+    names = sorted(BACKENDS)
+    for label, event_obj in [('sample event', sample_event()), ('10000 file event', large_event(10000))]:
+        print('{}, {} runs, usec per call'.format(label, number))
+        print('{:16}'.format('stage') + ''.join('{:>12}'.format(name) for name in names))
+        for stage, func in _stages(event_obj):
+            times = [
+                timeit(lambda name=name: func(*BACKENDS[name]), number=number) * 1e6 / number
+                for name in names
+            ]
+            print('{:16}'.format(stage) + ''.join('{:12.1f}'.format(value) for value in times))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compare first match and all match evaluation of jsonpath expressions."""
+from timeit import timeit
+from pacifica.notifications.jsonpath import parse, find, find_all
+from .events import large_event
+
+EXPRESSIONS = [
+    '$.data.*[?(@.destinationTable = "Files")]',
+    '$..name',
+    '$.data[*].size',
+]
+
+
+def _find_list(expr, data):
+    """The original list building find implementation."""
+    return bool(list(expr.match(data)))
+
+
+def main(num_files=10000, number=20):
+    """Print the time per call of each find implementation."""
+    event_obj = large_event(num_files)
+    print('{} file event, {} runs, msec per call'.format(num_files, number))
+    print('{:48} {:>10} {:>10} {:>10}'.format('expression', 'list', 'find', 'find_all'))
+    for expr_str in EXPRESSIONS:
+        expr = parse(expr_str)
+        times = [
+            timeit(lambda func=func: func(expr, event_obj), number=number) * 1000 / number
+            for func in (_find_list, find, find_all)
+        ]
+        print('{:48} {:10.3f} {:10.3f} {:10.3f}'.format(expr_str, *times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compare the cost per request of jsonschema.validate and the compiled validators."""
+from os.path import join
+from timeit import timeit
+import jsonschema
+from pacifica.notifications.rest import EventMatch, load_json_schema, validate
+from .events import EVENT_FILE, sample_event
+
+CLOUDEVENTS_SCHEMA = join(EVENT_FILE.rsplit('events.json', 1)[0], 'cloudevents-0.1.json')
+EVENTMATCH = {
+    'name': 'My Event Match',
+    'jsonpath': '$.data',
+    'target_url': 'http://www.example.com/receive',
+    'auth': {'type': 'basic', 'basic': {'username': 'user', 'password': 'pass'}},
+}
+
+
+def main(number=2000):
+    """Print the usec per validation of each payload."""
+    print('{} runs, usec per call'.format(number))
+    print('{:24} {:>12} {:>10}'.format('payload', 'validate', 'compiled'))
+    for label, obj, schema in [
+            ('cloudevent', sample_event(), load_json_schema(CLOUDEVENTS_SCHEMA)),
+            ('eventmatch', EVENTMATCH, EventMatch.json_schema)]:
+        before = timeit(lambda obj=obj, schema=schema: jsonschema.validate(obj, schema), number=number)
+        after = timeit(lambda obj=obj, schema=schema: validate(obj, schema), number=number)
+        print('{:24} {:12.1f} {:10.1f}'.format(label, before * 1e6 / number, after * 1e6 / number))
+
+
+if __name__ == '__main__':
+    main()
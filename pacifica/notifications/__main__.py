@@ -13,6 +13,7 @@ from .tasks import dispatch_orm_event
 from .orm import OrmSync, EventLog, NotificationSystem, eventget, eventpurge, SCHEMA_MAJOR, SCHEMA_MINOR
 from .rest import Root, error_page_default
 from .globals import CHERRYPY_CONFIG, CONFIG_FILE
+from .config import invalidate_config
 
 
 def stop_later(doit=False):
@@ -111,7 +112,7 @@ def _add_eventget_parser(subparsers):
     )
     dbchk_parser.add_argument(
         '--limit', default=10,
-        dest='limit', type=int, help='Number of events to get'
+        dest='limit', type=int, help='Number of events to get, 0 for all'
     )
     dbchk_parser.add_argument(
         '--date-format', default='%Y-%m-%d %H:%M:%S',
@@ -125,6 +126,14 @@ def _add_eventget_parser(subparsers):
         '--end-date', default=None,
         dest='end', type=str, help='End date and time'
     )
+    dbchk_parser.add_argument(
+        '--format', default='text', choices=['text', 'jsonl'],
+        dest='output_format', help='Output text or one JSON object per line'
+    )
+    dbchk_parser.add_argument(
+        '--chunk-size', default=1000,
+        dest='chunk_size', type=int, help='Number of events read per query'
+    )
     dbchk_parser.set_defaults(func=_eventget)
 
 
@@ -145,6 +154,18 @@ def _add_eventpurge_parser(subparsers):
         '--older-than-date', default=None,
         dest='older_than', type=str, help='Events older than given date'
     )
+    dbchk_parser.add_argument(
+        '--chunk-size', default=1000,
+        dest='chunk_size', type=int, help='Number of events deleted per transaction'
+    )
+    dbchk_parser.add_argument(
+        '--sleep', default=0.0,
+        dest='sleep', type=float, help='Seconds to sleep between chunks'
+    )
+    dbchk_parser.add_argument(
+        '--dry-run', default=False,
+        dest='dry_run', action='store_true', help='Count the events that would be purged'
+    )
     dbchk_parser.set_defaults(func=_eventpurge)
 
 
@@ -215,6 +236,8 @@ def main(*argv):
             '{}.{}'.format(SCHEMA_MAJOR, SCHEMA_MINOR)
         ))
     stop_later(args.stop_later)
+    # CherryPy handles SIGHUP itself, reload the configuration on graceful
+    cherrypy.engine.subscribe('graceful', invalidate_config)
     cherrypy.config.update({'error_page.default': error_page_default})
     cherrypy.config.update({
         'server.socket_host': args.address,
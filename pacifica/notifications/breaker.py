@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Retry schedule and circuit breakers for the target deliveries.
+
+A breaker opens for a host after consecutive failures, deliveries to
+the host are held until the reset timeout passes and one delivery is
+let through to probe it. The state is kept in a store so a redis store
+shares the breakers between processes.
+"""
+from random import uniform
+from time import time
+from urllib.parse import urlsplit
+from .config import get_config
+from .store import store_from_url
+
+
+def backoff_delay(attempt, base=10, maximum=3600):
+    """Return the seconds to wait before retry attempt using full jitter."""
+    return uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+def url_host(url):
+    """Return the scheme and host of url as a breaker key."""
+    parts = urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+class CircuitBreaker:
+    """Circuit breakers per host kept in a store."""
+
+    def __init__(self, store, failure_threshold=5, reset_timeout=60):
+        """Open after failure_threshold failures for reset_timeout seconds."""
+        self.store = store
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @staticmethod
+    def _key(host, part):
+        """Return the store key of the part of the host state."""
+        return 'breaker:{}:{}'.format(host, part)
+
+    def retry_after(self, host):
+        """
+        Return the seconds until a delivery to host is allowed, 0 if allowed now.
+
+        Once the reset timeout passed the breaker is half open, the
+        first caller gets 0 and the breaker is held open for another
+        reset timeout while that probe is in flight. The probe is
+        claimed with an atomic add so only one process sends it.
+        """
+        opened = self.store.get(self._key(host, 'opened'))
+        if opened is None:
+            return 0
+        now = time()
+        remaining = opened + self.reset_timeout - now
+        if remaining > 0:
+            return remaining
+        if self.store.add(self._key(host, 'probe'), now, self.reset_timeout):
+            return 0
+        probed = self.store.get(self._key(host, 'probe'))
+        # the claim of the probe may expire between the add and the get
+        return max(probed + self.reset_timeout - now, 0.1) if probed is not None else 0.1
+
+    def record_success(self, host):
+        """Close the breaker of host."""
+        for part in ['failures', 'opened', 'probe']:
+            self.store.delete(self._key(host, part))
+
+    def record_failure(self, host):
+        """Count a failure of host and open the breaker past the threshold."""
+        if self.store.incr(self._key(host, 'failures')) >= self.failure_threshold:
+            self.store.add(self._key(host, 'opened'), time())
+
+
+def breaker_from_config():
+    """Return the CircuitBreaker configured."""
+    config = get_config()
+    return CircuitBreaker(
+        store_from_url(config.get('notifications', 'breaker_url')),
+        config.getint('notifications', 'breaker_failure_threshold'),
+        config.getfloat('notifications', 'breaker_reset_timeout')
+    )
+
+
+BREAKER = breaker_from_config()
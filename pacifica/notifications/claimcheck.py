@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Claim check of the events passed between the tasks.
+
+With claim_check on the task messages carry the event log uuid as a
+ticket in place of the event and the subscription uuids in place of
+the subscriptions. Each worker process loads an event once from the
+event log into a small LRU cache and looks the subscriptions up in the
+active subscriptions snapshot. The cached events are shared, the tasks
+must not change them.
+"""
+from .config import get_config
+from .metrics import METRICS
+from .orm import EventLog
+from .store import MemoryStore
+from .subscriptions import ACTIVE_SUBSCRIPTIONS
+
+
+def claim_check_enabled():
+    """Return True if the task messages carry claim tickets."""
+    return get_config().getboolean('notifications', 'claim_check')
+
+
+def is_ticket(event_obj):
+    """Return True if event_obj is a claim ticket, events are JSON objects."""
+    return isinstance(event_obj, str)
+
+
+class EventCache:
+    """LRU cache of the events loaded from the event log."""
+
+    def __init__(self, maxsize=64):
+        """Create the cache holding at most maxsize events."""
+        self._events = MemoryStore(maxsize)
+
+    def load(self, event_log_uuid):
+        """Return the event of the event log, loading it if not cached."""
+        event_obj = self._events.get(event_log_uuid)
+        if event_obj is None:
+            EventLog.database_connect()
+            try:
+                with METRICS.timer('notifications_db_seconds', operation='eventlog_get'):
+                    event_obj = EventLog.get_by_id(event_log_uuid).event_obj()
+            finally:
+                EventLog.database_close()
+            self._events.set(event_log_uuid, event_obj)
+        return event_obj
+
+    def clear(self):
+        """Drop every cached event."""
+        self._events.clear()
+
+
+EVENT_CACHE = EventCache(get_config().getint('notifications', 'claim_check_cache_size'))
+
+
+def claim_event(event_obj):
+    """Return the event for the ticket or the event itself."""
+    if is_ticket(event_obj):
+        return EVENT_CACHE.load(event_obj)
+    return event_obj
+
+
+def claim_eventmatches(eventmatches, refresh=False):
+    """
+    Return the active eventmatch hashes for the uuids or the eventmatch hashes given.
+
+    With refresh the eventmatch hashes given are looked up again as
+    well, a retry isn't sent for a subscription deleted or disabled
+    since it was queued.
+    """
+    if refresh or any(isinstance(eventmatch, str) for eventmatch in eventmatches):
+        return ACTIVE_SUBSCRIPTIONS.lookup([
+            eventmatch if isinstance(eventmatch, str) else eventmatch['uuid'] for eventmatch in eventmatches
+        ])
+    return eventmatches
+
+
+def eventmatch_ticket(eventmatch, event_obj):
+    """Return the eventmatch to send along event_obj, its uuid with a ticket."""
+    return eventmatch['uuid'] if is_ticket(event_obj) else eventmatch
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Deduplication of received events.
+
+Each received event gets a dedup key from its CloudEvents id and
+source or from a hash of its canonical JSON. The key is claimed in a
+store for the dedup window so a duplicate arriving while the original
+is still queued is caught, and looked up in the indexed event log so a
+duplicate is caught after a restart or by another REST process.
+"""
+from datetime import datetime, timedelta
+from hashlib import sha256
+from json import dumps
+from .config import get_config
+from .orm import EventLog
+from .store import store_from_url
+
+DEDUP_MODES = ('id', 'hash')
+
+
+def dedup_key(event_obj, mode='id'):
+    """
+    Return the dedup key of the event.
+
+    With the id mode the key is the CloudEvents id and source, events
+    without both fall back to the hash of the canonical JSON.
+    """
+    if mode == 'id' and isinstance(event_obj, dict) and \
+            event_obj.get('id') is not None and event_obj.get('source') is not None:
+        text = 'id\n{}\n{}'.format(event_obj['source'], event_obj['id'])
+    else:
+        text = 'hash\n' + dumps(event_obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return sha256(text.encode('utf8')).hexdigest()
+
+
+class Deduplicator:
+    """Claim the dedup keys of received events for a window of seconds."""
+
+    def __init__(self, store, window=3600, mode='id'):
+        """Keep the claims in store for window seconds."""
+        if mode not in DEDUP_MODES:
+            raise ValueError('Unsupported dedup mode {}'.format(mode))
+        self.store = store
+        self.window = window
+        self.mode = mode
+
+    def key(self, event_obj):
+        """Return the dedup key of the event."""
+        return dedup_key(event_obj, self.mode)
+
+    @staticmethod
+    def _store_key(key):
+        """Return the store key for the dedup key."""
+        return 'dedup:{}'.format(key)
+
+    def logged(self, keys):
+        """
+        Return a hash of dedup key to the uuid of the first event log in the window.
+
+        The caller holds the database connection, in the REST service it
+        is the connection of the request.
+        """
+        since = datetime.now() - timedelta(seconds=self.window)
+        query = EventLog.select(EventLog.uuid, EventLog.dedup_key).where(
+            (EventLog.dedup_key << list(set(keys))) & (EventLog.created >= since)
+        ).order_by(EventLog.created.desc())
+        return {event_log.dedup_key: str(event_log.uuid) for event_log in query.iterator()}
+
+    def claim(self, event_log_uuids, keys):
+        """
+        Claim the keys for the event logs in one event log query.
+
+        Return a list with the uuid of the original event log for each
+        duplicate and None for each event to dispatch.
+        """
+        logged = self.logged(keys) if keys else {}
+        originals = []
+        for event_log_uuid, key in zip(event_log_uuids, keys):
+            original = logged.get(key)
+            if original is None and not self.store.add(self._store_key(key), event_log_uuid, self.window):
+                original = self.store.get(self._store_key(key))
+            originals.append(original)
+        return originals
+
+    def release(self, keys):
+        """Release the claims on keys of events that were not dispatched."""
+        for key in keys:
+            self.store.delete(self._store_key(key))
+
+
+def dedup_from_config():
+    """Return the Deduplicator configured or None if dedup is off."""
+    config = get_config()
+    mode = config.get('notifications', 'dedup')
+    if not mode:
+        return None
+    return Deduplicator(
+        store_from_url(config.get('notifications', 'dedup_url')),
+        config.getfloat('notifications', 'dedup_window'),
+        mode
+    )
+
+
+DEDUP = dedup_from_config()
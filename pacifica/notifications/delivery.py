@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Concurrent delivery of events to subscriber targets.
+
+The asyncio engine runs the target posts on one event loop per worker
+process so a slow target doesn't hold a Celery worker slot. The posts
+are capped in total and per host. aiohttp is used when installed,
+otherwise the posts run on the keep-alive sessions in a thread pool
+driven by the same loop.
+"""
+import asyncio
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+from requests.exceptions import RequestException
+from .config import get_config
+from .sessions import SESSIONS
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover aiohttp is optional
+    aiohttp = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TargetResponse(namedtuple('TargetResponse', ['status_code', 'text'])):
+    """The parts of a target response the tasks use."""
+
+    __slots__ = ()
+
+
+class TargetRequest(namedtuple('TargetRequest', ['url', 'data', 'headers', 'auth'])):
+    """A post of data to a target url with the basic auth tuple or None."""
+
+    __slots__ = ()
+
+    def __new__(cls, url, data, headers, auth=None):
+        """Create the request, auth is optional."""
+        return super().__new__(cls, url, data, headers, auth)
+
+
+class DeliveryLimits(namedtuple('DeliveryLimits', ['max_in_flight', 'max_per_host', 'timeout'])):
+    """The concurrency caps and the post timeout of a DeliveryEngine."""
+
+    __slots__ = ()
+
+
+class DeliveryEngine:
+    """Deliver posts concurrently on an event loop in a background thread."""
+
+    def __init__(self, max_in_flight=100, max_per_host=10, timeout=60):
+        """Create the engine, the loop starts on the first submit."""
+        self.limits = DeliveryLimits(max_in_flight, max_per_host, timeout)
+        self._lock = Lock()
+        # the (loop, thread, executor) running the deliveries
+        self._runner = None
+        self._session = None
+        self._global_limit = None
+        self._host_limits = {}
+        self._pending = set()
+
+    def _start(self):
+        """Start the event loop thread if it isn't running."""
+        with self._lock:
+            if self._runner is not None:
+                return self._runner[0]
+            loop = asyncio.new_event_loop()
+            executor = ThreadPoolExecutor(max_workers=self.limits.max_in_flight)
+            loop.set_default_executor(executor)
+            thread = Thread(target=loop.run_forever, name='delivery-engine', daemon=True)
+            thread.start()
+            self._runner = (loop, thread, executor)
+            return loop
+
+    def _host_limit(self, url):
+        """Return the semaphore for the host of url, only called on the loop."""
+        parts = urlsplit(url)
+        key = '{}://{}'.format(parts.scheme, parts.netloc)
+        if key not in self._host_limits:
+            self._host_limits[key] = asyncio.Semaphore(self.limits.max_per_host)
+        return self._host_limits[key]
+
+    async def _aiohttp_post(self, request):
+        """Post with aiohttp and return a TargetResponse."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limits.max_in_flight, limit_per_host=self.limits.max_per_host
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.limits.timeout),
+                # the session is shared by every subscription so it keeps no cookies
+                cookie_jar=aiohttp.DummyCookieJar()
+            )
+        auth = aiohttp.BasicAuth(*request.auth) if request.auth is not None else None
+        async with self._session.post(request.url, data=request.data, headers=request.headers, auth=auth) as resp:
+            return TargetResponse(resp.status, await resp.text())
+
+    async def _requests_post(self, request):
+        """Post with the keep-alive sessions in the thread pool."""
+        kwargs = {'data': request.data, 'headers': request.headers, 'timeout': self.limits.timeout}
+        if request.auth is not None:
+            kwargs['auth'] = request.auth
+        resp = await asyncio.get_event_loop().run_in_executor(None, lambda: SESSIONS.post(request.url, **kwargs))
+        return TargetResponse(resp.status_code, resp.text)
+
+    async def _post(self, request):
+        """Post the request within the limits and return the TargetResponse or None and the error or None."""
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self.limits.max_in_flight)
+        async with self._global_limit, self._host_limit(request.url):
+            try:
+                if aiohttp is not None:
+                    return await self._aiohttp_post(request), None
+                return await self._requests_post(request), None
+            except asyncio.TimeoutError:
+                return None, 'Timeout posting to {}'.format(request.url)
+            except RequestException as ex:
+                return None, str(ex)
+            except Exception as ex:  # pylint: disable=broad-except
+                if aiohttp is None or not isinstance(ex, aiohttp.ClientError):
+                    raise
+                return None, str(ex)
+
+    async def _deliver(self, request, callback):
+        """
+        Post the request then run callback(resp, error) in the thread pool.
+
+        The callback runs even if the post failed unexpectedly, with the
+        error, so the caller always gets to release its resources.
+        """
+        resp, error = None, 'Delivery to {} failed'.format(request.url)
+        try:
+            resp, error = await self._post(request)
+        except Exception as ex:
+            error = 'Delivery to {} failed: {}'.format(request.url, ex)
+            raise
+        finally:
+            if callback is not None:
+                await asyncio.get_event_loop().run_in_executor(None, callback, resp, error)
+        return resp, error
+
+    def submit(self, request, callback=None):
+        """
+        Post the TargetRequest and return a concurrent.futures.Future.
+
+        The callback is called with the TargetResponse or None and the
+        error message or None once the post is done.
+        """
+        loop = self._start()
+        future = asyncio.run_coroutine_threadsafe(self._deliver(request, callback), loop)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        """Forget a finished delivery and log its exception if it raised one."""
+        with self._lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.error('Delivery failed', exc_info=future.exception())
+
+    def in_flight(self):
+        """Return the number of deliveries not finished yet."""
+        with self._lock:
+            return len(self._pending)
+
+    def close(self, timeout=None):
+        """Wait for the deliveries in flight up to timeout seconds then stop the loop."""
+        with self._lock:
+            runner, self._runner = self._runner, None
+        if runner is None:
+            return
+        loop, thread, executor = runner
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+        async def _close_session():
+            """Close the aiohttp session."""
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+        asyncio.run_coroutine_threadsafe(_close_session(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        executor.shutdown(wait=True)
+        self._global_limit = None
+        self._host_limits = {}
+
+
+def delivery_engine_from_config():
+    """Return the DeliveryEngine configured or None for the requests engine."""
+    config = get_config()
+    engine = config.get('notifications', 'delivery_engine')
+    if engine == 'requests':
+        return None
+    if engine != 'asyncio':
+        raise ValueError('Unsupported delivery engine {}'.format(engine))
+    return DeliveryEngine(
+        config.getint('notifications', 'delivery_max_in_flight'),
+        config.getint('notifications', 'delivery_max_per_host'),
+        config.getfloat('notifications', 'delivery_timeout')
+    )
+
+
+DELIVERY_ENGINE = delivery_engine_from_config()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and decoding used across ingest, storage and delivery.
+
+The stdlib json module is the default backend, orjson is used when it
+is installed and json_backend is auto. Both backends write compact
+UTF-8 JSON and give the same bytes, except for floats written with an
+exponent (below 1e-4 or from 1e16). Objects orjson can't encode, like
+integers past 64 bits or NaN and infinite floats orjson would write as
+null, and text it can't decode, like NaN, fall back to the stdlib.
+"""
+import json
+from math import isfinite
+from .config import get_config
+try:
+    import orjson
+except ImportError:  # pragma: no cover orjson is optional
+    orjson = None
+
+
+def _stdlib_dumps_bytes(obj):
+    """Encode obj as compact UTF-8 JSON with the stdlib."""
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+
+
+def _has_non_finite(obj):
+    """Return True if obj holds a NaN or infinite float."""
+    if isinstance(obj, float):
+        return not isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _orjson_dumps_bytes(obj):
+    """Encode obj as compact UTF-8 JSON with orjson, the stdlib keeps NaN and infinite floats."""
+    try:
+        data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return _stdlib_dumps_bytes(obj)
+    # orjson writes non finite floats as null, only look for them if there is a null
+    if b'null' in data and _has_non_finite(obj):
+        return _stdlib_dumps_bytes(obj)
+    return data
+
+
+def _orjson_loads(text):
+    """Decode the JSON str or bytes with orjson."""
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        return json.loads(text)
+
+
+BACKENDS = {'stdlib': (_stdlib_dumps_bytes, json.loads)}
+if orjson is not None:  # pragma: no branch
+    BACKENDS['orjson'] = (_orjson_dumps_bytes, _orjson_loads)
+
+
+def select_backend(name='auto'):
+    """Return the backend for name, auto is orjson when installed."""
+    if name == 'auto':
+        return 'orjson' if 'orjson' in BACKENDS else 'stdlib'
+    if name not in BACKENDS:
+        raise ValueError('Unsupported or not installed json backend {}'.format(name))
+    return name
+
+
+JSON_BACKEND = select_backend(get_config().get('notifications', 'json_backend'))
+_DUMPS_BYTES, _LOADS = BACKENDS[JSON_BACKEND]
+
+
+def dumps_bytes(obj):
+    """Encode obj as JSON bytes."""
+    return _DUMPS_BYTES(obj)
+
+
+def dumps(obj):
+    """Encode obj as JSON text."""
+    return _DUMPS_BYTES(obj).decode('utf8')
+
+
+def loads(text):
+    """Decode the JSON str or bytes."""
+    return _LOADS(text)
@@ -1,14 +1,142 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """The jsonpath interface module."""
+from collections import OrderedDict
+from threading import Lock
 from jsonpath2.path import Path
+from jsonpath2.nodes.current import CurrentNode
+from jsonpath2.nodes.root import RootNode
+from jsonpath2.nodes.subscript import SubscriptNode
+from jsonpath2.nodes.terminal import TerminalNode
+from jsonpath2.subscripts.filter import FilterSubscript
+from jsonpath2.subscripts.objectindex import ObjectIndexSubscript
+from jsonpath2.expressions.operator import AndVariadicOperatorExpression, EqualBinaryOperatorExpression
+from .config import get_config
+
+
+class PathCache:
+    """
+    Bounded least recently used cache of compiled jsonpath expressions.
+
+    Parsing a jsonpath runs the full jsonpath2 grammar so compiled
+    ``Path`` objects are kept keyed by the expression string. The
+    cache is safe to share between threads and keeps hit and miss
+    counters for monitoring.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Create the cache holding at most maxsize expressions."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._paths = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, jsonpath_str):
+        """Return the compiled path for jsonpath_str parsing if needed."""
+        with self._lock:
+            path = self._paths.get(jsonpath_str)
+            if path is not None:
+                self._paths.move_to_end(jsonpath_str)
+                self.hits += 1
+                return path
+            self.misses += 1
+        # parse outside the lock so a slow parse doesn't block readers
+        path = Path.parse_str(jsonpath_str)
+        if self.maxsize > 0:
+            with self._lock:
+                self._paths[jsonpath_str] = path
+                self._paths.move_to_end(jsonpath_str)
+                while len(self._paths) > self.maxsize:
+                    self._paths.popitem(last=False)
+        return path
+
+    def clear(self):
+        """Remove all the compiled paths and reset the counters."""
+        with self._lock:
+            self._paths.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a hash of the cache size and counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._paths),
+                'maxsize': self.maxsize
+            }
+
+
+PATH_CACHE = PathCache(get_config().getint('notifications', 'jsonpath_cache_size'))
 
 
 def parse(jsonpath_str):
-    """Parse the json path."""
-    return Path.parse_str(jsonpath_str)
+    """Parse the json path using the compiled path cache."""
+    return PATH_CACHE.get(jsonpath_str)
 
 
 def find(expr, data):
-    """Match the expression in the data and return truthy value."""
-    return bool(list(expr.match(data)))
+    """
+    Match the expression in the data and return truthy value.
+
+    Only the first match is evaluated, use find_all() to get every
+    matched value.
+    """
+    for _match_data in expr.match(data):
+        return True
+    return False
+
+
+def find_all(expr, data):
+    """Match the expression in the data and return all matched values."""
+    return [match_data.current_value for match_data in expr.match(data)]
+
+
+def _literal_keys(node):
+    """Return the leading literal object keys of the node chain and the remaining node."""
+    keys = []
+    while isinstance(node, SubscriptNode) and len(node.subscripts) == 1 and \
+            isinstance(node.subscripts[0], ObjectIndexSubscript):
+        keys.append(node.subscripts[0].index)
+        node = node.next_node
+    return tuple(keys), node
+
+
+def _equal_constraints(expression, key_path):
+    """Yield the (path, value) literal equality constraints of a filter expression."""
+    if isinstance(expression, AndVariadicOperatorExpression):
+        for sub_expression in expression.expressions:
+            for constraint in _equal_constraints(sub_expression, key_path):
+                yield constraint
+        return
+    if not isinstance(expression, EqualBinaryOperatorExpression):
+        return
+    sides = (expression.left_node_or_value, expression.right_node_or_value)
+    for node, value in (sides, reversed(sides)):
+        if not isinstance(node, (CurrentNode, RootNode)):
+            continue
+        if not (value is None or isinstance(value, (str, int, float, bool))):
+            continue
+        keys, rest = _literal_keys(node.next_node)
+        if isinstance(rest, TerminalNode):
+            yield (key_path + keys if isinstance(node, CurrentNode) else keys), value
+
+
+def required_constraints(expr):
+    """
+    Return the constraints an event must satisfy to match the expression.
+
+    The return value is a tuple of the literal key path the expression
+    starts with and a list of (path, value) equality constraints from
+    a filter directly following that key path. Both are necessary but
+    not sufficient conditions for a match, an expression that can't be
+    analyzed returns an empty key path and no equality constraints.
+    """
+    key_path, node = _literal_keys(expr.root_node.next_node)
+    equals = []
+    if isinstance(node, SubscriptNode) and len(node.subscripts) == 1 and \
+            isinstance(node.subscripts[0], FilterSubscript):
+        equals = list(_equal_constraints(node.subscripts[0].expression, key_path))
+    return key_path, equals
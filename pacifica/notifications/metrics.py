@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms in the Prometheus text format.
+
+Each process records into its own registry. With metrics_dir set the
+registry is written to a file per process every metrics_flush_interval
+seconds and the /metrics endpoints sum the files of every process, so
+the REST service and the Celery exporter both report the whole host.
+"""
+import atexit
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import monotonic
+from .config import get_config
+from .jsoncodec import dumps, loads
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@lru_cache(maxsize=4096)
+def _label_key(items):
+    """Return the sorted label items rendered as the series key."""
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in items
+    )
+
+
+def series_key(**labels):
+    """Return the labels rendered and sorted as the series key."""
+    return _label_key(tuple(sorted(labels.items())))
+
+
+class Metrics:
+    """Thread safe registry of counters and histograms of one process."""
+
+    def __init__(self, directory='', flush_interval=5, buckets=DEFAULT_BUCKETS):
+        """Create an empty registry written to directory every flush_interval seconds."""
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        # the counter and histogram series by metric name and the collectors
+        self._values = {'counters': {}, 'histograms': {}, 'collectors': []}
+        self._flushed = monotonic()
+
+    def register(self, collector):
+        """Add collector, a callable returning (name, value, series key) counters read on every snapshot."""
+        with self._lock:
+            self._values['collectors'].append(collector)
+
+    def inc(self, name, value=1, **labels):
+        """Add value to the counter name with the labels."""
+        key = series_key(**labels)
+        with self._lock:
+            series = self._values['counters'].setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        self._maybe_flush()
+
+    def inc_all(self, increments):
+        """Add each (name, value, series key) of increments to its counter at once."""
+        with self._lock:
+            for name, value, key in increments:
+                series = self._values['counters'].setdefault(name, {})
+                series[key] = series.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        """Record seconds in the histogram name with the labels."""
+        key = series_key(**labels)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._values['histograms'].setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the seconds the block takes in the histogram name."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def snapshot(self):
+        """Return a JSON serializable copy of the registry with the counters of the collectors."""
+        with self._lock:
+            snapshot = {
+                'buckets': list(self.buckets),
+                'counters': {name: dict(series) for name, series in self._values['counters'].items()},
+                'histograms': {
+                    name: {key: list(histogram) for key, histogram in series.items()}
+                    for name, series in self._values['histograms'].items()
+                },
+            }
+            collectors = list(self._values['collectors'])
+        for collector in collectors:
+            for name, value, key in collector():
+                series = snapshot['counters'].setdefault(name, {})
+                series[key] = series.get(key, 0) + value
+        return snapshot
+
+    def reset(self):
+        """Drop every recorded value, a forked process starts empty and keeps the collectors."""
+        with self._lock:
+            self._values = {'counters': {}, 'histograms': {}, 'collectors': self._values['collectors']}
+            self._flushed = monotonic()
+
+    def _path(self):
+        """Return the snapshot file of this process."""
+        return os.path.join(self.directory, '{}.json'.format(os.getpid()))
+
+    def flush(self):
+        """Write the snapshot of this process to the directory, skipped if a flush is running."""
+        if not self.directory or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._flushed = monotonic()
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path()
+            with open(path + '.tmp', 'w') as snapshot_fd:
+                snapshot_fd.write(dumps(self.snapshot()))
+            os.replace(path + '.tmp', path)
+        finally:
+            self._flush_lock.release()
+
+    def _maybe_flush(self):
+        """Flush once the flush interval passed, recording never fails on a flush error."""
+        if self.directory and monotonic() - self._flushed >= self.flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        """Return this registry summed with the snapshots of the other processes."""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            snapshots.extend(read_snapshots(self.directory, exclude=self._path()))
+        return merge_snapshots(snapshots, self.buckets)
+
+
+def read_snapshots(directory, exclude=None):
+    """Return the snapshots written in directory, skipping the exclude path."""
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if not file_name.endswith('.json') or path == exclude:
+            continue
+        try:
+            with open(path) as snapshot_fd:
+                snapshots.append(loads(snapshot_fd.read()))
+        except (OSError, ValueError):
+            # the file was removed or replaced while reading
+            continue
+    return snapshots
+
+
+def merge_snapshots(snapshots, buckets=DEFAULT_BUCKETS):
+    """Return the sum of the snapshots, histograms with other buckets are left out."""
+    merged = {'buckets': list(buckets), 'counters': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        for name, series in snapshot['counters'].items():
+            merged_series = merged['counters'].setdefault(name, {})
+            for key, value in series.items():
+                merged_series[key] = merged_series.get(key, 0) + value
+        if snapshot['buckets'] != merged['buckets']:
+            continue
+        for name, series in snapshot['histograms'].items():
+            merged_series = merged['histograms'].setdefault(name, {})
+            for key, histogram in series.items():
+                merged_histogram = merged_series.setdefault(key, [0] * len(histogram))
+                for index, value in enumerate(histogram):
+                    merged_histogram[index] += value
+    return merged
+
+
+def _series(name, key, extra=''):
+    """Return the series name with the labels key and the extra label."""
+    labels = ','.join(label for label in [key, extra] if label)
+    return '{}{{{}}}'.format(name, labels) if labels else name
+
+
+def render(snapshot):
+    """Return the snapshot in the Prometheus text exposition format."""
+    lines = []
+    for name, series in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE {} counter'.format(name))
+        for key, value in sorted(series.items()):
+            lines.append('{} {}'.format(_series(name, key), repr(float(value))))
+    bounds = ['{}'.format(bound) for bound in snapshot['buckets']] + ['+Inf']
+    for name, series in sorted(snapshot['histograms'].items()):
+        lines.append('# TYPE {} histogram'.format(name))
+        for key, histogram in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, histogram[:-2] + [0]):
+                cumulative += count
+                lines.append('{} {}'.format(
+                    _series(name + '_bucket', key, 'le="{}"'.format(bound)),
+                    histogram[-1] if bound == '+Inf' else cumulative
+                ))
+            lines.append('{} {}'.format(_series(name + '_sum', key), repr(float(histogram[-2]))))
+            lines.append('{} {}'.format(_series(name + '_count', key), histogram[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serve each scrape in a thread."""
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the collected metrics on /metrics."""
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Respond with the metrics of every process."""
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(METRICS.collect()).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    # pylint: enable=invalid-name
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        """Don't log the scrapes."""
+
+
+def start_exporter(port, host='0.0.0.0'):
+    """Serve /metrics on host and port in a background thread and return the server."""
+    server = _ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    return server
+
+
+def metrics_from_config():
+    """Return the Metrics registry configured."""
+    config = get_config()
+    return Metrics(
+        config.get('notifications', 'metrics_dir'),
+        config.getfloat('notifications', 'metrics_flush_interval')
+    )
+
+
+METRICS = metrics_from_config()
+atexit.register(METRICS.flush)
@@ -1,20 +1,47 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """The ORM module defining the SQL model for notifications."""
+import lzma
 import uuid
+import zlib
 from time import sleep
 from datetime import datetime
-from json import loads
 from peewee import Model, CharField, TextField, DateTimeField, UUIDField
-from peewee import OperationalError, IntegerField, ForeignKeyField
+from peewee import OperationalError, IntegerField, ForeignKeyField, FloatField, BlobField
 from playhouse.migrate import SchemaMigrator, migrate
 from playhouse.db_url import connect
+from playhouse.pool import PooledDatabase
 from .config import get_config
+from .jsoncodec import dumps, dumps_bytes, loads
 from .jsonpath import parse
 
 SCHEMA_MAJOR = 3
-SCHEMA_MINOR = 0
-DB = connect(get_config().get('database', 'peewee_url'))
+SCHEMA_MINOR = 3
+
+
+def database_from_config():
+    """
+    Create the database object from the configuration.
+
+    When pooled is enabled the url scheme is switched to the peewee
+    pooled database class for the same backend.
+    """
+    config = get_config()
+    peewee_url = config.get('database', 'peewee_url')
+    if config.getboolean('database', 'pooled'):
+        scheme, rest = peewee_url.split('://', 1)
+        if not scheme.endswith('+pool'):
+            peewee_url = '{}+pool://{}'.format(scheme, rest)
+    if peewee_url.split('://', 1)[0].endswith('+pool'):
+        return connect(
+            peewee_url,
+            max_connections=config.getint('database', 'max_connections'),
+            stale_timeout=config.getint('database', 'stale_timeout')
+        )
+    return connect(peewee_url)
+
+
+DB = database_from_config()
 
 
 class OrmSync:
@@ -52,7 +79,10 @@ class OrmSync:
         (0, 0),
         (1, 0),
         (2, 0),
-        (3, 0)
+        (3, 0),
+        (3, 1),
+        (3, 2),
+        (3, 3)
     ]
 
     @staticmethod
@@ -97,6 +127,31 @@ class OrmSync:
             if not orm_obj.table_exists():
                 orm_obj.create_table()
 
+    @classmethod
+    def update_3_0_to_3_1(cls):
+        """Update by adding the target rate limit columns."""
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(
+            migrator.add_column('eventmatch', 'rate_limit', FloatField(null=True)),
+            migrator.add_column('eventmatch', 'rate_burst', IntegerField(null=True)),
+            migrator.add_column('eventmatch', 'max_in_flight', IntegerField(null=True))
+        )
+
+    @classmethod
+    def update_3_1_to_3_2(cls):
+        """Update by adding the event log codec and payload columns."""
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(
+            migrator.add_column('eventlog', 'codec', CharField(default='json')),
+            migrator.add_column('eventlog', 'payload', BlobField(null=True))
+        )
+
+    @classmethod
+    def update_3_2_to_3_3(cls):
+        """Update by adding the indexed event log dedup key column."""
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(migrator.add_column('eventlog', 'dedup_key', CharField(null=True, index=True)))
+
     @classmethod
     def update_tables(cls):
         """Update the database to the current version."""
@@ -135,8 +190,14 @@ class BaseModel(Model):
 
         Trying to connect a second
         time *does* cause problems.
+
+        A pooled database checks out a connection from the pool
+        and reuses the connection already checked out.
         """
         # pylint: disable=no-member
+        if isinstance(cls._meta.database, PooledDatabase):
+            cls._meta.database.connect(reuse_if_open=True)
+            return
         if not cls._meta.database.is_closed():
             cls._meta.database.close()
         cls._meta.database.connect()
@@ -149,6 +210,8 @@ class BaseModel(Model):
 
         Closing already closed database
         is not a problem, so continue on.
+
+        A pooled database returns the connection to the pool.
         """
         # pylint: disable=no-member
         if not cls._meta.database.is_closed():
@@ -176,8 +239,29 @@ class NotificationSystem(BaseModel):
             return (0, 0)
         major = cls.get_or_create(part='major', value=SCHEMA_MAJOR)
         minor = cls.get_or_create(part='minor', value=SCHEMA_MINOR)
+        cls.get_or_create(part='generation', defaults={'value': 0})
         return (major, minor)
 
+    @classmethod
+    def get_generation(cls):
+        """Get the current generation of the subscription set."""
+        gen_obj = cls.get_or_none(cls.part == 'generation')
+        if gen_obj is None:
+            return 0
+        return gen_obj.value
+
+    @classmethod
+    def bump_generation(cls):
+        """
+        Increment the generation of the subscription set.
+
+        This should be called in the same transaction as any change
+        to the enabled or deleted state of an EventMatch object.
+        """
+        updated = cls.update(value=cls.value + 1).where(cls.part == 'generation').execute()
+        if not updated:
+            cls.get_or_create(part='generation', defaults={'value': 1})
+
     @classmethod
     def get_version(cls):
         """Get the current version as a tuple."""
@@ -198,11 +282,27 @@ class NotificationSystem(BaseModel):
         return major == SCHEMA_MAJOR
 
 
+# codec name to (compress, decompress) of the JSON text encoded as utf8
+EVENT_CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
 class EventLog(BaseModel):
-    """Events matching via jsonpath per user."""
+    """
+    Events matching via jsonpath per user.
+
+    The event is JSON text in jsondata with the json codec, with the
+    other codecs jsondata is empty and payload holds the compressed
+    JSON text.
+    """
 
     uuid = UUIDField(primary_key=True, default=uuid.uuid4, index=True)
     jsondata = TextField()
+    codec = CharField(default='json')
+    payload = BlobField(null=True)
+    dedup_key = CharField(null=True, index=True)
     created = DateTimeField(default=datetime.now, index=True)
 
     # pylint: disable=too-few-public-methods
@@ -212,6 +312,29 @@ class EventLog(BaseModel):
         database = DB
     # pylint: enable=too-few-public-methods
 
+    @staticmethod
+    def encode(event_obj, codec=None):
+        """Return the jsondata, codec and payload fields for the event."""
+        if codec is None:
+            codec = get_config().get('database', 'event_codec')
+        if codec == 'json':
+            return {'jsondata': dumps(event_obj), 'codec': codec, 'payload': None}
+        if codec not in EVENT_CODECS:
+            raise ValueError('Unsupported event codec {}'.format(codec))
+        return {'jsondata': '', 'codec': codec, 'payload': EVENT_CODECS[codec][0](dumps_bytes(event_obj))}
+
+    def json_text(self):
+        """Return the event as JSON text."""
+        if self.codec in (None, 'json'):
+            return self.jsondata
+        return EVENT_CODECS[self.codec][1](bytes(self.payload)).decode('utf8')
+
+    def event_obj(self):
+        """Return the event object."""
+        if self.codec in (None, 'json'):
+            return loads(self.jsondata)
+        return loads(EVENT_CODECS[self.codec][1](bytes(self.payload)))
+
 
 class EventMatch(BaseModel):
     """Events matching via jsonpath per user."""
@@ -228,6 +351,11 @@ class EventMatch(BaseModel):
     # to a database backend
     extensions = TextField(default='{}')
     auth = TextField(default='{}', null=True)
+    # per subscription overrides of the target limits, null uses the
+    # configured defaults
+    rate_limit = FloatField(null=True)
+    rate_burst = IntegerField(null=True)
+    max_in_flight = IntegerField(null=True)
     created = DateTimeField(default=datetime.now, index=True)
     updated = DateTimeField(default=datetime.now, index=True)
     deleted = DateTimeField(null=True, index=True)
@@ -282,39 +410,151 @@ class EventLogMatch(BaseModel):
     # pylint: enable=too-few-public-methods
 
 
+def _event_log_chunks(query, chunk_size, limit=0):
+    """
+    Yield lists of EventLog objects from query in (created, uuid) order.
+
+    Each chunk is a keyset query starting after the last row of the
+    previous chunk so no rows are held between chunks. A limit of 0
+    yields every row.
+    """
+    last = None
+    remaining = limit
+    while not limit or remaining > 0:
+        chunk_query = query
+        if last is not None:
+            chunk_query = chunk_query.where(
+                (EventLog.created > last.created) |
+                ((EventLog.created == last.created) & (EventLog.uuid > last.uuid))
+            )
+        size = min(chunk_size, remaining) if limit else chunk_size
+        rows = list(chunk_query.order_by(EventLog.created, EventLog.uuid).limit(size).iterator())
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last = rows[-1]
+        remaining -= len(rows)
+
+
+def _event_log_matches(event_logs):
+    """Return a hash of EventLog uuid to its EventLogMatch objects in one query."""
+    query = EventLogMatch.select(
+        EventLogMatch.uuid, EventLogMatch.event_log, EventLogMatch.event_match,
+        EventLogMatch.created, EventLogMatch.policy_status_code, EventLogMatch.target_status_code
+    ).where(
+        EventLogMatch.event_log << [event_obj.uuid for event_obj in event_logs]
+    ).order_by(EventLogMatch.created)
+    matches = {}
+    for elm_obj in query.iterator():
+        # pylint: disable=no-member
+        matches.setdefault(elm_obj.event_log_id, []).append(elm_obj)
+        # pylint: enable=no-member
+    return matches
+
+
+def _print_event_text(event_obj, elm_objs):
+    """Print the event and its matches as text."""
+    print('Event - {}\n{}'.format(event_obj.uuid, event_obj.json_text()))
+    for elm_obj in elm_objs:
+        print('    ELM {} ({}) policy {} target {}'.format(
+            elm_obj.event_match_id,
+            elm_obj.created.isoformat(),
+            elm_obj.policy_status_code,
+            elm_obj.target_status_code
+        ))
+
+
+def _print_event_jsonl(event_obj, elm_objs):
+    """Print the event and its matches as one line of JSON."""
+    print(dumps({
+        'uuid': str(event_obj.uuid),
+        'created': event_obj.created.isoformat(),
+        'event': event_obj.event_obj(),
+        'matches': [
+            {
+                'uuid': str(elm_obj.uuid),
+                'event_match': str(elm_obj.event_match_id),
+                'created': elm_obj.created.isoformat(),
+                'policy_status_code': elm_obj.policy_status_code,
+                'target_status_code': elm_obj.target_status_code
+            }
+            for elm_obj in elm_objs
+        ]
+    }))
+
+
 def eventget(args):
-    """Get events based on command line argument in args."""
+    """
+    Get events based on command line argument in args.
+
+    The events are read in chunks of args.chunk_size and the matches
+    of each chunk in one query, so memory use stays flat. The output
+    is text or one JSON object per line with args.output_format jsonl.
+    """
     query = EventLog.select()
+    limit = 0
     if args.events:
         query = query.where(EventLog.uuid << args.events)
     else:
         query = query.where(
             (EventLog.created < args.end) &
             (EventLog.created > args.start)
-        ).limit(args.limit)
-    for event_obj in query:
-        print('Event - {}\n{}'.format(event_obj.uuid, event_obj.jsondata))
-        for elm_obj in event_obj.event_matches:
-            print('    ELM {} ({}) policy {} target {}'.format(
-                elm_obj.event_match.uuid,
-                elm_obj.created.isoformat(),
-                elm_obj.policy_status_code,
-                elm_obj.target_status_code
-            ))
+        )
+        limit = args.limit
+    print_event = _print_event_jsonl if args.output_format == 'jsonl' else _print_event_text
+    for event_logs in _event_log_chunks(query, args.chunk_size, limit):
+        matches = _event_log_matches(event_logs)
+        for event_obj in event_logs:
+            # pylint: disable=no-member
+            print_event(event_obj, matches.get(event_obj.uuid, []))
+            # pylint: enable=no-member
     return True
 
 
+def purge_count(where):
+    """Return the (events, matches) counts the EventLog where clause would purge."""
+    return (
+        EventLog.select().where(where).count(),
+        EventLogMatch.select().join(EventLog).where(where).count()
+    )
+
+
+def purge_events(where, chunk_size=1000, sleep_time=0, progress=None):
+    """
+    Delete the EventLog objects of the where clause and their matches.
+
+    The deletes run in chunks of chunk_size events, matches first, each
+    chunk in its own transaction with sleep_time seconds in between.
+    progress is called with the running (events, matches) totals after
+    each chunk. Return the totals.
+    """
+    events = matches = 0
+    while True:
+        with EventLog.atomic():
+            uuids = [row[0] for row in EventLog.select(EventLog.uuid).where(where).limit(chunk_size).tuples()]
+            if uuids:
+                matches += EventLogMatch.delete().where(EventLogMatch.event_log << uuids).execute()
+                events += EventLog.delete().where(EventLog.uuid << uuids).execute()
+        if uuids and progress is not None:
+            progress(events, matches)
+        if len(uuids) < chunk_size:
+            return events, matches
+        sleep(sleep_time)
+
+
 def eventpurge(args):
     """Purge events based on command line argument in args."""
-    query = EventLog.select()
     if args.events:
-        query = query.where(EventLog.uuid << args.events)
+        where = EventLog.uuid << args.events
     else:
-        query = query.where(
-            (EventLog.created < args.older_than)
-        )
-    for event_obj in query:
-        for elm_obj in event_obj.event_matches:
-            elm_obj.delete_instance()
-        event_obj.delete_instance()
+        where = EventLog.created < args.older_than
+    if args.dry_run:
+        print('Would purge {} events and {} matches'.format(*purge_count(where)))
+        return True
+    events, matches = purge_events(
+        where, args.chunk_size, args.sleep,
+        lambda events, matches: print('Purged {} events and {} matches'.format(events, matches))
+    )
+    print('Purged {} events and {} matches in total'.format(events, matches))
     return True
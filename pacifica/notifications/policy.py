@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Policy server authorization decisions and their cache."""
+from collections import namedtuple
+from hashlib import sha256
+from json import dumps
+from threading import Lock
+from .config import get_config
+from .jsonpath import parse, find_all
+from .metrics import METRICS
+from .store import store_from_url
+
+
+class PolicyDecision(namedtuple('PolicyDecision', ['status_code', 'text'])):
+    """The parts of a policy server response the tasks use."""
+
+    __slots__ = ()
+
+
+class PolicyCache:
+    """
+    Cache of policy decisions keyed by user and event fingerprint.
+
+    The fingerprint is the values matched by the fingerprint jsonpath
+    expressions, or the whole event if there are none. Only 2xx and
+    4xx decisions are cached, a 5xx is an error of the policy server.
+    """
+
+    def __init__(self, store, ttl=60, fingerprint=None):
+        """Create the cache in store with decisions expiring after ttl seconds."""
+        self.store = store
+        self.ttl = ttl
+        self.fingerprint = [parse(jsonpath_str) for jsonpath_str in (fingerprint or [])]
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def key(self, user, event_obj):
+        """Return the cache key for the user and event."""
+        if self.fingerprint:
+            event_obj = [find_all(expr, event_obj) for expr in self.fingerprint]
+        return 'policy:{}'.format(sha256(dumps([user, event_obj], sort_keys=True).encode('utf8')).hexdigest())
+
+    def get(self, user, event_obj):
+        """Return the cached PolicyDecision or None."""
+        value = self.store.get(self.key(user, event_obj))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return PolicyDecision(*value)
+
+    def set(self, user, event_obj, resp):
+        """Cache the decision in the response if it's cacheable."""
+        if int(int(resp.status_code)/100) not in (2, 4):
+            return
+        self.store.set(self.key(user, event_obj), [resp.status_code, resp.text], self.ttl)
+
+    def stats(self):
+        """Return a hash of the hit and miss counters."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def counters(self):
+        """Return the stats as (name, value, series key) counters for the metrics registry."""
+        stats = self.stats()
+        return [
+            ('notifications_policy_cache_hits_total', stats['hits'], ''),
+            ('notifications_policy_cache_misses_total', stats['misses'], ''),
+        ]
+
+
+def policy_cache_from_config():
+    """Return the PolicyCache configured or None if disabled."""
+    config = get_config()
+    store_url = config.get('notifications', 'policy_cache_url')
+    if not store_url:
+        return None
+    fingerprint = [
+        jsonpath_str.strip() for jsonpath_str in config.get('notifications', 'policy_cache_fingerprint').split(';')
+        if jsonpath_str.strip()
+    ]
+    return PolicyCache(
+        store_from_url(store_url, config.getint('notifications', 'policy_cache_size')),
+        config.getfloat('notifications', 'policy_cache_ttl'),
+        fingerprint
+    )
+
+
+POLICY_CACHE = policy_cache_from_config()
+if POLICY_CACHE is not None:
+    METRICS.register(POLICY_CACHE.counters)
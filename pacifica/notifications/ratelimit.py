@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Token bucket rate limits and in-flight caps per target host.
+
+The memory limiter is local to the process, the redis limiter is
+shared by every worker process using the same redis server. A
+delivery takes a token, reserving one ahead if the bucket is empty,
+then a lease on the host. The lease is released once the delivery is
+done or expires if the worker died before releasing it.
+"""
+from threading import Lock
+from time import time
+from uuid import uuid4
+from .config import get_config
+
+_TOKEN_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+if tokens < 0 then
+  return tostring(-tokens / rate)
+end
+return '0'
+"""
+
+_LEASE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_in_flight = tonumber(ARGV[2])
+local expires = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= max_in_flight then
+  local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+  return tostring(math.min(1, tonumber(first[2]) - now))
+end
+redis.call('ZADD', KEYS[1], expires, ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.ceil(expires - now) + 1)
+return '0'
+"""
+
+
+def _burst(rate, burst):
+    """Return the bucket size, at least one token."""
+    return max(1.0, float(burst or rate))
+
+
+class RateLimiter:
+    """Rate limits and in-flight caps per host kept in the process."""
+
+    def __init__(self, lease=300):
+        """Create the limiter with in-flight leases expiring after lease seconds."""
+        self.lease = lease
+        self._lock = Lock()
+        self._buckets = {}
+        self._in_flight = {}
+
+    def take_token(self, host, rate=0, burst=0):
+        """
+        Take a token from the bucket of host and return the seconds to wait.
+
+        An empty bucket goes negative, the token is reserved and the
+        caller must deliver after the wait without taking another one.
+        """
+        if rate <= 0:
+            return 0
+        burst = _burst(rate, burst)
+        now = time()
+        with self._lock:
+            tokens, stamp = self._buckets.get(host, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - stamp) * rate) - 1
+            self._buckets[host] = (tokens, now)
+        return -tokens / rate if tokens < 0 else 0
+
+    def acquire_lease(self, host, max_in_flight=0):
+        """
+        Take an in-flight lease on host.
+
+        Return a (lease, wait) tuple, wait is 0 once acquired and the
+        lease must be released when the delivery is done. Otherwise
+        wait is the seconds to wait before trying again.
+        """
+        if max_in_flight <= 0:
+            return None, 0
+        lease = uuid4().hex
+        now = time()
+        with self._lock:
+            leases = self._in_flight.setdefault(host, {})
+            for lease_id, expires in list(leases.items()):
+                if expires <= now:
+                    del leases[lease_id]
+            if len(leases) >= max_in_flight:
+                return None, min(1.0, min(leases.values()) - now)
+            leases[lease] = now + self.lease
+        return lease, 0
+
+    def release(self, host, lease):
+        """Release the in-flight lease on host."""
+        if lease is None:
+            return
+        with self._lock:
+            self._in_flight.get(host, {}).pop(lease, None)
+
+
+class RedisRateLimiter(RateLimiter):
+    """Rate limits and in-flight caps per host shared in a redis database."""
+
+    def __init__(self, url, lease=300, prefix='pacifica-notifications:ratelimit:'):
+        """Connect to the redis server at url, redis is an optional dependency."""
+        super(RedisRateLimiter, self).__init__(lease)
+        # pylint: disable=import-outside-toplevel
+        from redis import Redis
+        self.redis = Redis.from_url(url)
+        self.prefix = prefix
+        self._take_token = self.redis.register_script(_TOKEN_SCRIPT)
+        self._acquire_lease = self.redis.register_script(_LEASE_SCRIPT)
+
+    def take_token(self, host, rate=0, burst=0):
+        """Take a token from the bucket of host atomically in redis."""
+        if rate <= 0:
+            return 0
+        return float(self._take_token(
+            keys=[self.prefix + 'bucket:' + host],
+            args=[repr(time()), repr(float(rate)), repr(_burst(rate, burst))]
+        ))
+
+    def acquire_lease(self, host, max_in_flight=0):
+        """Take an in-flight lease on host atomically in redis."""
+        if max_in_flight <= 0:
+            return None, 0
+        lease = uuid4().hex
+        now = time()
+        wait = float(self._acquire_lease(
+            keys=[self.prefix + 'inflight:' + host],
+            args=[repr(now), int(max_in_flight), repr(now + self.lease), lease]
+        ))
+        if wait > 0:
+            return None, wait
+        return lease, 0
+
+    def release(self, host, lease):
+        """Release the in-flight lease on host."""
+        if lease is None:
+            return
+        self.redis.zrem(self.prefix + 'inflight:' + host, lease)
+
+
+def rate_limiter_from_url(url, lease=300):
+    """Return the rate limiter for url, memory:// or a redis url."""
+    if url.startswith('memory://'):
+        return RateLimiter(lease)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRateLimiter(url, lease)
+    raise ValueError('Unsupported rate limiter url {}'.format(url))
+
+
+def target_limits(eventmatch):
+    """Return the (rate, burst, max_in_flight) of the eventmatch or the configured defaults."""
+    config = get_config()
+    return tuple(
+        config.getfloat('notifications', option) if eventmatch.get(field) is None else eventmatch[field]
+        for field, option in [
+            ('rate_limit', 'target_rate_limit'),
+            ('rate_burst', 'target_rate_burst'),
+            ('max_in_flight', 'target_max_in_flight')]
+    )
+
+
+def rate_limiter_from_config():
+    """Return the rate limiter configured."""
+    config = get_config()
+    return rate_limiter_from_url(
+        config.get('notifications', 'rate_limit_url'),
+        config.getfloat('notifications', 'target_in_flight_lease')
+    )
+
+
+RATE_LIMITER = rate_limiter_from_config()
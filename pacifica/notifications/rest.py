@@ -1,16 +1,29 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """CherryPy module containing classes for rest interface."""
-from uuid import UUID
+from uuid import UUID, uuid4
+from contextlib import contextmanager
+from hashlib import sha1
+from urllib.parse import urlencode
+from codecs import getincrementaldecoder
 from datetime import datetime
-from json import dumps, loads
-from jsonschema import validate
+from json import JSONDecoder
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 import cherrypy
 from cherrypy import HTTPError
-from peewee import DoesNotExist
+from peewee import DoesNotExist, fn
+from playhouse.pool import PooledDatabase
 from pacifica.notifications import orm
 from pacifica.notifications.config import get_config
-from pacifica.notifications.tasks import dispatch_event
+from pacifica.notifications.jsoncodec import dumps, dumps_bytes, loads
+from pacifica.notifications.dedup import DEDUP
+from pacifica.notifications.metrics import CONTENT_TYPE, METRICS, render
+from pacifica.notifications.tasks import dispatch_event, dispatch_events
+
+READ_SIZE = 64 * 1024
+_VALIDATORS = {}
 
 
 def encode_text(thing_obj):
@@ -18,6 +31,37 @@ def encode_text(thing_obj):
     return bytes(thing_obj, 'utf8')  # pragma: no cover only for python 3
 
 
+def compiled_validator(schema):
+    """
+    Return the validator for schema checked and compiled once.
+
+    The validators are kept per schema object, a schema replaced on a
+    class gets a new validator on first use.
+    """
+    validator = _VALIDATORS.get(id(schema))
+    if validator is None or validator.schema is not schema:
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        _VALIDATORS[id(schema)] = validator
+    return validator
+
+
+def validate(obj, schema):
+    """Raise the best ValidationError of obj against schema like jsonschema.validate."""
+    error = best_match(compiled_validator(schema).iter_errors(obj))
+    if error is not None:
+        raise error
+
+
+def load_json_schema(path):
+    """Return the JSON schema in the file at path, an empty path accepts anything."""
+    if not path:
+        return {}
+    with open(path) as schema_fd:
+        return loads(schema_fd.read())
+
+
 def get_remote_user():
     """Get the remote user from cherrypy request headers."""
     return cherrypy.request.headers.get(
@@ -26,6 +70,148 @@ def get_remote_user():
     )
 
 
+def _skip_whitespace(buf, idx):
+    """Return the index of the first non whitespace character at or after idx."""
+    while idx < len(buf) and buf[idx] in ' \t\n\r':
+        idx += 1
+    return idx
+
+
+def _decode_value(decoder, buf, idx, eof):
+    """
+    Return the value at idx in buf and the index after it, None if it may go on in the next read.
+
+    A value is decoded once it's followed by something else than the
+    end of buf, for a number something else than more number characters.
+    """
+    try:
+        value, end = decoder.raw_decode(buf, idx)
+    except ValueError:
+        if eof:
+            raise
+        return None
+    stop = end
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        while stop < len(buf) and buf[stop] in '0123456789.eE+-':
+            stop += 1
+    if stop < len(buf) or eof:
+        return value, end
+    return None
+
+
+def iter_json_array(body, first=b'', read_size=READ_SIZE):
+    """
+    Yield the elements of a JSON array read incrementally from body.
+
+    The bytes in first were already read from the body. Only the
+    element being decoded and one read of look ahead are held in
+    memory, the read size grows with the buffer so a large element
+    isn't decoded over and over again. Anything but whitespace after
+    the array is an error.
+    """
+    decoder = JSONDecoder()
+    text = getincrementaldecoder('utf8')()
+    buf = text.decode(first)
+    idx = 0
+    eof = False
+    expect = '['
+    while True:
+        idx = _skip_whitespace(buf, idx)
+        if idx < len(buf):
+            if expect == 'value':
+                decoded = _decode_value(decoder, buf, idx, eof)
+                if decoded is not None:
+                    yield decoded[0]
+                    idx = decoded[1]
+                    expect = ','
+                    continue
+            elif expect == '[' and buf[idx] == '[':
+                idx += 1
+                expect = 'first'
+                continue
+            elif expect in ('first', ',') and buf[idx] == ']':
+                idx += 1
+                expect = 'end'
+                continue
+            elif expect == ',' and buf[idx] == ',':
+                idx += 1
+                expect = 'value'
+                continue
+            elif expect == 'first':
+                expect = 'value'
+                continue
+            else:
+                raise ValueError('Unexpected {!r} in JSON array'.format(buf[idx:idx + 20]))
+        if eof:
+            if expect == 'end':
+                return
+            raise ValueError('Unexpected end of JSON array')
+        data = body.read(max(read_size, len(buf) - idx))
+        eof = not data
+        buf = buf[idx:] + text.decode(data or b'', final=eof)
+        idx = 0
+
+
+def iter_ndjson(body):
+    """Yield the JSON documents of a newline delimited body."""
+    for line in iter(body.readline, b''):
+        line = line.strip()
+        if line:
+            yield loads(line)
+
+
+# pylint: disable=too-few-public-methods
+class DatabaseTool(cherrypy.Tool):
+    """
+    Check out a database connection for the duration of a request.
+
+    The connection is returned when the request ends even if the
+    handler raised an error. Enabled for pooled databases on Root,
+    the handlers then leave the connection alone.
+    """
+
+    def __init__(self):
+        """Attach the checkout to the start of the request."""
+        super(DatabaseTool, self).__init__('on_start_resource', self._checkout)
+
+    def _setup(self):
+        """Attach the return of the connection to the end of the request."""
+        super(DatabaseTool, self)._setup()
+        cherrypy.request.hooks.attach('on_end_request', self._release)
+
+    @staticmethod
+    def _checkout():
+        """Check out a database connection."""
+        orm.BaseModel.database_connect()
+
+    @staticmethod
+    def _release():
+        """Return the database connection."""
+        orm.BaseModel.database_close()
+# pylint: enable=too-few-public-methods
+
+
+cherrypy.tools.database = DatabaseTool()
+
+
+@contextmanager
+def request_database():
+    """
+    Connect to the database for the block.
+
+    The connection checked out by the database tool is used as is and
+    returned by the tool at the end of the request.
+    """
+    if (cherrypy.request.config or {}).get('tools.database.on'):
+        yield
+        return
+    orm.BaseModel.database_connect()
+    try:
+        yield
+    finally:
+        orm.BaseModel.database_close()
+
+
 def error_page_default(**kwargs):
     """The default error page should always enforce json."""
     cherrypy.response.headers['Content-Type'] = 'application/json'
@@ -81,6 +267,9 @@ class EventMatch:
                         },
                         'required': ['type']
                     },
+                    'rate_limit': {'type': ['number', 'null'], 'minimum': 0},
+                    'rate_burst': {'type': ['integer', 'null'], 'minimum': 0},
+                    'max_in_flight': {'type': ['integer', 'null'], 'minimum': 0},
                     'created': {'type': 'string', 'format': 'date-time'},
                     'updated': {'type': 'string', 'format': 'date-time'},
                     'deleted': {'type': ['string', 'null'], 'format': 'date-time'}
@@ -97,35 +286,116 @@ class EventMatch:
     def _http_get(event_uuid):
         """Internal get event by UUID and return peewee obj."""
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        orm.EventMatch.database_connect()
         try:
-            event_obj = orm.EventMatch.get(
-                orm.EventMatch.uuid == UUID('{{{}}}'.format(event_uuid)))
+            with request_database():
+                event_obj = orm.EventMatch.get(
+                    orm.EventMatch.uuid == UUID('{{{}}}'.format(event_uuid)))
         except DoesNotExist:
-            orm.EventMatch.database_close()
             raise HTTPError(403, 'Forbidden')
-        orm.EventMatch.database_close()
         if event_obj.user != get_remote_user() or event_obj.deleted:
             raise HTTPError(403, 'Forbidden')
         return event_obj
 
+    @staticmethod
+    def _list_etag(user, cursor, limit):
+        """
+        Return the ETag of a page of eventmatches of user.
+
+        The tag changes when any eventmatch of the user is created,
+        updated, deleted or disabled.
+        """
+        latest_updated, latest_disabled, count = orm.EventMatch.select(
+            fn.MAX(orm.EventMatch.updated), fn.MAX(orm.EventMatch.disabled), fn.COUNT(orm.EventMatch.uuid)
+        ).where(orm.EventMatch.user == user).tuples().get()
+        state = '{}|{}|{}|{}|{}|{}'.format(user, latest_updated, latest_disabled, count, cursor, limit)
+        return '"{}"'.format(sha1(state.encode('utf8')).hexdigest())
+
+    @staticmethod
+    def _etag_matches(etag, if_none_match):
+        """Return True if the If-None-Match header value matches etag."""
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+    @staticmethod
+    def _list_page(user, cursor, limit):
+        """Return up to limit + 1 eventmatch rows of user after the cursor uuid."""
+        query = orm.EventMatch.select().where(
+            (orm.EventMatch.user == user) &
+            (orm.EventMatch.deleted >> None)
+        )
+        if cursor:
+            query = query.where(orm.EventMatch.uuid > UUID('{{{}}}'.format(cursor)))
+        return list(query.order_by(orm.EventMatch.uuid).limit(limit + 1).dicts())
+
+    @staticmethod
+    def _encode_row(row):
+        """Encode an eventmatch row as the JSON of its hash without decoding extensions and auth."""
+        fields = dict(row, uuid=str(row['uuid']))
+        for dt_element in ['disabled', 'deleted', 'updated', 'created']:
+            if fields[dt_element]:
+                fields[dt_element] = fields[dt_element].isoformat()
+        extensions = fields.pop('extensions')
+        auth = fields.pop('auth')
+        return '{},"extensions":{},"auth":{}}}'.format(dumps(fields)[:-1], extensions, auth or 'null')
+
     @classmethod
-    # pylint: disable=invalid-name
-    def GET(cls, event_uuid=None):
-        """Get the event ID and return it."""
-        if event_uuid:
-            objs = cls._http_get(event_uuid).to_hash()
-        else:
-            cherrypy.response.headers['Content-Type'] = 'application/json'
-            orm.EventMatch.database_connect()
-            query = orm.EventMatch.select().where(
-                (orm.EventMatch.user == get_remote_user()) &
-                (orm.EventMatch.deleted >> None)
+    def _list(cls, cursor=None, limit=None):
+        """
+        Return the eventmatches of the user one page at a time.
+
+        The page is the limit eventmatches after the cursor uuid, the
+        Link header has the url of the next page. A request with a
+        matching If-None-Match header gets a 304.
+        """
+        max_limit = get_config().getint('notifications', 'eventmatch_page_size')
+        try:
+            limit = min(int(limit), max_limit) if limit else max_limit
+            if cursor:
+                UUID('{{{}}}'.format(cursor))
+        except ValueError:
+            raise HTTPError(400, 'Bad Request')
+        if limit < 1:
+            raise HTTPError(400, 'Bad Request')
+        user = get_remote_user()
+        with request_database():
+            etag = cls._list_etag(user, cursor, limit)
+            if cls._etag_matches(etag, cherrypy.request.headers.get('If-None-Match', '')):
+                cherrypy.response.headers['ETag'] = etag
+                raise cherrypy.HTTPRedirect([], 304)
+            rows = cls._list_page(user, cursor, limit)
+        if not rows and not cursor:
+            raise HTTPError(403, 'Forbidden')
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['ETag'] = etag
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cherrypy.response.headers['Link'] = '<{}>; rel="next"'.format(
+                cherrypy.url(qs=urlencode({'cursor': str(rows[-1]['uuid']), 'limit': limit}))
             )
-            objs = [x.to_hash() for x in query]
-            orm.EventMatch.database_close()
+        cherrypy.response.stream = True
+
+        def _stream():
+            """Encode the rows as a JSON array one row at a time."""
+            yield b'['
+            for index, row in enumerate(rows):
+                yield encode_text((',' if index else '') + cls._encode_row(row))
+            yield b']'
+        return _stream()
+
+    @classmethod
+    # pylint: disable=invalid-name
+    def GET(cls, event_uuid=None, cursor=None, limit=None):
+        """
+        Get the event ID and return it.
+
+        Without an event ID the eventmatches of the user are listed a
+        page at a time.
+        """
+        if not event_uuid:
+            return cls._list(cursor, limit)
+        objs = cls._http_get(event_uuid).to_hash()
         if objs:
-            return encode_text(dumps(objs))
+            return dumps_bytes(objs)
         raise HTTPError(403, 'Forbidden')
 
     @classmethod
@@ -133,7 +403,7 @@ class EventMatch:
     def PUT(cls, event_uuid):
         """Update an Event Match obj in the database."""
         event_obj = cls._http_get(event_uuid)
-        json_obj = loads(cherrypy.request.body.read().decode('utf8'))
+        json_obj = loads(cherrypy.request.body.read())
         validate(json_obj, cls.json_schema)
         json_obj['extensions'] = dumps(json_obj.get('extensions', {}))
         json_obj['auth'] = dumps(json_obj.get('auth', {}))
@@ -141,18 +411,16 @@ class EventMatch:
             setattr(event_obj, key, value)
         event_obj.updated = datetime.now()
         event_obj.validate_jsonpath()
-        orm.EventMatch.database_connect()
-        with orm.EventMatch.atomic():
+        with request_database(), orm.EventMatch.atomic():
             event_obj.save()
-        orm.EventMatch.database_close()
+            orm.NotificationSystem.bump_generation()
         return cls.GET(str(event_obj.uuid))
 
     @classmethod
     # pylint: disable=invalid-name
     def POST(cls):
         """Create an Event Match obj in the database."""
-        orm.EventMatch.database_connect()
-        event_match_obj = loads(cherrypy.request.body.read().decode('utf8'))
+        event_match_obj = loads(cherrypy.request.body.read())
         validate(event_match_obj, cls.json_schema)
         event_match_obj['extensions'] = dumps(
             event_match_obj.get('extensions', {})
@@ -161,9 +429,9 @@ class EventMatch:
         event_match_obj['user'] = get_remote_user()
         event_obj = orm.EventMatch(**event_match_obj)
         event_obj.validate_jsonpath()
-        with orm.EventMatch.atomic():
+        with request_database(), orm.EventMatch.atomic():
             event_obj.save(force_insert=True)
-        orm.EventMatch.database_close()
+            orm.NotificationSystem.bump_generation()
         return cls.GET(str(event_obj.uuid))
 
     @classmethod
@@ -171,12 +439,11 @@ class EventMatch:
     def DELETE(cls, event_uuid):
         """Delete the event by uuid."""
         event_obj = cls._http_get(event_uuid)
-        orm.EventMatch.database_connect()
         event_obj.deleted = datetime.now()
         event_obj.updated = datetime.now()
-        with orm.EventMatch.atomic():
+        with request_database(), orm.EventMatch.atomic():
             event_obj.save()
-        orm.EventMatch.database_close()
+            orm.NotificationSystem.bump_generation()
 
 
 # pylint: disable=too-few-public-methods
@@ -184,15 +451,126 @@ class ReceiveEvent:
     """CherryPy Receive Event object."""
 
     exposed = True
-    event_json_schema = {}
+    event_json_schema = load_json_schema(get_config().get('notifications', 'event_schema'))
+
+    @classmethod
+    def _dispatch_chunk(cls, chunk):
+        """
+        Send a chunk of (event log uuid, event) to the backend in one message.
+
+        With dedup on the duplicates are not sent, their result is the
+        uuid of the original event log.
+        """
+        METRICS.inc('notifications_events_received_total', len(chunk))
+        if DEDUP is None:
+            task_id = str(dispatch_events.delay(chunk))
+            return [{'task_id': task_id, 'event_log': event_log_uuid} for event_log_uuid, _event_obj in chunk]
+        dedup_keys = [DEDUP.key(event_obj) for _event_log_uuid, event_obj in chunk]
+        with request_database():
+            originals = DEDUP.claim([event_log_uuid for event_log_uuid, _event_obj in chunk], dedup_keys)
+        new_events = [index for index, original in enumerate(originals) if original is None]
+        if len(new_events) < len(chunk):
+            METRICS.inc('notifications_events_duplicate_total', len(chunk) - len(new_events))
+        task_id = None
+        if new_events:
+            new_keys = [dedup_keys[index] for index in new_events]
+            try:
+                task_id = str(dispatch_events.delay([chunk[index] for index in new_events], new_keys))
+            except Exception:
+                DEDUP.release(new_keys)
+                raise
+        return [
+            {'task_id': task_id, 'event_log': event_log_uuid} if original is None else
+            {'event_log': original, 'duplicate': True}
+            for (event_log_uuid, _event_obj), original in zip(chunk, originals)
+        ]
+
+    @classmethod
+    def _batch(cls, event_objs):
+        """Validate and dispatch the events in chunks returning the results in order."""
+        chunk_size = get_config().getint('notifications', 'batch_chunk_size')
+        results = []
+        chunk = []
+        slots = []
+        event_objs = iter(event_objs)
+        while True:
+            try:
+                event_obj = next(event_objs)
+            except StopIteration:
+                break
+            except ValueError as ex:
+                if not results:
+                    raise HTTPError(400, 'Bad Request: {}'.format(ex))
+                # events before the malformed one are already dispatched
+                results.append({'error': str(ex)})
+                break
+            try:
+                validate(event_obj, cls.event_json_schema)
+            except ValidationError as ex:
+                METRICS.inc('notifications_events_rejected_total')
+                results.append({'error': ex.message})
+                continue
+            chunk.append((str(uuid4()), event_obj))
+            slots.append(len(results))
+            results.append(None)
+            if len(chunk) == chunk_size:
+                for slot, result in zip(slots, cls._dispatch_chunk(chunk)):
+                    results[slot] = result
+                chunk = []
+                slots = []
+        if chunk:
+            for slot, result in zip(slots, cls._dispatch_chunk(chunk)):
+                results[slot] = result
+        return results
+
+    @classmethod
+    def _receive(cls):
+        """Read, validate and dispatch the single event or the batch in the request body."""
+        body = cherrypy.request.body
+        content_type = cherrypy.request.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-ndjson'):
+            event_objs = iter_ndjson(body)
+        else:
+            first = body.read(READ_SIZE)
+            if first.lstrip()[:1] != b'[':
+                event_obj = loads(first + body.read())
+                validate(event_obj, cls.event_json_schema)
+                if DEDUP is None:
+                    METRICS.inc('notifications_events_received_total')
+                    return encode_text(str(dispatch_event.delay(event_obj)))
+                result = cls._dispatch_chunk([(str(uuid4()), event_obj)])[0]
+                return encode_text(result['event_log'] if result.get('duplicate') else result['task_id'])
+            event_objs = iter_json_array(body, first)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return dumps_bytes(cls._batch(event_objs))
 
     @classmethod
     # pylint: disable=invalid-name
     def POST(cls):
-        """Receive the event and dispatch it to backend."""
-        event_obj = loads(cherrypy.request.body.read().decode('utf8'))
-        validate(event_obj, cls.event_json_schema)
-        return encode_text(str(dispatch_event.delay(event_obj)))
+        """
+        Receive the event and dispatch it to backend.
+
+        A JSON array or a newline delimited JSON body is a batch of events.
+        With dedup on a duplicate event is not dispatched again, the
+        uuid of the original event log is returned instead of a task id.
+        """
+        with METRICS.timer('notifications_stage_seconds', stage='receive'):
+            return cls._receive()
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-few-public-methods
+class PrometheusMetrics:
+    """CherryPy Prometheus metrics object."""
+
+    exposed = True
+
+    @staticmethod
+    # pylint: disable=invalid-name
+    def GET():
+        """Return the metrics of every process in the Prometheus text format."""
+        cherrypy.response.headers['Content-Type'] = CONTENT_TYPE
+        return encode_text(render(METRICS.collect()))
 # pylint: enable=too-few-public-methods
 
 
@@ -201,6 +579,13 @@ class Root:
     """CherryPy Root Object."""
 
     exposed = True
+    _cp_config = {'tools.database.on': isinstance(orm.DB, PooledDatabase)}
     eventmatch = EventMatch()
     receive = ReceiveEvent()
+    metrics = PrometheusMetrics()
 # pylint: enable=too-few-public-methods
+
+
+# check and compile the schemas at startup instead of on the first request
+compiled_validator(EventMatch.json_schema)
+compiled_validator(ReceiveEvent.event_json_schema)
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Time and size based retention of the event log.
+
+The retention policy is in the database section of the configuration
+and is enforced by the purge_retention task run by Celery beat.
+"""
+from datetime import datetime, time, timedelta
+from .config import get_config
+from .orm import EventLog, purge_events
+
+
+def in_window(window, now):
+    """
+    Return True if the time now is in the HH:MM-HH:MM window.
+
+    A window ending before it starts wraps past midnight, an empty
+    window is always open.
+    """
+    if not window:
+        return True
+    start, end = [
+        time(*[int(part) for part in window_time.strip().split(':')])
+        for window_time in window.split('-')
+    ]
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def retention_where(max_age_days=0, max_rows=0, now=None):
+    """
+    Return the EventLog where clause of the events past retention or None.
+
+    Events are past retention when older than max_age_days or older
+    than the newest max_rows events, 0 disables either limit.
+    """
+    where = None
+    if max_age_days > 0:
+        where = EventLog.created < (now or datetime.now()) - timedelta(days=max_age_days)
+    if max_rows > 0:
+        cutoff = EventLog.select(EventLog.created).order_by(
+            EventLog.created.desc(), EventLog.uuid.desc()
+        ).offset(max_rows - 1).limit(1).first()
+        if cutoff is not None:
+            rows_where = EventLog.created < cutoff.created
+            where = rows_where if where is None else (where | rows_where)
+    return where
+
+
+def enforce_retention(now=None):
+    """
+    Purge the events past retention if in the retention window.
+
+    Return a hash of the events and matches removed and whether the
+    purge was skipped because the window is closed.
+    """
+    config = get_config()
+    now = now or datetime.now()
+    if not in_window(config.get('database', 'retention_window'), now.time()):
+        return {'events': 0, 'matches': 0, 'skipped': True}
+    EventLog.database_connect()
+    try:
+        where = retention_where(
+            config.getfloat('database', 'retention_max_age'),
+            config.getint('database', 'retention_max_rows'),
+            now
+        )
+        events = matches = 0
+        if where is not None:
+            events, matches = purge_events(
+                where,
+                config.getint('database', 'retention_chunk_size'),
+                config.getfloat('database', 'retention_sleep')
+            )
+    finally:
+        EventLog.database_close()
+    return {'events': events, 'matches': matches, 'skipped': False}
+
+
+def retention_enabled():
+    """Return True if a retention limit is configured."""
+    config = get_config()
+    return config.getfloat('database', 'retention_max_age') > 0 or config.getint('database', 'retention_max_rows') > 0
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Keep-alive HTTP sessions shared by the tasks in a worker process.
+
+There is one requests session per scheme and host so connections to
+the policy server and to each subscriber are reused between tasks.
+"""
+import atexit
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from urllib.parse import urlsplit
+from requests import Session
+from requests.adapters import HTTPAdapter
+from .config import get_config
+from .metrics import METRICS, series_key
+
+
+class SessionPool:
+    """Thread safe pool of requests sessions keyed by scheme and host."""
+
+    def __init__(self, pool_connections=10, pool_maxsize=10):
+        """Create an empty pool, the sizes are passed to each HTTPAdapter."""
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = Lock()
+
+    def _new_session(self):
+        """
+        Return a new session with adapters of the configured size.
+
+        The session is shared by every user and subscription of the host
+        so it keeps no cookies.
+        """
+        session = Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize
+            ))
+        return session
+
+    def session(self, url):
+        """Return the session for the host of url creating it if needed."""
+        parts = urlsplit(url)
+        key = '{}://{}'.format(parts.scheme, parts.netloc)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._new_session()
+                self._sessions[key] = session
+            return session
+
+    def post(self, url, **kwargs):
+        """Post to url using the session for its host."""
+        return self.session(url).post(url, **kwargs)
+
+    def stats(self):
+        """
+        Return a hash of the requests and connections per host and in total.
+
+        The counters come from the urllib3 connection pools, reused is
+        the number of requests that didn't open a new connection.
+        """
+        with self._lock:
+            sessions = list(self._sessions.items())
+        hosts = {}
+        for key, session in sessions:
+            host_stats = {'requests': 0, 'new_connections': 0}
+            for adapter in session.adapters.values():
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    host_stats['requests'] += pool.num_requests
+                    host_stats['new_connections'] += pool.num_connections
+            host_stats['reused_connections'] = max(host_stats['requests'] - host_stats['new_connections'], 0)
+            hosts[key] = host_stats
+        ret = {
+            key: sum(host_stats[key] for host_stats in hosts.values())
+            for key in ('requests', 'new_connections', 'reused_connections')
+        }
+        ret['hosts'] = hosts
+        return ret
+
+    def counters(self):
+        """Return the per host stats as (name, value, series key) counters for the metrics registry."""
+        counters = []
+        for host, host_stats in self.stats()['hosts'].items():
+            key = series_key(host=host)
+            counters.extend([
+                ('notifications_http_requests_total', host_stats['requests'], key),
+                ('notifications_http_connections_new_total', host_stats['new_connections'], key),
+                ('notifications_http_connections_reused_total', host_stats['reused_connections'], key),
+            ])
+        return counters
+
+    def close(self):
+        """Close every session and its connections."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+def session_pool_from_config():
+    """Return a SessionPool sized from the configuration."""
+    config = get_config()
+    return SessionPool(
+        config.getint('notifications', 'http_pool_connections'),
+        config.getint('notifications', 'http_pool_maxsize')
+    )
+
+
+SESSIONS = session_pool_from_config()
+METRICS.register(SESSIONS.counters)
+atexit.register(SESSIONS.close)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Key value stores with expiring keys.
+
+The memory store lives in the process, the redis store is shared by
+every process using the same redis server. Values must be JSON
+serializable.
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from .jsoncodec import dumps_bytes, loads
+
+
+class MemoryStore:
+    """Thread safe in process store evicting the oldest keys past maxsize."""
+
+    def __init__(self, maxsize=10000):
+        """Create an empty store holding at most maxsize keys."""
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value of key or None if missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Set key to value expiring after ttl seconds."""
+        expires = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Set key to value expiring after ttl seconds if missing, return True if set."""
+        expires = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > monotonic()):
+                return False
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def incr(self, key):
+        """Add one to the integer value of key, missing is 0, and return it."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[1] is not None and item[1] <= monotonic()):
+                item = (0, None)
+            self._data[key] = (item[0] + 1, item[1])
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return item[0] + 1
+
+    def delete(self, key):
+        """Remove key from the store."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove every key from the store."""
+        with self._lock:
+            self._data.clear()
+
+
+class RedisStore:
+    """Store shared between processes in a redis database."""
+
+    def __init__(self, url, prefix='pacifica-notifications:'):
+        """Connect to the redis server at url, redis is an optional dependency."""
+        # pylint: disable=import-outside-toplevel
+        from redis import Redis
+        self.redis = Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        """Return the value of key or None if missing or expired."""
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        return loads(value)
+
+    def set(self, key, value, ttl=None):
+        """Set key to value expiring after ttl seconds."""
+        self.redis.set(self.prefix + key, dumps_bytes(value), px=None if ttl is None else int(ttl * 1000))
+
+    def add(self, key, value, ttl=None):
+        """Set key to value expiring after ttl seconds if missing, return True if set."""
+        return bool(self.redis.set(
+            self.prefix + key, dumps_bytes(value), px=None if ttl is None else int(ttl * 1000), nx=True
+        ))
+
+    def incr(self, key):
+        """Add one to the integer value of key, missing is 0, and return it."""
+        return self.redis.incr(self.prefix + key)
+
+    def delete(self, key):
+        """Remove key from the store."""
+        self.redis.delete(self.prefix + key)
+
+    def clear(self):
+        """Remove every key with the prefix from the store."""
+        keys = list(self.redis.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+def store_from_url(url, maxsize=10000):
+    """Return the store for url, memory:// or a redis url."""
+    if url.startswith('memory://'):
+        return MemoryStore(maxsize)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError('Unsupported store url {}'.format(url))
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""In memory snapshot of the active subscriptions."""
+from collections.abc import Mapping
+from threading import Lock
+from time import monotonic
+from .orm import EventMatch, NotificationSystem
+from .jsonpath import parse, find, required_constraints
+from .config import get_config
+from .metrics import METRICS, series_key
+
+_MISSING = object()
+
+
+def _lookup(event_obj, key_path):
+    """Return the value at the literal key path or _MISSING."""
+    value = event_obj
+    for key in key_path:
+        if not isinstance(value, Mapping) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+class SubscriptionIndex:
+    """
+    Discrimination index over the compiled subscription expressions.
+
+    Each subscription is filed under the most selective constraint
+    required_constraints() found for its jsonpath. Events are only
+    evaluated against the subscriptions whose constraint they satisfy
+    and the subscriptions that couldn't be analyzed.
+    """
+
+    def __init__(self, subscriptions):
+        """Build the index from (eventmatch hash, compiled jsonpath) tuples."""
+        self.subscriptions = subscriptions
+        self.by_uuid = {eventmatch['uuid']: eventmatch for eventmatch, _jsonpath_expr in subscriptions}
+        self._series_keys = {
+            uuid: (series_key(subscription=uuid), {
+                matched: series_key(subscription=uuid, matched=str(matched).lower()) for matched in (False, True)
+            }) for uuid in self.by_uuid
+        }
+        self._fallback = []
+        self._by_key = {}
+        self._by_value = {}
+        for position, (_eventmatch, jsonpath_expr) in enumerate(subscriptions):
+            key_path, equals = required_constraints(jsonpath_expr)
+            if equals:
+                path, value = equals[0]
+                self._by_value.setdefault(path, {}).setdefault(value, []).append(position)
+            elif key_path:
+                self._by_key.setdefault(key_path, []).append(position)
+            else:
+                self._fallback.append(position)
+
+    def candidates(self, event_obj):
+        """Return the subscriptions the event could match in their original order."""
+        positions = list(self._fallback)
+        for key_path, key_positions in self._by_key.items():
+            if _lookup(event_obj, key_path) is not _MISSING:
+                positions.extend(key_positions)
+        for path, value_positions in self._by_value.items():
+            try:
+                positions.extend(value_positions.get(_lookup(event_obj, path), []))
+            except TypeError:
+                # unhashable values never equal a literal
+                continue
+        return [self.subscriptions[position] for position in sorted(positions)]
+
+    def match(self, event_obj):
+        """Return the eventmatch hashes whose jsonpath matches the event timing each evaluation."""
+        matches = []
+        increments = []
+        with METRICS.timer('notifications_stage_seconds', stage='match'):
+            for eventmatch, jsonpath_expr in self.candidates(event_obj):
+                start = monotonic()
+                matched = bool(find(jsonpath_expr, event_obj))
+                seconds_key, evaluations_keys = self._series_keys[eventmatch['uuid']]
+                increments.append(('notifications_jsonpath_seconds_total', monotonic() - start, seconds_key))
+                increments.append(('notifications_jsonpath_evaluations_total', 1, evaluations_keys[matched]))
+                if matched:
+                    matches.append(eventmatch)
+            METRICS.inc_all(increments)
+        return matches
+
+
+class ActiveSubscriptions:
+    """
+    Snapshot of the enabled and not deleted EventMatch objects.
+
+    The snapshot is reloaded only when the subscription generation
+    stored in the database changes. The generation is checked at most
+    once every check_interval seconds so dispatching an event usually
+    doesn't touch the database at all.
+    """
+
+    def __init__(self, check_interval=5):
+        """Create an empty snapshot."""
+        self.check_interval = check_interval
+        self.generation = None
+        self._checked = 0
+        self._index = SubscriptionIndex([])
+        self._lock = Lock()
+
+    def invalidate(self):
+        """Force a reload of the snapshot on the next access."""
+        with self._lock:
+            self.generation = None
+
+    @staticmethod
+    def _load():
+        """Load the active subscriptions with their compiled jsonpath."""
+        query = EventMatch.select().where(
+            (EventMatch.deleted >> None) &
+            (EventMatch.disabled >> None)
+        )
+        return [(eventmatch.to_hash(), parse(eventmatch.jsonpath)) for eventmatch in query]
+
+    def index(self):
+        """Return the SubscriptionIndex reloading it if the generation changed."""
+        with self._lock:
+            now = monotonic()
+            if self.generation is not None and now - self._checked < self.check_interval:
+                return self._index
+            EventMatch.database_connect()
+            try:
+                generation = NotificationSystem.get_generation()
+                if generation != self.generation:
+                    self._index = SubscriptionIndex(self._load())
+            finally:
+                EventMatch.database_close()
+            self.generation = generation
+            self._checked = now
+            return self._index
+
+    def get(self):
+        """Return the list of (eventmatch hash, compiled jsonpath) tuples."""
+        return self.index().subscriptions
+
+    def match(self, event_obj):
+        """Return the active eventmatch hashes matching the event."""
+        return self.index().match(event_obj)
+
+    def lookup(self, eventmatch_uuids):
+        """
+        Return the active eventmatch hashes for the uuids.
+
+        The snapshot is reloaded once if some are missing, in case they
+        were created since. The ones still missing aren't active and
+        are left out.
+        """
+        by_uuid = self.index().by_uuid
+        if any(eventmatch_uuid not in by_uuid for eventmatch_uuid in eventmatch_uuids):
+            self.invalidate()
+            by_uuid = self.index().by_uuid
+        return [by_uuid[eventmatch_uuid] for eventmatch_uuid in eventmatch_uuids if eventmatch_uuid in by_uuid]
+
+
+ACTIVE_SUBSCRIPTIONS = ActiveSubscriptions(
+    get_config().getfloat('notifications', 'subscription_check_interval')
+)
@@ -1,14 +1,27 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """The Celery tasks module."""
+from collections import OrderedDict, namedtuple
 from datetime import datetime
-from json import dumps, loads
-import requests
+from functools import partial
+from random import uniform
+from time import monotonic
 from requests.exceptions import RequestException
 from celery import Celery
-from .orm import EventMatch, EventLog, EventLogMatch
-from .jsonpath import parse, find
-from .config import get_config
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+from peewee import chunked
+from .orm import EventMatch, EventLog, EventLogMatch, NotificationSystem
+from .subscriptions import ACTIVE_SUBSCRIPTIONS
+from .policy import POLICY_CACHE
+from .breaker import BREAKER, backoff_delay, url_host
+from .ratelimit import RATE_LIMITER, target_limits
+from .sessions import SESSIONS
+from .delivery import DELIVERY_ENGINE, TargetRequest
+from .retention import enforce_retention, retention_enabled
+from .claimcheck import EVENT_CACHE, claim_check_enabled, claim_event, claim_eventmatches, eventmatch_ticket
+from .config import get_config, install_sighup_handler
+from .jsoncodec import dumps_bytes
+from .metrics import METRICS, start_exporter
 
 CELERY_APP = Celery(
     'notifications',
@@ -16,57 +29,161 @@ CELERY_APP = Celery(
     backend=get_config().get('celery', 'backend_url')
 )
 
+if retention_enabled():
+    CELERY_APP.conf.beat_schedule = {
+        'purge-retention': {
+            'task': 'pacifica.notifications.tasks.purge_retention',
+            'schedule': get_config().getfloat('database', 'retention_interval')
+        }
+    }
+
+
+@worker_init.connect
+def _worker_init(**_kwargs):
+    """Start the metrics exporter of the worker processes if a port is configured."""
+    port = get_config().getint('notifications', 'metrics_port')
+    if port:
+        start_exporter(port)
+
+
+@worker_process_init.connect
+def _worker_process_init(**_kwargs):
+    """Read the configuration again on SIGHUP and drop the sessions, events and metrics inherited from the parent."""
+    install_sighup_handler()
+    SESSIONS.close()
+    EVENT_CACHE.clear()
+    METRICS.reset()
+
+
+@worker_process_shutdown.connect
+def _worker_process_shutdown(**_kwargs):
+    """Finish the deliveries in flight, write the metrics and close the keep-alive connections."""
+    if DELIVERY_ENGINE is not None:
+        DELIVERY_ENGINE.close()
+    METRICS.flush()
+    SESSIONS.close()
+
+
+@CELERY_APP.task
+def purge_retention():
+    """Purge the event log past the retention policy and return what was removed."""
+    return enforce_retention()
+
 
 @CELERY_APP.task
 def dispatch_event(event_obj):
     """Get all the events and see which match."""
+    fields = EventLog.encode(event_obj)
     EventLog.database_connect()
-    orm_event = EventLog.create(
-        jsondata=dumps(event_obj)
-    )
-    orm_event.save()
+    with METRICS.timer('notifications_db_seconds', operation='eventlog_insert'):
+        orm_event = EventLog.create(**fields)
     EventLog.database_close()
     dispatch_orm_event(orm_event)
 
 
+@CELERY_APP.task
+def dispatch_events(events, dedup_keys=None):
+    """
+    Log and dispatch a list of (event log uuid, event) pairs.
+
+    The event logs are inserted in one transaction and the whole batch
+    is matched against one snapshot of the subscriptions before any
+    policy queries are sent. The dedup keys of the events are logged
+    with them when given.
+    """
+    codec = get_config().get('database', 'event_codec')
+    rows = [
+        dict(EventLog.encode(event_obj, codec), uuid=event_log_uuid, dedup_key=dedup_key)
+        for (event_log_uuid, event_obj), dedup_key in zip(events, dedup_keys or [None] * len(events))
+    ]
+    EventLog.database_connect()
+    with METRICS.timer('notifications_db_seconds', operation='eventlog_insert'), EventLog.atomic():
+        for rows_chunk in chunked(rows, 100):
+            EventLog.insert_many(rows_chunk).execute()
+    EventLog.database_close()
+    subscriptions = ACTIVE_SUBSCRIPTIONS.index()
+    matches = [
+        (event_log_uuid, event_obj, subscriptions.match(event_obj))
+        for event_log_uuid, event_obj in events
+    ]
+    for event_log_uuid, event_obj, eventmatches in matches:
+        queue_matches(event_obj, event_log_uuid, eventmatches)
+
+
+def group_by_user(eventmatches):
+    """Return a list of (user, eventmatches) keeping the order of the users."""
+    by_user = OrderedDict()
+    for eventmatch in eventmatches:
+        by_user.setdefault(eventmatch['user'], []).append(eventmatch)
+    return list(by_user.items())
+
+
+def queue_matches(event_obj, event_log_uuid, eventmatches):
+    """
+    Queue the policy queries and deliveries of the eventmatches.
+
+    The user fan-out sends one message per user with the eventmatch
+    hashes. The event fan-out sends one message per event with only
+    the eventmatch uuids and does the per user and per eventmatch work
+    in the worker consuming it.
+
+    With claim_check on the messages carry the event log uuid in place
+    of the event and the eventmatch uuids in place of the hashes.
+    """
+    if not eventmatches:
+        return []
+    if claim_check_enabled():
+        event_obj = event_log_uuid
+    if get_config().get('notifications', 'dispatch_fanout') == 'event':
+        return [fanout_event.delay(
+            event_obj, event_log_uuid, [eventmatch['uuid'] for eventmatch in eventmatches]
+        )]
+    return [
+        query_user_policy.delay(
+            [eventmatch_ticket(eventmatch, event_obj) for eventmatch in user_eventmatches], event_obj, event_log_uuid
+        )
+        for _user, user_eventmatches in group_by_user(eventmatches)
+    ]
+
+
 def dispatch_orm_event(orm_event):
     """Dispatch the event from an existing orm obj."""
-    results = []
-    event_obj = loads(orm_event.jsondata)
-    EventMatch.database_connect()
-    eventmatch_objs = EventMatch.select().where(
-        (EventMatch.deleted >> None) &
-        (EventMatch.disabled >> None)
-    )
-    EventMatch.database_close()
-    for eventmatch in eventmatch_objs:
-        jsonpath_expr = parse(eventmatch.jsonpath)
-        if find(jsonpath_expr, event_obj):
-            results.append(query_policy.delay(eventmatch.to_hash(), event_obj, orm_event.uuid))
-    return results
+    event_obj = orm_event.event_obj()
+    return queue_matches(event_obj, str(orm_event.uuid), ACTIVE_SUBSCRIPTIONS.match(event_obj))
+
+
+@CELERY_APP.task
+def fanout_event(event_obj, event_log_uuid, eventmatch_uuids):
+    """Query the policy per user and route the event to the eventmatches in this worker."""
+    eventmatches = ACTIVE_SUBSCRIPTIONS.lookup(eventmatch_uuids)
+    for _user, user_eventmatches in group_by_user(eventmatches):
+        query_user_policy(user_eventmatches, event_obj, event_log_uuid, fanout=True)
 
 
 def disable_eventmatch(eventmatch_uuid, error):
-    """Disable the eventmatch obj."""
+    """Disable the eventmatch obj unless it is already disabled or deleted."""
     EventMatch.database_connect()
-    with EventMatch.atomic():
-        eventmatch = EventMatch.get(EventMatch.uuid == eventmatch_uuid)
-        eventmatch.disabled = datetime.now()
-        eventmatch.error = error
-        eventmatch.save()
+    with METRICS.timer('notifications_db_seconds', operation='eventmatch_disable'), EventMatch.atomic():
+        disabled = EventMatch.update(disabled=datetime.now(), error=error).where(
+            (EventMatch.uuid == eventmatch_uuid) & (EventMatch.disabled >> None) & (EventMatch.deleted >> None)
+        ).execute()
+        if disabled:
+            NotificationSystem.bump_generation()
     EventMatch.database_close()
+    ACTIVE_SUBSCRIPTIONS.invalidate()
 
 
 def create_log_match(eventmatch, event_log_uuid, policy_resp):
     """Create the EventLogMatch object."""
     EventLogMatch.database_connect()
-    orm_elm = EventLogMatch.create(
-        event_log=event_log_uuid,
-        event_match=eventmatch['uuid'],
-        policy_status_code=policy_resp.status_code,
-        policy_resp_body=policy_resp.text
-    )
-    orm_elm.save()
+    with METRICS.timer('notifications_db_seconds', operation='eventlogmatch_insert'):
+        orm_elm = EventLogMatch.create(
+            event_log=event_log_uuid,
+            event_match=eventmatch['uuid'],
+            policy_status_code=policy_resp.status_code,
+            policy_resp_body=policy_resp.text
+        )
+        orm_elm.save()
     EventLogMatch.database_close()
     return orm_elm.uuid
 
@@ -74,33 +191,104 @@ def create_log_match(eventmatch, event_log_uuid, policy_resp):
 def update_log_match(elm_uuid, target_resp):
     """Update the EventLogMatch object with the target resp."""
     EventLogMatch.database_connect()
-    orm_elm = EventLogMatch.get_by_id(elm_uuid)
-    orm_elm.target_status_code = target_resp.status_code
-    orm_elm.target_resp_body = target_resp.text
-    orm_elm.save()
+    with METRICS.timer('notifications_db_seconds', operation='eventlogmatch_update'):
+        orm_elm = EventLogMatch.get_by_id(elm_uuid)
+        orm_elm.target_status_code = target_resp.status_code
+        orm_elm.target_resp_body = target_resp.text
+        orm_elm.save()
     EventLogMatch.database_close()
 
 
-@CELERY_APP.task
-def query_policy(eventmatch, event_obj, event_log_uuid):
-    """Query policy server to see if the event should be routed."""
-    resp = requests.post(
-        '{}/events/{}'.format(
-            get_config().get('notifications', 'policy_url'),
-            eventmatch['user']
-        ),
-        data=dumps(event_obj),
-        headers={'Content-Type': 'application/json'}
+def policy_decision(user, event_obj):
+    """Return the policy server response for the user and event using the cache if enabled."""
+    if POLICY_CACHE is not None:
+        resp = POLICY_CACHE.get(user, event_obj)
+        if resp is not None:
+            return resp
+    with METRICS.timer('notifications_stage_seconds', stage='policy'):
+        resp = SESSIONS.post(
+            '{}/events/{}'.format(
+                get_config().get('notifications', 'policy_url'),
+                user
+            ),
+            data=dumps_bytes(event_obj),
+            headers={'Content-Type': 'application/json'}
+        )
+    if POLICY_CACHE is not None:
+        POLICY_CACHE.set(user, event_obj, resp)
+    return resp
+
+
+def retry_delay(attempt):
+    """Return the countdown before retry attempt or None if out of attempts."""
+    config = get_config()
+    if attempt >= config.getint('notifications', 'retry_max_attempts'):
+        return None
+    return backoff_delay(
+        attempt,
+        config.getfloat('notifications', 'retry_backoff'),
+        config.getfloat('notifications', 'retry_backoff_max')
     )
+
+
+def retry_user_policy(eventmatches, event_obj, event_log_uuid, attempt, fanout):
+    """Query the policy server again later for the eventmatches, return False if out of attempts."""
+    countdown = retry_delay(attempt + 1)
+    if countdown is None:
+        return False
+    query_user_policy.apply_async(
+        ([eventmatch_ticket(eventmatch, event_obj) for eventmatch in eventmatches], event_obj, event_log_uuid),
+        {'attempt': attempt + 1, 'fanout': fanout},
+        countdown=countdown
+    )
+    return True
+
+
+@CELERY_APP.task
+def query_user_policy(eventmatches, event_obj, event_log_uuid, attempt=0, fanout=False):
+    """
+    Query policy server once for the eventmatches of one user.
+
+    The decision applies to every eventmatch, each one gets its
+    EventLogMatch object and is routed or disabled on its own. A 5xx
+    is retried with backoff, the eventmatches are disabled once the
+    retries run out. An unreachable policy server is retried the same
+    way but never disables the eventmatches, the task fails once the
+    retries run out. With fanout the events are routed in this worker
+    instead of queued. The event and eventmatches may be claim check
+    tickets, they are passed on as tickets. Retries only go on for the
+    eventmatches still active.
+    """
+    active = claim_eventmatches(eventmatches, refresh=attempt > 0)
+    if not active:
+        return
+    try:
+        resp = policy_decision(active[0]['user'], claim_event(event_obj))
+    except RequestException:
+        METRICS.inc('notifications_policy_decisions_total', status_code='error')
+        if retry_user_policy(active, event_obj, event_log_uuid, attempt, fanout):
+            return
+        raise
+    METRICS.inc('notifications_policy_decisions_total', status_code=resp.status_code)
     resp_major = int(int(resp.status_code)/100)
-    if resp_major == 5:
-        create_log_match(eventmatch, event_log_uuid, resp)
-        disable_eventmatch(eventmatch['uuid'], resp.text)
-    if resp_major == 4:
+    if resp_major == 5 and retry_user_policy(active, event_obj, event_log_uuid, attempt, fanout):
         return
-    if resp_major == 2:
-        elm_uuid = create_log_match(eventmatch, event_log_uuid, resp)
-        route_event.delay(eventmatch, event_obj, elm_uuid)
+    for eventmatch in active:
+        if resp_major == 5:
+            create_log_match(eventmatch, event_log_uuid, resp)
+            disable_eventmatch(eventmatch['uuid'], resp.text)
+        if resp_major == 2:
+            elm_uuid = create_log_match(eventmatch, event_log_uuid, resp)
+            if fanout:
+                route_event(eventmatch, event_obj, str(elm_uuid))
+            else:
+                route_event.delay(eventmatch_ticket(eventmatch, event_obj), event_obj, elm_uuid)
+
+
+@CELERY_APP.task
+def query_policy(eventmatch, event_obj, event_log_uuid):
+    """Query policy server to see if the event should be routed."""
+    query_user_policy([eventmatch], event_obj, event_log_uuid)
 
 
 def event_auth_to_requests(eventmatch, headers):
@@ -118,25 +306,131 @@ def event_auth_to_requests(eventmatch, headers):
     return requests_kwargs
 
 
+class Delivery(namedtuple('Delivery', ['eventmatch', 'event_obj', 'elm_uuid', 'attempt', 'lease', 'started'])):
+    """A delivery of the event to the eventmatch target holding the lease since the started monotonic time."""
+
+    __slots__ = ()
+
+
+def route_result(delivery, resp, error=None):
+    """
+    Log the target response and retry or disable the eventmatch on failure.
+
+    The in-flight lease on the target host is released first and the
+    delivery latency recorded. Failures are retried with backoff, the
+    eventmatch is disabled once the retries run out. Errors and 5xx,
+    408 or 429 responses count against the circuit breaker of the
+    target host.
+    """
+    eventmatch = delivery.eventmatch
+    host = url_host(eventmatch['target_url'])
+    RATE_LIMITER.release(host, delivery.lease)
+    elapsed = monotonic() - delivery.started
+    METRICS.observe('notifications_stage_seconds', elapsed, stage='route')
+    METRICS.observe('notifications_delivery_seconds', elapsed, host=host)
+    METRICS.inc(
+        'notifications_deliveries_total', host=host, subscription=eventmatch['uuid'],
+        status_code=resp.status_code if resp is not None else 'error'
+    )
+    if resp is not None:
+        update_log_match(delivery.elm_uuid, resp)
+        if int(int(resp.status_code)/100) == 2:
+            BREAKER.record_success(host)
+            return
+        error = resp.text
+    if resp is None or int(resp.status_code) in (408, 429) or int(int(resp.status_code)/100) == 5:
+        BREAKER.record_failure(host)
+    countdown = retry_delay(delivery.attempt + 1)
+    if countdown is None:
+        disable_eventmatch(eventmatch['uuid'], error)
+        return
+    route_event.apply_async(
+        (eventmatch_ticket(eventmatch, delivery.event_obj), delivery.event_obj, delivery.elm_uuid),
+        {'attempt': delivery.attempt + 1},
+        countdown=countdown
+    )
+
+
+def hold_event(eventmatch, event_obj, elm_uuid, attempt, wait):
+    """Deliver the event again after wait seconds, its rate limit token is reserved."""
+    METRICS.inc('notifications_deliveries_held_total', host=url_host(eventmatch['target_url']))
+    route_event.apply_async(
+        (eventmatch_ticket(eventmatch, event_obj), event_obj, elm_uuid), {'attempt': attempt, 'reserved': True},
+        countdown=wait + uniform(0, min(1.0, wait))
+    )
+
+
+def acquire_delivery(eventmatch, host, reserved=False):
+    """
+    Return the in-flight lease on host and the seconds to hold the delivery.
+
+    A rate limit token is taken unless one is reserved, then a lease
+    if the host is under its in-flight cap and its circuit breaker is
+    closed. The lease is released again if the delivery is held.
+    """
+    rate, burst, max_in_flight = target_limits(eventmatch)
+    if not reserved:
+        wait = RATE_LIMITER.take_token(host, rate, burst)
+        if wait:
+            return None, wait
+    lease, wait = RATE_LIMITER.acquire_lease(host, max_in_flight)
+    if not wait:
+        wait = BREAKER.retry_after(host)
+        if wait:
+            RATE_LIMITER.release(host, lease)
+    return lease, wait
+
+
+def target_body(eventmatch, event_obj):
+    """Return the event posted to the target with the eventmatch extensions merged in a copy."""
+    body = claim_event(event_obj)
+    new_extensions = dict(body.get('extensions', {}))
+    new_extensions.update(eventmatch.get('extensions', {}))
+    return dict(body, extensions=new_extensions)
+
+
 @CELERY_APP.task
-def route_event(eventmatch, event_obj, elm_uuid):
-    """Route the event to the target url."""
+def route_event(eventmatch, event_obj, elm_uuid, attempt=0, reserved=False):
+    """
+    Route the event to the target url.
+
+    The delivery takes a rate limit token unless one is reserved and an
+    in-flight lease on the target host. While the host is over its
+    limits or its circuit breaker is open the event is held and
+    delivered again later. With the asyncio delivery engine the post
+    is queued on the engine and the task returns without waiting for
+    the target. The event and eventmatch may be claim check tickets.
+    The eventmatch of a ticket, a retry or a held delivery is looked up
+    again and an eventmatch no longer active isn't delivered to.
+    """
+    if isinstance(eventmatch, str) or attempt or reserved:
+        eventmatches = claim_eventmatches([eventmatch], refresh=True)
+        if not eventmatches:
+            return
+        eventmatch = eventmatches[0]
+    host = url_host(eventmatch['target_url'])
+    lease, wait = acquire_delivery(eventmatch, host, reserved)
+    if wait:
+        hold_event(eventmatch, event_obj, elm_uuid, attempt, wait)
+        return
+    data = dumps_bytes(target_body(eventmatch, event_obj))
+    headers = {'Content-Type': 'application/json'}
+    extra_args = event_auth_to_requests(eventmatch, headers)
+    delivery = Delivery(eventmatch, event_obj, elm_uuid, attempt, lease, monotonic())
+    if DELIVERY_ENGINE is not None:
+        DELIVERY_ENGINE.submit(
+            TargetRequest(eventmatch['target_url'], data, headers, extra_args.get('auth')),
+            partial(route_result, delivery)
+        )
+        return
     try:
-        new_extensions = event_obj.get('extensions', {})
-        new_extensions.update(eventmatch.get('extensions', {}))
-        event_obj['extensions'] = new_extensions
-        headers = {'Content-Type': 'application/json'}
-        extra_args = event_auth_to_requests(eventmatch, headers)
-        resp = requests.post(
+        resp = SESSIONS.post(
             eventmatch['target_url'],
-            data=dumps(event_obj),
+            data=data,
             headers=headers,
             **extra_args
         )
     except RequestException as ex:
-        disable_eventmatch(eventmatch['uuid'], str(ex))
+        route_result(delivery, None, str(ex))
         return
-    resp_major = int(int(resp.status_code)/100)
-    if resp_major in (5, 4):
-        disable_eventmatch(eventmatch['uuid'], resp.text)
-    update_log_match(elm_uuid, resp)
+    route_result(delivery, resp)
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the retry schedule and the circuit breakers."""
+import os
+from datetime import datetime
+from unittest import TestCase
+import mock
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from pacifica.notifications import tasks
+from pacifica.notifications.breaker import CircuitBreaker, backoff_delay, url_host
+from pacifica.notifications.orm import EventMatch, NotificationSystem
+from pacifica.notifications.policy import PolicyDecision
+from pacifica.notifications.store import MemoryStore
+from pacifica.notifications.subscriptions import ActiveSubscriptions
+from .common_test import active_subscriptions, eventmatch_droptables
+
+
+class TestCircuitBreaker(TestCase):
+    """Test the breaker state changes."""
+
+    @mock.patch('pacifica.notifications.breaker.time')
+    def test_open_half_open_close(self, mock_time):
+        """Test the breaker opens, lets one probe through and closes."""
+        mock_time.return_value = 1000.0
+        breaker = CircuitBreaker(MemoryStore(), failure_threshold=2, reset_timeout=60)
+        host = url_host('http://example.com:8080/path')
+        self.assertEqual(host, 'http://example.com:8080')
+        breaker.record_failure(host)
+        self.assertEqual(breaker.retry_after(host), 0)
+        breaker.record_failure(host)
+        self.assertEqual(breaker.retry_after(host), 60)
+        mock_time.return_value = 1030.0
+        self.assertEqual(breaker.retry_after(host), 30)
+        mock_time.return_value = 1061.0
+        self.assertEqual(breaker.retry_after(host), 0)
+        self.assertEqual(breaker.retry_after(host), 60)
+        breaker.record_success(host)
+        self.assertEqual(breaker.retry_after(host), 0)
+        self.assertEqual(breaker.retry_after('http://other'), 0)
+
+    @mock.patch('pacifica.notifications.breaker.time')
+    def test_one_probe(self, mock_time):
+        """Test only one of the breakers sharing a store sends the probe."""
+        mock_time.return_value = 1000.0
+        store = MemoryStore()
+        breakers = [CircuitBreaker(store, failure_threshold=2, reset_timeout=60) for _index in range(3)]
+        breakers[0].record_failure('http://example.com')
+        breakers[1].record_failure('http://example.com')
+        mock_time.return_value = 1010.0
+        breakers[2].record_failure('http://example.com')
+        self.assertEqual(store.get('breaker:http://example.com:failures'), 3)
+        self.assertEqual(breakers[2].retry_after('http://example.com'), 50)
+        mock_time.return_value = 1061.0
+        self.assertEqual([breaker.retry_after('http://example.com') for breaker in breakers], [0, 60, 60])
+        mock_time.return_value = 1091.0
+        self.assertEqual(breakers[0].retry_after('http://example.com'), 30)
+
+    def test_store_incr(self):
+        """Test incr counts from a missing or expired key."""
+        store = MemoryStore()
+        self.assertEqual(store.incr('key'), 1)
+        self.assertEqual(store.incr('key'), 2)
+        store.set('key', 5, -1)
+        self.assertEqual(store.incr('key'), 1)
+
+    def test_backoff_delay(self):
+        """Test the delay is jittered below the capped exponential."""
+        for attempt in range(10):
+            delay = backoff_delay(attempt, 10, 300)
+            self.assertTrue(0 <= delay <= min(300, 10 * 2 ** attempt))
+
+
+@mock.patch.dict(os.environ, {'RETRY_MAX_ATTEMPTS': '3', 'RETRY_BACKOFF': '10', 'RETRY_BACKOFF_MAX': '3600'})
+@mock.patch('pacifica.notifications.tasks.update_log_match')
+@mock.patch('pacifica.notifications.tasks.disable_eventmatch')
+@mock.patch('pacifica.notifications.tasks.SESSIONS')
+class TestRouteEventRetry(TestCase):
+    """Test route_event retries before disabling."""
+
+    eventmatch = {'uuid': 'a-uuid', 'target_url': 'http://example.com/', 'extensions': {}, 'auth': {}}
+
+    def setUp(self):
+        """Use a fresh breaker and capture the redeliveries."""
+        self.breaker = CircuitBreaker(MemoryStore(), failure_threshold=2, reset_timeout=60)
+        for patcher in [
+                mock.patch.object(tasks, 'BREAKER', self.breaker),
+                mock.patch(
+                    'pacifica.notifications.claimcheck.ACTIVE_SUBSCRIPTIONS', active_subscriptions(self.eventmatch)
+                ),
+                mock.patch.object(tasks, 'DELIVERY_ENGINE', None),
+                mock.patch.object(tasks.route_event, 'apply_async')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_retry_then_disable(self, mock_sessions, disable_eventmatch, update_log_match):
+        """Test a failing target is retried then disabled."""
+        mock_sessions.post.return_value = PolicyDecision(500, 'broken')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid')
+        args, kwargs, countdown = self._redelivery()
+        self.assertEqual(kwargs, {'attempt': 1})
+        self.assertTrue(0 <= countdown <= 20)
+        tasks.route_event(*args, **kwargs)
+        args, kwargs, countdown = self._redelivery()
+        self.assertEqual(kwargs, {'attempt': 2})
+        self.assertFalse(disable_eventmatch.called)
+        self.breaker.record_success('http://example.com')
+        tasks.route_event(*args, **kwargs)
+        disable_eventmatch.assert_called_once_with('a-uuid', 'broken')
+        self.assertEqual(update_log_match.call_count, 3)
+        self.assertEqual(tasks.route_event.apply_async.call_count, 2)
+
+    def test_held_while_open(self, mock_sessions, disable_eventmatch, _update_log_match):
+        """Test deliveries are held while the breaker is open."""
+        mock_sessions.post.side_effect = RequestsConnectionError('refused')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid', attempt=1)
+        self.assertEqual(mock_sessions.post.call_count, 2)
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid', attempt=1)
+        self.assertEqual(mock_sessions.post.call_count, 2)
+        _args, kwargs, countdown = self._redelivery()
+        self.assertEqual(kwargs, {'attempt': 1, 'reserved': True})
+        self.assertTrue(60 <= countdown <= 61)
+        self.assertFalse(disable_eventmatch.called)
+
+    def test_success(self, mock_sessions, disable_eventmatch, update_log_match):
+        """Test a successful delivery is logged and closes the breaker."""
+        self.breaker.record_failure('http://example.com')
+        mock_sessions.post.return_value = PolicyDecision(200, 'ok')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid')
+        self.assertEqual(update_log_match.call_count, 1)
+        self.assertFalse(disable_eventmatch.called)
+        self.assertFalse(tasks.route_event.apply_async.called)
+        self.assertEqual(self.breaker.store.get('breaker:http://example.com:failures'), None)
+
+    @staticmethod
+    def _redelivery():
+        """Return the args, kwargs and countdown of the last redelivery."""
+        call_args = tasks.route_event.apply_async.call_args
+        return call_args[0][0], call_args[0][1], call_args[1]['countdown']
+
+
+@mock.patch.dict(os.environ, {'RETRY_MAX_ATTEMPTS': '2'})
+@mock.patch('pacifica.notifications.tasks.disable_eventmatch')
+@mock.patch('pacifica.notifications.tasks.create_log_match')
+@mock.patch('pacifica.notifications.tasks.policy_decision')
+class TestQueryPolicyRetry(TestCase):
+    """Test the policy query retries before disabling."""
+
+    eventmatch = {'uuid': 'a-uuid', 'user': 'dmlb2001'}
+
+    def setUp(self):
+        """Keep the eventmatch active."""
+        patcher = mock.patch(
+            'pacifica.notifications.claimcheck.ACTIVE_SUBSCRIPTIONS', active_subscriptions(self.eventmatch)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(tasks.query_user_policy, 'apply_async')
+    def test_retry_then_disable(self, apply_async, policy_decision, create_log_match, disable_eventmatch):
+        """Test a policy server 5xx is retried then the eventmatches disabled."""
+        policy_decision.return_value = PolicyDecision(503, 'unavailable')
+        tasks.query_user_policy([self.eventmatch], {}, 'log-uuid')
+        self.assertEqual(apply_async.call_args[0][1], {'attempt': 1, 'fanout': False})
+        self.assertFalse(disable_eventmatch.called)
+        tasks.query_user_policy([self.eventmatch], {}, 'log-uuid', attempt=1)
+        self.assertEqual(apply_async.call_count, 1)
+        disable_eventmatch.assert_called_once_with('a-uuid', 'unavailable')
+        self.assertEqual(create_log_match.call_args[0][2].status_code, 503)
+
+    @mock.patch.object(tasks.query_user_policy, 'apply_async')
+    def test_unreachable_not_disabled(self, apply_async, policy_decision, create_log_match, disable_eventmatch):
+        """Test an unreachable policy server is retried then the task fails without disabling."""
+        policy_decision.side_effect = RequestsConnectionError('refused')
+        tasks.query_user_policy([self.eventmatch], {}, 'log-uuid')
+        self.assertEqual(apply_async.call_args[0][1], {'attempt': 1, 'fanout': False})
+        with self.assertRaises(RequestsConnectionError):
+            tasks.query_user_policy([self.eventmatch], {}, 'log-uuid', attempt=1)
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertFalse(disable_eventmatch.called)
+        self.assertFalse(create_log_match.called)
+
+
+@mock.patch.dict(os.environ, {'RETRY_MAX_ATTEMPTS': '2'})
+@mock.patch('pacifica.notifications.tasks.update_log_match')
+@mock.patch('pacifica.notifications.tasks.SESSIONS')
+class TestRetryInactive(TestCase):
+    """Test retries aren't sent for subscriptions no longer active."""
+
+    def setUp(self):
+        """Use a fresh breaker and snapshot and capture the redeliveries."""
+        for patcher in [
+                mock.patch.object(tasks, 'BREAKER', CircuitBreaker(MemoryStore())),
+                mock.patch('pacifica.notifications.claimcheck.ACTIVE_SUBSCRIPTIONS', ActiveSubscriptions(0)),
+                mock.patch.object(tasks, 'DELIVERY_ENGINE', None),
+                mock.patch.object(tasks.route_event, 'apply_async')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _create_eventmatch():
+        """Create an active eventmatch."""
+        with EventMatch.atomic():
+            eventmatch = EventMatch.create(
+                name='retried', jsonpath='$', user='dmlb2001', target_url='http://example.com/'
+            )
+            NotificationSystem.bump_generation()
+        return eventmatch
+
+    @eventmatch_droptables
+    def test_deleted_between_attempts(self, mock_sessions, _update_log_match):
+        """Test the retry of a subscription deleted since is dropped."""
+        mock_sessions.post.return_value = PolicyDecision(500, 'broken')
+        eventmatch = self._create_eventmatch()
+        tasks.route_event(eventmatch.to_hash(), {}, 'elm-uuid')
+        args, kwargs = tasks.route_event.apply_async.call_args[0]
+        with EventMatch.atomic():
+            eventmatch.deleted = datetime.now()
+            eventmatch.save()
+            NotificationSystem.bump_generation()
+        tasks.route_event(*args, **kwargs)
+        self.assertEqual(mock_sessions.post.call_count, 1)
+        self.assertEqual(tasks.route_event.apply_async.call_count, 1)
+        self.assertEqual(EventMatch.get_by_id(eventmatch.uuid).disabled, None)
+
+    @eventmatch_droptables
+    def test_disable_kept(self, mock_sessions, _update_log_match):
+        """Test a stale retry doesn't disable a subscription again."""
+        mock_sessions.post.return_value = PolicyDecision(500, 'broken')
+        eventmatch = self._create_eventmatch()
+        tasks.route_event(eventmatch.to_hash(), {}, 'elm-uuid', attempt=1)
+        disabled = EventMatch.get_by_id(eventmatch.uuid)
+        self.assertEqual(disabled.error, 'broken')
+        tasks.disable_eventmatch(str(eventmatch.uuid), 'stale')
+        self.assertEqual(EventMatch.get_by_id(eventmatch.uuid).error, 'broken')
+        self.assertEqual(EventMatch.get_by_id(eventmatch.uuid).disabled, disabled.disabled)
+        mock_sessions.post.reset_mock()
+        tasks.route_event(eventmatch.to_hash(), {}, 'elm-uuid', attempt=1)
+        self.assertFalse(mock_sessions.post.called)
+
+    @eventmatch_droptables
+    @mock.patch.object(tasks.query_user_policy, 'apply_async')
+    @mock.patch('pacifica.notifications.tasks.policy_decision')
+    def test_policy_retry_dropped(self, policy_decision, apply_async, _mock_sessions, _update_log_match):
+        """Test a policy retry for a deleted subscription is dropped."""
+        eventmatch = self._create_eventmatch()
+        with EventMatch.atomic():
+            eventmatch.deleted = datetime.now()
+            eventmatch.save()
+            NotificationSystem.bump_generation()
+        tasks.query_user_policy([eventmatch.to_hash()], {}, 'log-uuid', attempt=1)
+        self.assertFalse(policy_decision.called)
+        self.assertFalse(apply_async.called)
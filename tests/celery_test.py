@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Test the example module."""
+import os
 from argparse import Namespace
 from os.path import join, dirname
 from datetime import datetime
@@ -8,6 +9,7 @@ from time import sleep
 from json import loads, dumps
 import requests
 from cherrypy.test import helper
+import mock
 from pacifica.notifications.orm import EventMatch, EventLog
 from pacifica.notifications.__main__ import _eventretry
 from .common_test import NotificationsCPTest, eventmatch_droptables
@@ -17,8 +19,9 @@ class CeleryCPTest(NotificationsCPTest, helper.CPWebCase):
     """Test the EventMatch class."""
 
     @eventmatch_droptables
+    @mock.patch.dict(os.environ, {'RETRY_BACKOFF': '0.1'})
     def test_bad_url(self):
-        """Test the create POST method in EventMatch."""
+        """Test the failed policy queries and deliveries are retried then the eventmatches disabled."""
         uuid_list = []
         resp = self._create_eventmatch(
             headers={'Http-Remote-User': 'doesnotexist'}
@@ -54,8 +57,9 @@ class CeleryCPTest(NotificationsCPTest, helper.CPWebCase):
             self.assertEqual(eventmatch_obj.disabled.year, datetime.now().year)
 
     @eventmatch_droptables
+    @mock.patch.dict(os.environ, {'RETRY_BACKOFF': '0.1'})
     def test_bad_connection(self):
-        """Test the create POST method in EventMatch."""
+        """Test the refused deliveries are retried then the eventmatch disabled."""
         resp = self._create_eventmatch(
             headers={'Http-Remote-User': 'dmlb2001'},
             json_data={
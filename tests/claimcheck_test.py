@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the claim check of events passed between the tasks."""
+import os
+from json import loads
+from unittest import TestCase
+from uuid import uuid4
+import mock
+from pacifica.notifications.breaker import CircuitBreaker
+from pacifica.notifications.claimcheck import EventCache, claim_event, claim_eventmatches
+from pacifica.notifications.orm import EventMatch, EventLog, NotificationSystem
+from pacifica.notifications.store import MemoryStore
+from pacifica.notifications import tasks
+from .common_test import eventmatch_droptables
+
+
+def _create_eventmatch():
+    """Create an eventmatch on data and bump the generation."""
+    with EventMatch.atomic():
+        eventmatch = EventMatch.create(
+            name='first', jsonpath='$.data', user='dmlb2001', target_url='http://127.0.0.1:8080',
+            extensions='{"subscription": "ext"}', auth='{}'
+        )
+        NotificationSystem.bump_generation()
+    return eventmatch
+
+
+class TestEventCache(TestCase):
+    """Test the events are loaded once per process."""
+
+    @eventmatch_droptables
+    def test_load_once(self):
+        """Test the event log is read once and evicted past maxsize."""
+        event_logs = [EventLog.create(**EventLog.encode({'data': index})) for index in range(3)]
+        cache = EventCache(2)
+        with mock.patch.object(EventLog, 'get_by_id', wraps=EventLog.get_by_id) as get_by_id:
+            for event_log in event_logs[:2] + event_logs[:2]:
+                self.assertEqual(cache.load(str(event_log.uuid)), event_log.event_obj())
+            self.assertEqual(get_by_id.call_count, 2)
+            cache.load(str(event_logs[2].uuid))
+            cache.load(str(event_logs[0].uuid))
+            self.assertEqual(get_by_id.call_count, 4)
+
+    @eventmatch_droptables
+    def test_claim(self):
+        """Test tickets are claimed and events and hashes are kept."""
+        eventmatch = _create_eventmatch()
+        event_log = EventLog.create(**EventLog.encode({'data': 1}))
+        self.assertEqual(claim_event(str(event_log.uuid)), {'data': 1})
+        self.assertEqual(claim_event({'data': 2}), {'data': 2})
+        self.assertEqual([sub['name'] for sub in claim_eventmatches([str(eventmatch.uuid), 'gone'])], ['first'])
+        self.assertEqual(claim_eventmatches([{'uuid': 'hash'}]), [{'uuid': 'hash'}])
+
+
+class TestClaimCheckTasks(TestCase):
+    """Test the task messages carry tickets end to end."""
+
+    @eventmatch_droptables
+    @mock.patch.dict(os.environ, {'CLAIM_CHECK': 'True', 'RETRY_MAX_ATTEMPTS': '2'})
+    @mock.patch('pacifica.notifications.tasks.BREAKER', CircuitBreaker(MemoryStore()))
+    @mock.patch('pacifica.notifications.tasks.SESSIONS')
+    @mock.patch('pacifica.notifications.tasks.route_event.apply_async')
+    @mock.patch('pacifica.notifications.tasks.route_event.delay')
+    @mock.patch('pacifica.notifications.tasks.query_user_policy.delay')
+    def test_tickets(self, query_delay, route_delay, route_retry, sessions):
+        """Test only uuids are queued and the target gets the merged event."""
+        eventmatch = _create_eventmatch()
+        event_uuid = str(uuid4())
+        event_obj = {'data': 'x' * 1000, 'extensions': {'event': 'ext'}}
+        tasks.dispatch_events([(event_uuid, event_obj)])
+        query_delay.assert_called_once_with([str(eventmatch.uuid)], event_uuid, event_uuid)
+        sessions.post.return_value = mock.Mock(status_code=200, text='{"status": "OK"}')
+        tasks.query_user_policy(*query_delay.call_args[0])
+        self.assertEqual(loads(sessions.post.call_args[1]['data']), event_obj)
+        route_args = route_delay.call_args[0]
+        self.assertEqual(route_args[:2], (str(eventmatch.uuid), event_uuid))
+        sessions.post.return_value = mock.Mock(status_code=500, text='down')
+        tasks.route_event(*route_args)
+        self.assertEqual(
+            loads(sessions.post.call_args[1]['data'])['extensions'], {'event': 'ext', 'subscription': 'ext'}
+        )
+        self.assertEqual(route_retry.call_args[0][0], route_args)
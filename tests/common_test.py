@@ -6,24 +6,32 @@ from time import sleep
 import threading
 import requests
 import cherrypy
+import mock
 from celery.bin.celery import main as celery_main
 from pacifica.notifications.orm import EventMatch, EventLogMatch, EventLog, NotificationSystem, DB
 from pacifica.notifications.rest import Root, error_page_default
+from pacifica.notifications.subscriptions import ACTIVE_SUBSCRIPTIONS
 from pacifica.notifications.globals import CHERRYPY_CONFIG
 
 
+def active_subscriptions(*eventmatches):
+    """Return a mock active subscriptions snapshot holding the eventmatches."""
+    return mock.Mock(lookup=lambda uuids: [eventmatch for eventmatch in eventmatches if eventmatch['uuid'] in uuids])
+
+
 def eventmatch_droptables(func):
     """Setup the database and drop it once done."""
     def wrapper(*args, **kwargs):
         """Create the database table."""
-        for orm_obj in [EventLogMatch, EventMatch, EventLog]:
+        for orm_obj in [EventLogMatch, EventMatch, EventLog, NotificationSystem]:
             orm_obj.database_connect()
             if orm_obj.table_exists():
                 orm_obj.drop_table()
-        for orm_obj in [EventLog, EventMatch, EventLogMatch]:
+        for orm_obj in [NotificationSystem, EventLog, EventMatch, EventLogMatch]:
             orm_obj.create_table()
+        ACTIVE_SUBSCRIPTIONS.invalidate()
         func(*args, **kwargs)
-        for orm_obj in [EventLogMatch, EventMatch, EventLog]:
+        for orm_obj in [EventLogMatch, EventMatch, EventLog, NotificationSystem]:
             orm_obj.drop_table()
     return wrapper
 
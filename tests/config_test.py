@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the cached configuration."""
+import os
+import signal
+from time import sleep
+from tempfile import NamedTemporaryFile
+from unittest import TestCase
+import mock
+from pacifica.notifications.config import get_config, invalidate_config, install_sighup_handler
+
+
+class TestConfig(TestCase):
+    """Test the cached configuration."""
+
+    def setUp(self):
+        """Create a configuration file to use."""
+        # pylint: disable=consider-using-with
+        self.config_file = NamedTemporaryFile('w', suffix='.ini', delete=False)
+        self.config_file.write('[notifications]\npolicy_url = http://example.com\n')
+        self.config_file.close()
+        patcher = mock.patch('pacifica.notifications.config.CONFIG_FILE', self.config_file.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        invalidate_config()
+
+    def tearDown(self):
+        """Remove the configuration file."""
+        os.unlink(self.config_file.name)
+        invalidate_config()
+
+    def test_cached(self):
+        """Test the configuration is only read once."""
+        config = get_config()
+        self.assertEqual(config.get('notifications', 'policy_url'), 'http://example.com')
+        self.assertTrue(get_config() is config)
+        invalidate_config()
+        self.assertFalse(get_config() is config)
+
+    def test_file_changed(self):
+        """Test the configuration is read again when the file changes."""
+        config = get_config()
+        sleep(0.01)
+        with open(self.config_file.name, 'w') as config_fd:
+            config_fd.write('[notifications]\npolicy_url = http://example.com:8181\n')
+        self.assertFalse(get_config() is config)
+        self.assertEqual(get_config().get('notifications', 'policy_url'), 'http://example.com:8181')
+
+    def test_environment(self):
+        """Test environment overrides still apply."""
+        config = get_config()
+        with mock.patch.dict(os.environ, {'DATABASE_CONNECT_WAIT': '2', 'DEFAULT_USER': 'someone'}):
+            self.assertEqual(get_config().getint('database', 'connect_wait'), 2)
+            self.assertEqual(get_config().get('DEFAULT', 'default_user'), 'someone')
+        self.assertEqual(get_config().getint('database', 'connect_wait'), config.getint('database', 'connect_wait'))
+
+    def test_sighup(self):
+        """Test SIGHUP invalidates the configuration."""
+        previous = signal.getsignal(signal.SIGHUP)
+        previous_handler = mock.Mock()
+        signal.signal(signal.SIGHUP, previous_handler)
+        try:
+            install_sighup_handler()
+            config = get_config()
+            os.kill(os.getpid(), signal.SIGHUP)
+            self.assertFalse(get_config() is config)
+            self.assertEqual(previous_handler.call_count, 1)
+        finally:
+            signal.signal(signal.SIGHUP, previous)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the deduplication of received events."""
+from datetime import datetime, timedelta
+from unittest import TestCase
+from uuid import uuid4
+import mock
+from playhouse.migrate import SchemaMigrator, migrate
+from pacifica.notifications.dedup import Deduplicator, dedup_key
+from pacifica.notifications.orm import DB, EventLog, OrmSync
+from pacifica.notifications.rest import ReceiveEvent
+from pacifica.notifications.store import MemoryStore
+from pacifica.notifications.tasks import dispatch_events
+from .common_test import eventmatch_droptables
+
+
+class TestDedupKey(TestCase):
+    """Test the dedup keys."""
+
+    def test_id_mode(self):
+        """Test the id mode keys on the id and source only."""
+        event_obj = {'id': '1', 'source': '/a', 'data': 1}
+        self.assertEqual(dedup_key(event_obj), dedup_key(dict(event_obj, data=2)))
+        self.assertNotEqual(dedup_key(event_obj), dedup_key(dict(event_obj, source='/b')))
+        self.assertEqual(dedup_key({'data': 1}), dedup_key({'data': 1}, 'hash'))
+
+    def test_hash_mode(self):
+        """Test the hash mode ignores key order but not content."""
+        self.assertEqual(dedup_key({'a': 1, 'b': [1, 2]}, 'hash'), dedup_key({'b': [1, 2], 'a': 1}, 'hash'))
+        self.assertNotEqual(dedup_key({'a': 1, 'b': [1, 2]}, 'hash'), dedup_key({'a': 1, 'b': [2, 1]}, 'hash'))
+
+    def test_unknown_mode(self):
+        """Test an unknown mode is an error."""
+        with self.assertRaises(ValueError):
+            Deduplicator(MemoryStore(), mode='name')
+
+    def test_store_add(self):
+        """Test add only sets missing or expired keys."""
+        store = MemoryStore()
+        self.assertTrue(store.add('key', 1, 60))
+        self.assertFalse(store.add('key', 2, 60))
+        self.assertEqual(store.get('key'), 1)
+        store.set('key', 1, -1)
+        self.assertTrue(store.add('key', 3))
+
+
+class TestDeduplicator(TestCase):
+    """Test the claims against the store and the event log."""
+
+    @eventmatch_droptables
+    def test_claim(self):
+        """Test duplicates in the batch, the store and the event log."""
+        dedup = Deduplicator(MemoryStore(), 60)
+        logged = [
+            ({'id': 'logged', 'source': '/a'}, datetime.now()),
+            ({'id': 'old', 'source': '/a'}, datetime.now() - timedelta(hours=1))
+        ]
+        logged_uuids = [str(uuid4()) for _index in logged]
+        for event_log_uuid, (event_obj, created) in zip(logged_uuids, logged):
+            EventLog.create(
+                uuid=event_log_uuid, created=created, dedup_key=dedup.key(event_obj), **EventLog.encode(event_obj)
+            )
+        events = [{'id': name, 'source': '/a'} for name in ['new', 'logged', 'old', 'new']]
+        uuids = [str(uuid4()) for _index in events]
+        originals = dedup.claim(uuids, [dedup.key(event_obj) for event_obj in events])
+        self.assertEqual(originals, [None, logged_uuids[0], None, uuids[0]])
+        self.assertEqual(dedup.claim([str(uuid4())], [dedup.key(events[0])]), [uuids[0]])
+        dedup.release([dedup.key(events[0])])
+        self.assertEqual(dedup.claim([uuids[1]], [dedup.key(events[0])]), [None])
+
+    @eventmatch_droptables
+    @mock.patch('pacifica.notifications.tasks.queue_matches')
+    def test_receive(self, queue_matches):
+        """Test a duplicate is not dispatched and returns the original event log."""
+        dedup = Deduplicator(MemoryStore(), 60, 'hash')
+        with mock.patch('pacifica.notifications.rest.DEDUP', dedup), \
+                mock.patch('pacifica.notifications.rest.dispatch_events') as mock_dispatch:
+            mock_dispatch.delay.side_effect = lambda *args: dispatch_events(*args) or 'task-1'
+            first = ReceiveEvent._batch([{'a': 1}, {'a': 2}])
+            dedup.store.clear()
+            second = ReceiveEvent._batch([{'a': 2}, {'a': 3}])
+        self.assertEqual(mock_dispatch.delay.call_count, 2)
+        self.assertEqual(second[0], {'event_log': first[1]['event_log'], 'duplicate': True})
+        self.assertEqual(second[1]['task_id'], 'task-1')
+        self.assertEqual(EventLog.select().count(), 3)
+        self.assertEqual(queue_matches.call_count, 3)
+        mock_dispatch.delay.side_effect = RuntimeError('broker down')
+        with mock.patch('pacifica.notifications.rest.DEDUP', dedup), \
+                mock.patch('pacifica.notifications.rest.dispatch_events', mock_dispatch):
+            with self.assertRaises(RuntimeError):
+                ReceiveEvent._batch([{'a': 4}])
+        self.assertEqual(dedup.claim(['x'], [dedup.key({'a': 4})]), [None])
+
+    @eventmatch_droptables
+    def test_update_3_2_to_3_3(self):
+        """Test the dedup key column is added to an existing eventlog table."""
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(migrator.drop_index('eventlog', 'eventlog_dedup_key'), migrator.drop_column('eventlog', 'dedup_key'))
+        DB.execute_sql(
+            'INSERT INTO eventlog (uuid, jsondata, codec, created) VALUES (?, ?, ?, ?)',
+            (str(uuid4()), '{}', 'json', '2020-01-01')
+        )
+        OrmSync.update_3_2_to_3_3()
+        self.assertEqual(EventLog.get().dedup_key, None)
+        self.assertTrue('eventlog_dedup_key' in [index.name for index in DB.get_indexes('eventlog')])
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the asyncio delivery engine against local servers."""
+import os
+from unittest import TestCase
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from json import loads
+from threading import Lock, Thread
+from time import sleep
+import mock
+from pacifica.notifications import delivery, tasks
+from pacifica.notifications.breaker import CircuitBreaker
+from pacifica.notifications.delivery import DeliveryEngine, TargetRequest
+from pacifica.notifications.store import MemoryStore
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serve each request in a thread."""
+
+    daemon_threads = True
+
+
+class TargetHandler(BaseHTTPRequestHandler):
+    """Record the posts and the concurrent requests of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Record the post, wait a bit and respond with the status in the path."""
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.posts.append((dict(self.headers), loads(body.decode('utf8'))))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        status = int(self.path.strip('/') or 200)
+        self.send_response(status)
+        self.send_header('Set-Cookie', 'sid={}-session; Path=/'.format(len(server.posts)))
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    # pylint: enable=invalid-name
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        """Don't log the requests."""
+
+
+def _start_server(delay=0.0):
+    """Start a target server in a thread."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TargetHandler)
+    server.lock = Lock()
+    server.posts = []
+    server.active = 0
+    server.max_active = 0
+    server.delay = delay
+    Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    return server
+
+
+class TestDeliveryEngine(TestCase):
+    """Test the concurrency limits of the engine."""
+
+    def setUp(self):
+        """Start two slow target servers."""
+        self.servers = [_start_server(0.2), _start_server(0.2)]
+
+    def tearDown(self):
+        """Stop the servers."""
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_per_host_limit(self):
+        """Test no more than max_per_host posts run against one host."""
+        engine = DeliveryEngine(max_in_flight=10, max_per_host=2)
+        futures = [engine.submit(TargetRequest(self.servers[0].url, '{}', {})) for _index in range(6)]
+        for future in futures:
+            resp, error = future.result(10)
+            self.assertEqual((resp.status_code, resp.text, error), (200, 'ok', None))
+        engine.close()
+        self.assertEqual(self.servers[0].max_active, 2)
+
+    def test_global_limit(self):
+        """Test no more than max_in_flight posts run in total."""
+        engine = DeliveryEngine(max_in_flight=3, max_per_host=3)
+        callback = mock.Mock()
+        for _index in range(4):
+            for server in self.servers:
+                engine.submit(TargetRequest(server.url, '{}', {}), callback=callback)
+        self.assertTrue(engine.in_flight() > 0)
+        engine.close()
+        self.assertEqual(callback.call_count, 8)
+        self.assertEqual(engine.in_flight(), 0)
+        self.assertTrue(self.servers[0].max_active + self.servers[1].max_active <= 6)
+        self.assertTrue(max(server.max_active for server in self.servers) <= 3)
+
+    def test_no_cookies(self):
+        """Test the cookies set in response to one post aren't sent with the next."""
+        # aiohttp never keeps the cookies of an IP address
+        url = self.servers[0].url.replace('127.0.0.1', 'localhost')
+        for module in [delivery.aiohttp, None]:
+            with mock.patch.object(delivery, 'aiohttp', module):
+                engine = DeliveryEngine()
+                for _index in range(2):
+                    resp, error = engine.submit(TargetRequest(url, '{}', {})).result(10)
+                    self.assertEqual((resp.status_code, error), (200, None))
+                engine.close()
+        self.assertEqual(len(self.servers[0].posts), 4)
+        self.assertEqual([headers.get('Cookie') for headers, _body in self.servers[0].posts], [None] * 4)
+
+    def test_connection_error(self):
+        """Test a refused connection is reported as an error."""
+        engine = DeliveryEngine()
+        server = _start_server()
+        url = server.url
+        server.shutdown()
+        server.server_close()
+        resp, error = engine.submit(TargetRequest(url, '{}', {})).result(10)
+        engine.close()
+        self.assertEqual(resp, None)
+        self.assertTrue(error)
+
+
+class TestDeliveryErrors(TestCase):
+    """Test unexpected errors still run the callback and are logged."""
+
+    @mock.patch('pacifica.notifications.delivery.aiohttp', None)
+    @mock.patch('pacifica.notifications.delivery.SESSIONS')
+    def test_post_raises(self, mock_sessions):
+        """Test the callback gets the error when the post raises."""
+        mock_sessions.post.side_effect = RuntimeError('boom')
+        engine = DeliveryEngine()
+        callback = mock.Mock()
+        with self.assertLogs('pacifica.notifications.delivery', 'ERROR'):
+            future = engine.submit(TargetRequest('http://127.0.0.1:1/', '{}', {}), callback)
+            engine.close()
+        self.assertTrue(isinstance(future.exception(), RuntimeError))
+        resp, error = callback.call_args[0]
+        self.assertEqual(resp, None)
+        self.assertTrue('boom' in error)
+
+    def test_callback_raises(self):
+        """Test an error raised by the callback is logged."""
+        server = _start_server()
+        engine = DeliveryEngine()
+        with self.assertLogs('pacifica.notifications.delivery', 'ERROR') as logs:
+            engine.submit(TargetRequest(server.url, '{}', {}), mock.Mock(side_effect=ValueError('db down')))
+            engine.close()
+        server.shutdown()
+        server.server_close()
+        self.assertTrue('db down' in logs.output[0])
+
+
+class TestRouteEventEngine(TestCase):
+    """Test route_event keeps its semantics with the engine and no retries."""
+
+    eventmatch = {
+        'uuid': 'a-uuid',
+        'extensions': {'subscription': 'ext'},
+        'auth': {'type': 'basic', 'basic': {'username': 'user', 'password': 'pass'}},
+    }
+
+    def setUp(self):
+        """Start a target server and use an engine in the tasks."""
+        self.server = _start_server()
+        self.engine = DeliveryEngine()
+        for patcher in [
+                mock.patch.object(tasks, 'DELIVERY_ENGINE', self.engine),
+                mock.patch.object(tasks, 'BREAKER', CircuitBreaker(MemoryStore())),
+                mock.patch.dict(os.environ, {'RETRY_MAX_ATTEMPTS': '1'})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _route(self, target_url):
+        """Route an event to target_url and wait for the delivery."""
+        eventmatch = dict(self.eventmatch, target_url=target_url)
+        event_obj = {'data': 1, 'extensions': {'event': 'ext'}}
+        tasks.route_event(eventmatch, event_obj, 'elm-uuid')
+        self.engine.close()
+        self.assertEqual(event_obj, {'data': 1, 'extensions': {'event': 'ext'}})
+
+    @mock.patch('pacifica.notifications.tasks.disable_eventmatch')
+    @mock.patch('pacifica.notifications.tasks.update_log_match')
+    def test_route_ok(self, update_log_match, disable_eventmatch):
+        """Test the event is merged, authenticated and logged."""
+        self._route(self.server.url)
+        headers, body = self.server.posts[0]
+        self.assertEqual(body['extensions'], {'event': 'ext', 'subscription': 'ext'})
+        self.assertTrue(headers['Authorization'].startswith('Basic '))
+        self.assertEqual(update_log_match.call_args[0][0], 'elm-uuid')
+        self.assertEqual(update_log_match.call_args[0][1].status_code, 200)
+        self.assertFalse(disable_eventmatch.called)
+
+    @mock.patch('pacifica.notifications.tasks.disable_eventmatch')
+    @mock.patch('pacifica.notifications.tasks.update_log_match')
+    def test_route_failure(self, update_log_match, disable_eventmatch):
+        """Test a failed target disables the eventmatch and is logged."""
+        self._route(self.server.url + '500')
+        disable_eventmatch.assert_called_once_with('a-uuid', 'ok')
+        self.assertEqual(update_log_match.call_args[0][1].status_code, 500)
+
+    @mock.patch('pacifica.notifications.tasks.disable_eventmatch')
+    @mock.patch('pacifica.notifications.tasks.update_log_match')
+    def test_route_error(self, update_log_match, disable_eventmatch):
+        """Test a connection error disables the eventmatch."""
+        self._route('http://127.0.0.1:1/')
+        self.assertEqual(disable_eventmatch.call_args[0][0], 'a-uuid')
+        self.assertFalse(update_log_match.called)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the dispatch tasks without a broker."""
+import os
+from unittest import TestCase
+from uuid import uuid4
+import mock
+from pacifica.notifications.orm import EventMatch, EventLog, EventLogMatch, NotificationSystem
+from pacifica.notifications.tasks import dispatch_events, fanout_event, query_user_policy
+from .common_test import eventmatch_droptables
+
+
+class TestDispatchEvents(TestCase):
+    """Test the bulk dispatch task."""
+
+    @eventmatch_droptables
+    @mock.patch('pacifica.notifications.tasks.query_user_policy')
+    def test_dispatch_events(self, mock_query_policy):
+        """Test the events are logged and matched in one batch."""
+        with EventMatch.atomic():
+            eventmatch = EventMatch.create(
+                name='ingest', jsonpath='$[?(@.eventType = "ingest")]', user='dmlb2001',
+                target_url='http://127.0.0.1:8080'
+            )
+            NotificationSystem.bump_generation()
+        events = [
+            (str(uuid4()), {'eventType': 'ingest' if index % 2 else 'other', 'index': index})
+            for index in range(250)
+        ]
+        dispatch_events(events)
+        self.assertEqual(EventLog.select().count(), 250)
+        self.assertTrue(EventLog.get(EventLog.uuid == events[10][0]).created)
+        self.assertEqual(mock_query_policy.delay.call_count, 125)
+        first_call = mock_query_policy.delay.call_args_list[0][0]
+        self.assertEqual([(sub['uuid'], sub['user']) for sub in first_call[0]], [(str(eventmatch.uuid), 'dmlb2001')])
+        self.assertEqual(first_call[1:], (events[1][1], events[1][0]))
+
+    @eventmatch_droptables
+    @mock.patch('pacifica.notifications.tasks.query_user_policy')
+    def test_group_by_user(self, mock_query_policy):
+        """Test one policy query is queued per user for an event."""
+        with EventMatch.atomic():
+            for name, user in [('first', 'dmlb2001'), ('second', 'other'), ('third', 'dmlb2001')]:
+                EventMatch.create(name=name, jsonpath='$.data', user=user, target_url='http://127.0.0.1:8080')
+            NotificationSystem.bump_generation()
+        event_uuid = str(uuid4())
+        dispatch_events([(event_uuid, {'data': True})])
+        calls = sorted(
+            (args[0][0]['user'], sorted(sub['name'] for sub in args[0]))
+            for args, _kwargs in mock_query_policy.delay.call_args_list
+        )
+        self.assertEqual(calls, [('dmlb2001', ['first', 'third']), ('other', ['second'])])
+
+
+class TestQueryUserPolicy(TestCase):
+    """Test the per user policy query."""
+
+    @eventmatch_droptables
+    @mock.patch('pacifica.notifications.tasks.route_event')
+    @mock.patch('pacifica.notifications.tasks.SESSIONS.post')
+    def test_one_policy_request(self, mock_post, mock_route_event):
+        """Test one policy request is made and every subscription is logged and routed."""
+        mock_post.return_value = mock.Mock(status_code=200, text='{"status": "OK"}')
+        with EventMatch.atomic():
+            eventmatches = [
+                EventMatch.create(name=name, jsonpath='$.data', user='dmlb2001', target_url='http://127.0.0.1:8080')
+                for name in ['first', 'second', 'third']
+            ]
+        event_log = EventLog.create(jsondata='{"data": true}')
+        query_user_policy([eventmatch.to_hash() for eventmatch in eventmatches], {'data': True}, str(event_log.uuid))
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_route_event.delay.call_count, 3)
+        self.assertEqual(EventLogMatch.select().where(EventLogMatch.event_log == event_log.uuid).count(), 3)
+
+
+class TestEventFanout(TestCase):
+    """Test the one message per event fan-out."""
+
+    @staticmethod
+    def _create_eventmatches(names_users):
+        """Create the eventmatches and bump the generation."""
+        with EventMatch.atomic():
+            eventmatches = [
+                EventMatch.create(name=name, jsonpath='$.data', user=user, target_url='http://127.0.0.1:8080')
+                for name, user in names_users
+            ]
+            NotificationSystem.bump_generation()
+        return eventmatches
+
+    @eventmatch_droptables
+    @mock.patch.dict(os.environ, {'DISPATCH_FANOUT': 'event'})
+    @mock.patch('pacifica.notifications.tasks.query_user_policy')
+    @mock.patch('pacifica.notifications.tasks.fanout_event')
+    def test_one_message_per_event(self, mock_fanout_event, mock_query_policy):
+        """Test one message carrying the uuids is sent per matching event."""
+        eventmatches = self._create_eventmatches([('first', 'dmlb2001'), ('second', 'other'), ('third', 'dmlb2001')])
+        events = [(str(uuid4()), {'data': True}), (str(uuid4()), {'other': True})]
+        dispatch_events(events)
+        self.assertFalse(mock_query_policy.delay.called)
+        mock_fanout_event.delay.assert_called_once_with(
+            {'data': True}, events[0][0], [str(eventmatch.uuid) for eventmatch in eventmatches]
+        )
+
+    @eventmatch_droptables
+    @mock.patch('pacifica.notifications.tasks.route_event')
+    @mock.patch('pacifica.notifications.tasks.SESSIONS.post')
+    def test_fanout_event(self, mock_post, mock_route_event):
+        """Test the worker queries the policy per user and routes in process."""
+        mock_post.return_value = mock.Mock(status_code=200, text='{"status": "OK"}')
+        eventmatches = self._create_eventmatches([('first', 'dmlb2001'), ('second', 'other'), ('third', 'dmlb2001')])
+        event_log = EventLog.create(jsondata='{"data": true}')
+        event_obj = {'data': True, 'extensions': {}}
+        fanout_event(event_obj, str(event_log.uuid), [str(eventmatch.uuid) for eventmatch in eventmatches] + ['gone'])
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertFalse(mock_route_event.delay.called)
+        self.assertEqual(mock_route_event.call_count, 3)
+        self.assertEqual(mock_route_event.call_args_list[0][0][1], event_obj)
+        self.assertEqual(EventLogMatch.select().where(EventLogMatch.event_log == event_log.uuid).count(), 3)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the eventget command output and queries."""
+from argparse import Namespace
+from datetime import datetime, timedelta
+from io import StringIO
+from json import loads
+from unittest import TestCase
+import mock
+from pacifica.notifications.orm import DB, EventLog, EventLogMatch, EventMatch, eventget
+from .common_test import eventmatch_droptables
+
+
+class TestEventGet(TestCase):
+    """Test eventget reads the events and matches in chunks."""
+
+    @staticmethod
+    def _create_events(count):
+        """Create count events each matching two eventmatches."""
+        eventmatches = [
+            EventMatch.create(name=name, jsonpath='$', user='dmlb2001', target_url='http://127.0.0.1:8080')
+            for name in ['first', 'second']
+        ]
+        start = datetime.now() - timedelta(hours=1)
+        event_logs = []
+        for index in range(count):
+            # every other pair of events share a created time to exercise the keyset
+            event_log = EventLog.create(
+                jsondata='{{"index": {}}}'.format(index), created=start + timedelta(seconds=index // 2)
+            )
+            for eventmatch in eventmatches:
+                EventLogMatch.create(
+                    event_log=event_log, event_match=eventmatch,
+                    policy_status_code='200', policy_resp_body='{}'
+                )
+            event_logs.append(event_log)
+        return eventmatches, event_logs
+
+    @staticmethod
+    def _args(**kwargs):
+        """Return the eventget arguments for the last day."""
+        args = {
+            'events': [], 'limit': 0, 'start': datetime.now() - timedelta(days=1), 'end': datetime.now(),
+            'output_format': 'text', 'chunk_size': 4
+        }
+        args.update(kwargs)
+        return Namespace(**args)
+
+    @staticmethod
+    def _eventget(args):
+        """Run eventget returning the output and the number of queries."""
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            with mock.patch.object(DB, 'execute_sql', wraps=DB.execute_sql) as execute_sql:
+                eventget(args)
+        return stdout.getvalue(), execute_sql.call_count
+
+    @eventmatch_droptables
+    def test_jsonl(self):
+        """Test every event is output once with its matches in two queries per chunk."""
+        eventmatches, _event_logs = self._create_events(10)
+        output, queries = self._eventget(self._args(output_format='jsonl'))
+        lines = [loads(line) for line in output.splitlines()]
+        self.assertEqual(sorted(line['event']['index'] for line in lines), list(range(10)))
+        self.assertEqual([line['event']['index'] // 2 for line in lines], [index // 2 for index in range(10)])
+        self.assertEqual(
+            sorted(match['event_match'] for match in lines[0]['matches']),
+            sorted(str(eventmatch.uuid) for eventmatch in eventmatches)
+        )
+        self.assertEqual(queries, 6)
+
+    @eventmatch_droptables
+    def test_text_limit(self):
+        """Test the limit stops the chunks and the text output."""
+        _eventmatches, event_logs = self._create_events(10)
+        output, queries = self._eventget(self._args(limit=5))
+        self.assertEqual(output.count('Event - '), 5)
+        self.assertEqual(output.count('    ELM '), 10)
+        for event_log in event_logs[:4]:
+            self.assertTrue('Event - {}'.format(event_log.uuid) in output)
+        self.assertEqual(queries, 4)
+
+    @eventmatch_droptables
+    def test_uuids(self):
+        """Test the events are picked by uuid."""
+        _eventmatches, event_logs = self._create_events(3)
+        output, _queries = self._eventget(self._args(events=[str(event_logs[1].uuid)], output_format='jsonl'))
+        self.assertEqual([loads(line)['uuid'] for line in output.splitlines()], [str(event_logs[1].uuid)])
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the compressed event log storage."""
+import os
+from argparse import Namespace
+from io import StringIO
+from json import loads
+from unittest import TestCase
+from uuid import uuid4
+import mock
+from playhouse.migrate import SchemaMigrator, migrate
+from pacifica.notifications.orm import DB, EventLog, OrmSync, eventget
+from pacifica.notifications.tasks import dispatch_events, dispatch_orm_event
+from .common_test import eventmatch_droptables
+
+
+class TestEventLogCodec(TestCase):
+    """Test the event log codecs."""
+
+    event_obj = {'data': [{'name': 'file-{}.txt'.format(index), 'size': index} for index in range(100)], 'text': u'é'}
+
+    def test_round_trip(self):
+        """Test every codec decodes what it encoded."""
+        for codec in ['json', 'zlib', 'lzma']:
+            fields = EventLog.encode(self.event_obj, codec)
+            self.assertEqual(fields['codec'], codec)
+            self.assertEqual(EventLog(**fields).event_obj(), self.event_obj)
+        compressed = EventLog.encode(self.event_obj, 'zlib')['payload']
+        self.assertTrue(len(compressed) < len(EventLog.encode(self.event_obj, 'json')['jsondata']))
+
+    def test_unknown_codec(self):
+        """Test an unknown codec is an error."""
+        with self.assertRaises(ValueError):
+            EventLog.encode(self.event_obj, 'rot13')
+
+    @eventmatch_droptables
+    @mock.patch.dict(os.environ, {'EVENT_CODEC': 'zlib'})
+    @mock.patch('pacifica.notifications.tasks.queue_matches')
+    def test_dispatch_compressed(self, queue_matches):
+        """Test events are stored compressed and read back by dispatch and eventget."""
+        event_uuid = str(uuid4())
+        dispatch_events([(event_uuid, self.event_obj)])
+        event_log = EventLog.get_by_id(event_uuid)
+        self.assertEqual((event_log.codec, event_log.jsondata), ('zlib', ''))
+        dispatch_orm_event(event_log)
+        self.assertEqual(queue_matches.call_args[0][0], self.event_obj)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            eventget(Namespace(events=[event_uuid], output_format='jsonl', chunk_size=10))
+        self.assertEqual(loads(stdout.getvalue())['event'], self.event_obj)
+
+    @eventmatch_droptables
+    def test_update_3_1_to_3_2(self):
+        """Test the columns are added to an existing eventlog table with json rows."""
+        migrate(*[SchemaMigrator.from_database(DB).drop_column('eventlog', column) for column in ['codec', 'payload']])
+        DB.execute_sql(
+            'INSERT INTO eventlog (uuid, jsondata, created) VALUES (?, ?, ?)',
+            (str(uuid4()), '{"old": 1}', '2020-01-01')
+        )
+        OrmSync.update_3_1_to_3_2()
+        self.assertEqual(EventLog.get().event_obj(), {'old': 1})
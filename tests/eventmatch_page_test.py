@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the paged EventMatch listing."""
+import os
+from json import dumps
+import requests
+import cherrypy
+from cherrypy.test import helper
+import mock
+from pacifica.notifications.orm import EventMatch
+from pacifica.notifications.rest import Root, error_page_default
+from .common_test import eventmatch_droptables
+
+
+class EventMatchPageCPTest(helper.CPWebCase):
+    """Test the cursor pages and ETags of the EventMatch listing."""
+
+    @property
+    def list_url(self):
+        """Return the url of the listing on the test server."""
+        return 'http://{0}:{1}/eventmatch'.format(cherrypy.server.socket_host, cherrypy.server.socket_port)
+
+    @staticmethod
+    def setup_server():
+        """Mount the service with the method dispatcher."""
+        cherrypy.config.update({'error_page.default': error_page_default})
+        cherrypy.tree.mount(Root(), '/', {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+
+    def _create(self, count, user='default_user'):
+        """Create count eventmatches for user and return the uuids sorted."""
+        uuids = []
+        for index in range(count):
+            resp = requests.post(self.list_url, data=dumps({
+                'name': 'event-{}'.format(index), 'jsonpath': '$.data', 'target_url': 'http://127.0.0.1:8080',
+                'extensions': {'index': index}
+            }), headers={'Content-Type': 'application/json', 'Http-Remote-User': user})
+            self.assertEqual(resp.status_code, 200)
+            uuids.append(resp.json()['uuid'])
+        return sorted(uuids)
+
+    @eventmatch_droptables
+    def test_pages(self):
+        """Test following the next links returns every eventmatch once."""
+        uuids = self._create(5)
+        self._create(2, 'other')
+        url = self.list_url + '?limit=2'
+        pages = []
+        while url:
+            resp = requests.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Type'], 'application/json')
+            pages.append(resp.json())
+            url = resp.links.get('next', {}).get('url')
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([obj['uuid'] for page in pages for obj in page], uuids)
+        self.assertEqual(pages[0][0]['auth'], {})
+        self.assertEqual(sorted(obj['extensions']['index'] for page in pages for obj in page), list(range(5)))
+        self.assertEqual(pages[0][0], requests.get('{}/{}'.format(self.list_url, uuids[0])).json())
+
+    @eventmatch_droptables
+    def test_page_size(self):
+        """Test the page size is capped and bad pages are rejected."""
+        self._create(3)
+        with mock.patch.dict(os.environ, {'EVENTMATCH_PAGE_SIZE': '2'}):
+            resp = requests.get(self.list_url + '?limit=100')
+        self.assertEqual(len(resp.json()), 2)
+        self.assertTrue('next' in resp.links)
+        for query in ['limit=0', 'limit=x', 'cursor=1234']:
+            self.assertEqual(requests.get('{}?{}'.format(self.list_url, query)).status_code, 400)
+        self.assertEqual(requests.get(self.list_url, headers={'Http-Remote-User': 'nobody'}).status_code, 403)
+
+    @eventmatch_droptables
+    def test_etag(self):
+        """Test a matching If-None-Match is a 304 until an eventmatch changes."""
+        uuids = self._create(2)
+        etag = requests.get(self.list_url).headers['ETag']
+        resp = requests.get(self.list_url, headers={'If-None-Match': 'W/"other", ' + etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertNotEqual(requests.get(self.list_url + '?limit=1').headers['ETag'], etag)
+        EventMatch.update(disabled=EventMatch.created).where(EventMatch.uuid == uuids[0]).execute()
+        resp = requests.get(self.list_url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        requests.delete('{}/{}'.format(self.list_url, uuids[1]))
+        resp = requests.get(self.list_url, headers={'If-None-Match': etag})
+        self.assertEqual((resp.status_code, len(resp.json())), (200, 1))
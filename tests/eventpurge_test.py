@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the chunked eventpurge."""
+from argparse import Namespace
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import TestCase
+import mock
+from pacifica.notifications.orm import EventLog, EventLogMatch, EventMatch, eventpurge, purge_events
+from .common_test import eventmatch_droptables
+
+
+class TestEventPurge(TestCase):
+    """Test eventpurge deletes in chunks."""
+
+    @staticmethod
+    def _create_events(old, new):
+        """Create old events of last week and new ones of today each with a match."""
+        eventmatch = EventMatch.create(name='first', jsonpath='$', user='dmlb2001', target_url='http://127.0.0.1:8080')
+        for count, created in [(old, datetime.now() - timedelta(days=7)), (new, datetime.now())]:
+            for _index in range(count):
+                event_log = EventLog.create(jsondata='{}', created=created)
+                EventLogMatch.create(
+                    event_log=event_log, event_match=eventmatch,
+                    policy_status_code='200', policy_resp_body='{}'
+                )
+
+    @staticmethod
+    def _args(**kwargs):
+        """Return the eventpurge arguments for events older than a day."""
+        args = {
+            'events': [], 'older_than': datetime.now() - timedelta(days=1),
+            'chunk_size': 4, 'sleep': 0, 'dry_run': False
+        }
+        args.update(kwargs)
+        return Namespace(**args)
+
+    @eventmatch_droptables
+    def test_purge_chunks(self):
+        """Test the old events are deleted in chunks with progress."""
+        self._create_events(10, 3)
+        progress = mock.Mock()
+        with mock.patch('pacifica.notifications.orm.sleep') as mock_sleep:
+            totals = purge_events(EventLog.created < datetime.now() - timedelta(days=1), 4, 0.5, progress)
+        self.assertEqual(totals, (10, 10))
+        self.assertEqual([call[0] for call in progress.call_args_list], [(4, 4), (8, 8), (10, 10)])
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(EventLog.select().count(), 3)
+        self.assertEqual(EventLogMatch.select().count(), 3)
+
+    @eventmatch_droptables
+    def test_dry_run(self):
+        """Test the dry run only counts."""
+        self._create_events(5, 2)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            eventpurge(self._args(dry_run=True))
+        self.assertEqual(stdout.getvalue(), 'Would purge 5 events and 5 matches\n')
+        self.assertEqual(EventLog.select().count(), 7)
+
+    @eventmatch_droptables
+    def test_eventpurge(self):
+        """Test the command reports its progress and totals."""
+        self._create_events(8, 2)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            eventpurge(self._args())
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'Purged 4 events and 4 matches',
+            'Purged 8 events and 8 matches',
+            'Purged 8 events and 8 matches in total'
+        ])
+        self.assertEqual(EventLog.select().count(), 2)
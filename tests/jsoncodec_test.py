@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the JSON codec backends give the same bytes."""
+from json import loads as json_loads
+from os.path import dirname, join
+from unittest import TestCase, skipUnless
+from pacifica.notifications.jsoncodec import BACKENDS, select_backend, dumps, dumps_bytes, loads
+
+
+def _corpus():
+    """Return the objects both backends must encode to the same bytes."""
+    with open(join(dirname(__file__), 'test_files', 'events.json')) as event_fd:
+        sample_event = json_loads(event_fd.read())
+    return [
+        sample_event,
+        {'data': [sample_event['data'][0]] * 100, 'extensions': {}},
+        {'text': u'é ü 日本   \x00 \x1f " \\ / \t\n', u'clé': None},
+        {'numbers': [0, -1, 2 ** 53, 2 ** 63, -2 ** 63, 2 ** 64 - 1, 0.1, 1.5, -0.0, 123456789.125, 5e-324]},
+        {'nested': [[[{}]], [], {'a': [True, False, None]}]},
+        {1: 'int key', None: 'null key'},
+        {True: 'bool key'},
+        {'big': 2 ** 70, 'negative': -2 ** 70},
+        [], {}, '', 'text', 0, None,
+    ]
+
+
+class TestJsonCodec(TestCase):
+    """Test the configured backend and the backend selection."""
+
+    def test_round_trip(self):
+        """Test the configured backend decodes what it encodes."""
+        for obj in _corpus():
+            self.assertEqual(loads(dumps(obj)), json_loads(dumps_bytes(obj).decode('utf8')))
+        self.assertEqual(loads(b'{"a": [1, 2]}'), {'a': [1, 2]})
+        self.assertEqual(dumps({'a': [1, u'é']}), u'{"a":[1,"é"]}')
+
+    def test_select_backend(self):
+        """Test unknown backends are an error and auto prefers orjson."""
+        self.assertEqual(select_backend('stdlib'), 'stdlib')
+        self.assertEqual(select_backend(), 'orjson' if 'orjson' in BACKENDS else 'stdlib')
+        with self.assertRaises(ValueError):
+            select_backend('simplejson')
+
+    def test_stdlib_fallback(self):
+        """Test text orjson rejects is decoded by the stdlib and bad JSON is still an error."""
+        for _name, (_dumps_bytes, backend_loads) in BACKENDS.items():
+            self.assertTrue(backend_loads('[NaN]')[0] != backend_loads('[NaN]')[0])
+            for text in [b'', b'{', b'[1,]', b'\xff']:
+                with self.assertRaises(ValueError):
+                    backend_loads(text)
+
+
+@skipUnless('orjson' in BACKENDS, 'orjson is not installed')
+class TestOrjsonCompatible(TestCase):
+    """Test orjson gives the bytes the stdlib gives."""
+
+    def test_same_bytes(self):
+        """Test every object of the corpus encodes to the same bytes."""
+        stdlib_dumps, stdlib_loads = BACKENDS['stdlib']
+        orjson_dumps, orjson_loads = BACKENDS['orjson']
+        for obj in _corpus():
+            self.assertEqual(orjson_dumps(obj), stdlib_dumps(obj))
+            self.assertEqual(orjson_loads(stdlib_dumps(obj)), stdlib_loads(stdlib_dumps(obj)))
+
+    def test_non_finite(self):
+        """Test NaN and infinite floats are written like the stdlib instead of null."""
+        orjson_dumps, orjson_loads = BACKENDS['orjson']
+        obj = orjson_loads('{"v": NaN, "big": 1e400, "list": [1.5, -Infinity], "null": null}')
+        self.assertEqual(orjson_dumps(obj), b'{"v":NaN,"big":Infinity,"list":[1.5,-Infinity],"null":null}')
+        self.assertEqual(orjson_dumps({'a': None, 'b': (1.5, 'c')}), b'{"a":null,"b":[1.5,"c"]}')
+
+    def test_exponent_floats(self):
+        """Test floats written with an exponent decode to the same values."""
+        obj = [1e16, 1e-05, 1e300, -2.5e-10]
+        self.assertEqual(json_loads(BACKENDS['orjson'][0](obj)), json_loads(BACKENDS['stdlib'][0](obj)))
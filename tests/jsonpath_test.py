@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the jsonpath module."""
+from unittest import TestCase
+from pacifica.notifications.jsonpath import PathCache, PATH_CACHE, parse, find, find_all
+
+
+class TestPathCache(TestCase):
+    """Test the compiled jsonpath cache."""
+
+    def test_hit_and_miss(self):
+        """Test the same expression is only parsed once."""
+        cache = PathCache(4)
+        first = cache.get('$.data')
+        second = cache.get('$.data')
+        self.assertTrue(first is second)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 4})
+
+    def test_lru_eviction(self):
+        """Test the least recently used expression is evicted."""
+        cache = PathCache(2)
+        first = cache.get('$.a')
+        cache.get('$.b')
+        cache.get('$.a')
+        cache.get('$.c')
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertTrue(cache.get('$.a') is first)
+        cache.get('$.b')
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_disabled(self):
+        """Test a zero sized cache still parses."""
+        cache = PathCache(0)
+        self.assertTrue(find(cache.get('$.a'), {'a': 1}))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_clear(self):
+        """Test clearing the cache resets the counters."""
+        cache = PathCache(2)
+        cache.get('$.a')
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 2})
+
+    def test_bad_expression(self):
+        """Test parse errors are raised and not cached."""
+        cache = PathCache(2)
+        with self.assertRaises(ValueError):
+            cache.get('$.[')
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_module_parse(self):
+        """Test the module parse goes through the cache."""
+        PATH_CACHE.clear()
+        parse('$.data')
+        parse('$.data')
+        self.assertEqual(PATH_CACHE.stats()['hits'], 1)
+
+
+class TestFind(TestCase):
+    """Test the find and find_all functions."""
+
+    data = {'data': [{'value': 'Blah'}, {'value': 'Foo'}, {'value': 'Blah'}]}
+
+    def test_find(self):
+        """Test find returns a boolean."""
+        self.assertTrue(find(parse('$.data.*[?(@.value = "Blah")]'), self.data))
+        self.assertFalse(find(parse('$.data.*[?(@.value = "Bar")]'), self.data))
+
+    def test_find_all(self):
+        """Test find_all returns every match."""
+        self.assertEqual(find_all(parse('$.data.*[?(@.value = "Blah")].value'), self.data), ['Blah', 'Blah'])
+        self.assertEqual(find_all(parse('$.nothing'), self.data), [])
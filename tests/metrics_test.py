@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the Prometheus style metrics."""
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+import requests
+import cherrypy
+from cherrypy.test import helper
+import mock
+from pacifica.notifications.jsonpath import parse
+from pacifica.notifications.metrics import Metrics, CONTENT_TYPE, DEFAULT_BUCKETS, start_exporter
+from pacifica.notifications.metrics import merge_snapshots, read_snapshots, render
+from pacifica.notifications.rest import Root, error_page_default
+from pacifica.notifications.subscriptions import SubscriptionIndex
+
+
+class TestMetrics(TestCase):
+    """Test the metrics registry."""
+
+    def setUp(self):
+        """Create a snapshot directory."""
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        """Remove the snapshot directory."""
+        rmtree(self.directory)
+
+    def test_counters_and_histograms(self):
+        """Test the counters sum and the histograms count the buckets."""
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.inc('events_total', kind='a')
+        metrics.inc('events_total', 2, kind='a')
+        metrics.inc('events_total', kind='b')
+        for seconds in [0.05, 0.1, 0.5, 2.0]:
+            metrics.observe('stage_seconds', seconds, stage='route')
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['events_total'], {'kind="a"': 3, 'kind="b"': 1})
+        self.assertEqual(snapshot['histograms']['stage_seconds']['stage="route"'], [2, 1, 2.65, 4])
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['counters'], {})
+
+    def test_collectors(self):
+        """Test the counters of the collectors are added to every snapshot and kept on reset."""
+        metrics = Metrics()
+        metrics.inc('hits_total')
+        metrics.register(lambda: [('hits_total', 2, ''), ('misses_total', 1, 'host="a"')])
+        self.assertEqual(metrics.snapshot()['counters'], {'hits_total': {'': 3}, 'misses_total': {'host="a"': 1}})
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['counters'], {'hits_total': {'': 2}, 'misses_total': {'host="a"': 1}})
+
+    def test_render(self):
+        """Test the text exposition format."""
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.inc('events_total', kind='say "hi"')
+        metrics.observe('stage_seconds', 0.05, stage='route')
+        metrics.observe('stage_seconds', 2.0, stage='route')
+        self.assertEqual(render(metrics.snapshot()).splitlines(), [
+            '# TYPE events_total counter',
+            'events_total{kind="say \\"hi\\""} 1.0',
+            '# TYPE stage_seconds histogram',
+            'stage_seconds_bucket{stage="route",le="0.1"} 1',
+            'stage_seconds_bucket{stage="route",le="1.0"} 1',
+            'stage_seconds_bucket{stage="route",le="+Inf"} 2',
+            'stage_seconds_sum{stage="route"} 2.05',
+            'stage_seconds_count{stage="route"} 2',
+        ])
+
+    def test_timer(self):
+        """Test the timer records the block even when it raises."""
+        metrics = Metrics()
+        with self.assertRaises(RuntimeError):
+            with metrics.timer('stage_seconds', stage='match'):
+                raise RuntimeError('failed')
+        self.assertEqual(metrics.snapshot()['histograms']['stage_seconds']['stage="match"'][-1], 1)
+
+    def test_collect(self):
+        """Test the snapshots of other processes are summed once."""
+        metrics = Metrics(self.directory, 0, buckets=(1.0,))
+        metrics.inc('events_total')
+        metrics.observe('stage_seconds', 0.5)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, '{}.json'.format(os.getpid()))))
+        with open(os.path.join(self.directory, '1.json'), 'w') as snapshot_fd:
+            snapshot_fd.write(
+                '{"buckets":[1.0],"counters":{"events_total":{"":2}},"histograms":{"stage_seconds":{"":[0,3.0,1]}}}'
+            )
+        with open(os.path.join(self.directory, '2.json'), 'w') as snapshot_fd:
+            snapshot_fd.write('{"buckets":[2.0],"counters":{},"histograms":{"stage_seconds":{"":[1,1.0,1]}}}')
+        with open(os.path.join(self.directory, '3.json'), 'w') as snapshot_fd:
+            snapshot_fd.write('{"buckets"')
+        self.assertEqual(len(read_snapshots(self.directory)), 3)
+        collected = metrics.collect()
+        self.assertEqual(collected['counters'], {'events_total': {'': 3}})
+        self.assertEqual(collected['histograms'], {'stage_seconds': {'': [1, 3.5, 2]}})
+        self.assertEqual(merge_snapshots([]), {'buckets': list(DEFAULT_BUCKETS), 'counters': {}, 'histograms': {}})
+        self.assertEqual(read_snapshots(os.path.join(self.directory, 'missing')), [])
+
+    def test_flush_error(self):
+        """Test recording doesn't fail when the directory can't be written."""
+        path = os.path.join(self.directory, 'file')
+        with open(path, 'w') as file_fd:
+            file_fd.write('')
+        metrics = Metrics(path, 0)
+        metrics.inc('events_total')
+        self.assertEqual(metrics.snapshot()['counters'], {'events_total': {'': 1}})
+
+    def test_exporter(self):
+        """Test the exporter serves the metrics."""
+        metrics = Metrics()
+        metrics.inc('events_total')
+        with mock.patch('pacifica.notifications.metrics.METRICS', metrics):
+            server = start_exporter(0, '127.0.0.1')
+            try:
+                url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+                resp = requests.get(url + '/metrics')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['Content-Type'], CONTENT_TYPE)
+                self.assertEqual(resp.text, '# TYPE events_total counter\nevents_total 1.0\n')
+                self.assertEqual(requests.get(url + '/other').status_code, 404)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_match(self):
+        """Test the jsonpath evaluations are counted per subscription, pruned ones aren't evaluated."""
+        metrics = Metrics()
+        index = SubscriptionIndex([({'uuid': 'data'}, parse('$.data')), ({'uuid': 'name'}, parse('$.name'))])
+        with mock.patch('pacifica.notifications.subscriptions.METRICS', metrics):
+            index.match({'data': 1})
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            snapshot['counters']['notifications_jsonpath_evaluations_total'], {'matched="true",subscription="data"': 1}
+        )
+        self.assertEqual(list(snapshot['histograms']['notifications_stage_seconds']), ['stage="match"'])
+
+
+class MetricsCPTest(helper.CPWebCase):
+    """Test the metrics endpoint of the REST service."""
+
+    @staticmethod
+    def setup_server():
+        """Mount the service with the method dispatcher."""
+        cherrypy.config.update({'error_page.default': error_page_default})
+        cherrypy.tree.mount(Root(), '/', {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+
+    def test_metrics(self):
+        """Test the received events and the receive stage are reported."""
+        metrics = Metrics()
+        url = 'http://{0}:{1}'.format(cherrypy.server.socket_host, cherrypy.server.socket_port)
+        with mock.patch('pacifica.notifications.rest.METRICS', metrics), \
+                mock.patch('pacifica.notifications.rest.dispatch_events') as mock_dispatch:
+            mock_dispatch.delay.return_value = 'task-1'
+            resp = requests.post(
+                url + '/receive', data='[{"data": 1}, {"data": 2}]', headers={'Content-Type': 'application/json'}
+            )
+            self.assertEqual(resp.status_code, 200)
+            resp = requests.get(url + '/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        self.assertTrue('notifications_events_received_total 2.0' in resp.text.splitlines())
+        self.assertTrue('notifications_stage_seconds_count{stage="receive"} 1' in resp.text.splitlines())
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the policy decision cache."""
+import os
+from time import sleep
+from unittest import TestCase
+import mock
+from pacifica.notifications.policy import PolicyCache, PolicyDecision, policy_cache_from_config
+from pacifica.notifications.store import MemoryStore, RedisStore, store_from_url
+from pacifica.notifications import tasks
+
+
+class TestMemoryStore(TestCase):
+    """Test the in process store."""
+
+    def test_expire(self):
+        """Test keys expire after the ttl."""
+        store = MemoryStore()
+        store.set('a', 1, 0.05)
+        store.set('b', 2)
+        self.assertEqual(store.get('a'), 1)
+        sleep(0.06)
+        self.assertEqual(store.get('a'), None)
+        self.assertEqual(store.get('b'), 2)
+        store.delete('b')
+        self.assertEqual(store.get('b'), None)
+
+    def test_maxsize(self):
+        """Test the least recently used key is evicted."""
+        store = MemoryStore(2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertEqual([store.get(key) for key in 'abc'], [1, None, 3])
+        store.clear()
+        self.assertEqual(store.get('a'), None)
+
+    def test_store_from_url(self):
+        """Test the store urls."""
+        self.assertTrue(isinstance(store_from_url('memory://'), MemoryStore))
+        with mock.patch('redis.Redis'):
+            self.assertTrue(isinstance(store_from_url('redis://localhost:6379/1'), RedisStore))
+        with self.assertRaises(ValueError):
+            store_from_url('ftp://localhost')
+
+
+class TestRedisStore(TestCase):
+    """Test the store shared in redis."""
+
+    def setUp(self):
+        """Connect to the test redis server with a prefix of its own."""
+        self.store = RedisStore('redis://127.0.0.1:6379/1', 'pacifica-notifications-test:')
+        self.store.clear()
+
+    def tearDown(self):
+        """Remove the keys of the test."""
+        self.store.clear()
+
+    def test_get_set(self):
+        """Test the values round trip as JSON and keys expire after the ttl."""
+        self.assertEqual(self.store.get('a'), None)
+        self.store.set('a', [200, 'ok'], 0.05)
+        self.store.set('b', {'c': 2})
+        self.assertEqual(self.store.get('a'), [200, 'ok'])
+        sleep(0.1)
+        self.assertEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.get('b'), {'c': 2})
+        self.store.delete('b')
+        self.assertEqual(self.store.get('b'), None)
+
+    def test_add_incr(self):
+        """Test add only sets missing keys and incr counts from 0."""
+        self.assertTrue(self.store.add('a', 1, 60))
+        self.assertFalse(self.store.add('a', 2, 60))
+        self.assertEqual(self.store.get('a'), 1)
+        self.assertEqual([self.store.incr('n') for _index in range(3)], [1, 2, 3])
+        self.assertEqual(self.store.get('n'), 3)
+
+    def test_clear(self):
+        """Test clear only removes the keys with the prefix."""
+        other = RedisStore('redis://127.0.0.1:6379/1', 'pacifica-notifications-other:')
+        other.set('a', 1)
+        self.store.set('a', 1)
+        self.store.set('b', 2)
+        self.store.clear()
+        self.assertEqual([self.store.get(key) for key in 'ab'], [None, None])
+        self.assertEqual(other.get('a'), 1)
+        other.clear()
+
+
+class TestPolicyCache(TestCase):
+    """Test the policy decision cache."""
+
+    event = {'data': [{'destinationTable': 'Transactions.project', 'value': '1234'}], 'eventID': '1'}
+
+    def test_decisions(self):
+        """Test 2xx and 4xx are cached and 5xx isn't."""
+        cache = PolicyCache(MemoryStore(), 60)
+        self.assertEqual(cache.get('dmlb2001', self.event), None)
+        cache.set('dmlb2001', self.event, PolicyDecision(200, 'ok'))
+        self.assertEqual(cache.get('dmlb2001', self.event), PolicyDecision(200, 'ok'))
+        self.assertEqual(cache.get('someone', self.event), None)
+        cache.set('someone', self.event, PolicyDecision(403, 'no'))
+        self.assertEqual(cache.get('someone', self.event).status_code, 403)
+        cache.set('other', self.event, PolicyDecision(500, 'error'))
+        self.assertEqual(cache.get('other', self.event), None)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 3})
+        self.assertEqual(cache.counters(), [
+            ('notifications_policy_cache_hits_total', 2, ''), ('notifications_policy_cache_misses_total', 3, '')
+        ])
+
+    def test_fingerprint(self):
+        """Test events with the same fingerprint share the decision."""
+        cache = PolicyCache(MemoryStore(), 60, ['$.data[*][?(@.destinationTable = "Transactions.project")].value'])
+        cache.set('dmlb2001', self.event, PolicyDecision(200, 'ok'))
+        other_event = dict(self.event, eventID='2')
+        self.assertEqual(cache.get('dmlb2001', other_event), PolicyDecision(200, 'ok'))
+        other_event['data'] = [{'destinationTable': 'Transactions.project', 'value': '4321'}]
+        self.assertEqual(cache.get('dmlb2001', other_event), None)
+
+    @mock.patch.dict(os.environ, {
+        'POLICY_CACHE_URL': 'memory://', 'POLICY_CACHE_FINGERPRINT': '$.eventType; $.source', 'POLICY_CACHE_TTL': '5'
+    })
+    def test_from_config(self):
+        """Test the cache is configured from the configuration."""
+        cache = policy_cache_from_config()
+        self.assertEqual(len(cache.fingerprint), 2)
+        self.assertEqual(cache.ttl, 5)
+
+    def test_disabled(self):
+        """Test the cache is disabled by default."""
+        self.assertEqual(policy_cache_from_config(), None)
+
+    @mock.patch('pacifica.notifications.tasks.SESSIONS')
+    def test_policy_decision(self, mock_sessions):
+        """Test the policy server is only queried on a miss."""
+        mock_sessions.post.return_value = PolicyDecision(200, 'ok')
+        with mock.patch.object(tasks, 'POLICY_CACHE', PolicyCache(MemoryStore(), 60)):
+            self.assertEqual(tasks.policy_decision('dmlb2001', self.event).status_code, 200)
+            self.assertEqual(tasks.policy_decision('dmlb2001', self.event).status_code, 200)
+        self.assertEqual(mock_sessions.post.call_count, 1)
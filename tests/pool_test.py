@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the pooled database configuration."""
+import os
+from json import dumps
+from unittest import TestCase
+import requests
+import cherrypy
+from cherrypy.test import helper
+import mock
+from playhouse.pool import PooledDatabase
+from pacifica.notifications.dedup import Deduplicator
+from pacifica.notifications.orm import database_from_config, BaseModel
+from pacifica.notifications.store import MemoryStore
+from pacifica.notifications.rest import Root, error_page_default, request_database
+from .common_test import eventmatch_droptables
+
+
+class TestPooledDatabase(TestCase):
+    """Test the pooled database configuration."""
+
+    @mock.patch.dict(os.environ, {
+        'PEEWEE_URL': 'sqlite:///:memory:',
+        'DATABASE_POOLED': 'true',
+        'DATABASE_MAX_CONNECTIONS': '4',
+        'DATABASE_STALE_TIMEOUT': '60'
+    })
+    def test_pooled(self):
+        """Test pooled switches to the pooled database class."""
+        database = database_from_config()
+        self.assertTrue(isinstance(database, PooledDatabase))
+        # pylint: disable=protected-access
+        self.assertEqual(database._max_connections, 4)
+        self.assertEqual(database._stale_timeout, 60)
+
+    @mock.patch.dict(os.environ, {'PEEWEE_URL': 'sqlite+pool:///:memory:', 'DATABASE_POOLED': 'false'})
+    def test_pooled_url(self):
+        """Test a pooled url scheme is used as is."""
+        self.assertTrue(isinstance(database_from_config(), PooledDatabase))
+
+    @mock.patch.dict(os.environ, {'PEEWEE_URL': 'sqlite:///:memory:', 'DATABASE_POOLED': 'false'})
+    def test_not_pooled(self):
+        """Test the database isn't pooled by default."""
+        self.assertFalse(isinstance(database_from_config(), PooledDatabase))
+
+    @mock.patch.dict(os.environ, {'PEEWEE_URL': 'sqlite:///:memory:', 'DATABASE_POOLED': 'true'})
+    def test_checkout(self):
+        """Test connect reuses the checked out connection and close returns it."""
+        database = database_from_config()
+        with mock.patch.object(BaseModel._meta, 'database', database):
+            BaseModel.database_connect()
+            conn = database.connection()
+            BaseModel.database_connect()
+            self.assertTrue(database.connection() is conn)
+            BaseModel.database_close()
+            self.assertTrue(database.is_closed())
+            # pylint: disable=protected-access
+            self.assertEqual(len(database._connections), 1)
+            database.close_all()
+
+
+class DatabaseToolCPTest(helper.CPWebCase):
+    """Test the database tool owns the connection of the request."""
+
+    @staticmethod
+    def setup_server():
+        """Mount the service with the database tool on."""
+        cherrypy.config.update({'error_page.default': error_page_default})
+        cherrypy.tree.mount(Root(), '/', {'/': {
+            'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+            'tools.database.on': True
+        }})
+
+    def test_outside_request(self):
+        """Test the block connects and closes the database itself outside of a request."""
+        with mock.patch.object(BaseModel, 'database_connect') as connect, \
+                mock.patch.object(BaseModel, 'database_close') as close:
+            with request_database():
+                self.assertTrue(connect.called)
+                self.assertFalse(close.called)
+        self.assertTrue(close.called)
+
+    @eventmatch_droptables
+    def test_one_checkout(self):
+        """Test the handlers leave the connection to the tool, released after the response is sent."""
+        url = 'http://{0}:{1}'.format(cherrypy.server.socket_host, cherrypy.server.socket_port)
+        session = requests.Session()
+        with mock.patch.object(BaseModel, 'database_connect', side_effect=BaseModel.database_connect) as connect, \
+                mock.patch.object(BaseModel, 'database_close', side_effect=BaseModel.database_close) as close:
+            resp = session.post(url + '/eventmatch', data=dumps({
+                'name': 'event', 'jsonpath': '$.data', 'target_url': 'http://127.0.0.1:8080'
+            }), headers={'Content-Type': 'application/json'})
+            self.assertEqual(resp.status_code, 200)
+            resp = session.delete('{}/eventmatch/{}'.format(url, resp.json()['uuid']))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(session.get(url + '/metrics').status_code, 200)
+        session.close()
+        self.assertEqual(connect.call_count, 3)
+        self.assertTrue(close.call_count in [2, 3])
+
+    @eventmatch_droptables
+    def test_dedup_checkout(self):
+        """Test the dedup lookup of a received event uses the connection of the request."""
+        url = 'http://{0}:{1}/receive'.format(cherrypy.server.socket_host, cherrypy.server.socket_port)
+        with mock.patch('pacifica.notifications.rest.DEDUP', Deduplicator(MemoryStore(), 60)), \
+                mock.patch('pacifica.notifications.rest.dispatch_events') as mock_dispatch, \
+                mock.patch.object(BaseModel, 'database_connect', side_effect=BaseModel.database_connect) as connect, \
+                mock.patch.object(BaseModel, 'database_close', side_effect=BaseModel.database_close) as close:
+            mock_dispatch.delay.return_value = 'task-1'
+            resp = requests.post(
+                url, data='[{"id": "1", "source": "/a"}]', headers={'Content-Type': 'application/json'}
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json()[0]['task_id'], 'task-1')
+        self.assertEqual(connect.call_count, 1)
+        self.assertTrue(close.call_count <= 1)
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the target rate limits and in-flight caps."""
+import os
+from unittest import TestCase
+import mock
+from playhouse.migrate import SchemaMigrator, migrate
+from pacifica.notifications import tasks
+from pacifica.notifications.breaker import CircuitBreaker
+from pacifica.notifications.orm import DB, EventMatch, OrmSync
+from pacifica.notifications.policy import PolicyDecision
+from pacifica.notifications.ratelimit import RateLimiter, RedisRateLimiter, rate_limiter_from_url, target_limits
+from pacifica.notifications.store import MemoryStore
+from .common_test import active_subscriptions, eventmatch_droptables
+
+
+class TestRateLimiter(TestCase):
+    """Test the in process rate limiter."""
+
+    @mock.patch('pacifica.notifications.ratelimit.time')
+    def test_token_bucket(self, mock_time):
+        """Test the burst is allowed then tokens are reserved at the rate."""
+        mock_time.return_value = 1000.0
+        limiter = RateLimiter()
+        self.assertEqual(limiter.take_token('host', 0), 0)
+        waits = [limiter.take_token('host', 2, 3) for _index in range(5)]
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1.0])
+        mock_time.return_value = 1001.0
+        self.assertEqual(limiter.take_token('host', 2, 3), 0.5)
+        self.assertEqual(limiter.take_token('other', 2, 3), 0)
+        mock_time.return_value = 1010.0
+        self.assertEqual(limiter.take_token('host', 2, 3), 0)
+
+    @mock.patch('pacifica.notifications.ratelimit.time')
+    def test_in_flight(self, mock_time):
+        """Test the leases are capped, released and expire."""
+        mock_time.return_value = 1000.0
+        limiter = RateLimiter(lease=30)
+        self.assertEqual(limiter.acquire_lease('host', 0), (None, 0))
+        first, wait = limiter.acquire_lease('host', 2)
+        self.assertEqual(wait, 0)
+        second, _wait = limiter.acquire_lease('host', 2)
+        self.assertEqual(limiter.acquire_lease('host', 2), (None, 1.0))
+        limiter.release('host', first)
+        third, wait = limiter.acquire_lease('host', 2)
+        self.assertTrue(third and not wait)
+        mock_time.return_value = 1031.0
+        self.assertTrue(limiter.acquire_lease('host', 2)[0])
+        limiter.release('host', second)
+        limiter.release('host', None)
+
+    def test_from_url(self):
+        """Test the limiter is picked from the url."""
+        self.assertTrue(isinstance(rate_limiter_from_url('memory://'), RateLimiter))
+        with mock.patch('redis.Redis'):
+            self.assertTrue(rate_limiter_from_url('redis://localhost:6379/2').redis)
+        with self.assertRaises(ValueError):
+            rate_limiter_from_url('other://')
+
+    @mock.patch.dict(os.environ, {'TARGET_RATE_LIMIT': '5', 'TARGET_MAX_IN_FLIGHT': '2'})
+    def test_target_limits(self):
+        """Test the eventmatch fields override the configured defaults."""
+        self.assertEqual(target_limits({}), (5.0, 0.0, 2.0))
+        self.assertEqual(target_limits({'rate_limit': 1, 'rate_burst': None, 'max_in_flight': 4}), (1, 0.0, 4))
+
+
+class TestRedisRateLimiter(TestCase):
+    """Test the rate limiter shared in redis."""
+
+    def setUp(self):
+        """Connect to the test redis server with a prefix of its own."""
+        self.limiter = RedisRateLimiter('redis://127.0.0.1:6379/2', 30, 'pacifica-notifications-test:')
+        self.tearDown()
+
+    def tearDown(self):
+        """Remove the keys of the test."""
+        for key in self.limiter.redis.scan_iter(match='pacifica-notifications-test:*'):
+            self.limiter.redis.delete(key)
+
+    @mock.patch('pacifica.notifications.ratelimit.time')
+    def test_token_bucket(self, mock_time):
+        """Test the burst is allowed then tokens are reserved at the rate."""
+        mock_time.return_value = 1000.0
+        self.assertEqual(self.limiter.take_token('host', 0), 0)
+        waits = [self.limiter.take_token('host', 2, 3) for _index in range(5)]
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1.0])
+        mock_time.return_value = 1001.0
+        self.assertEqual(self.limiter.take_token('host', 2, 3), 0.5)
+        self.assertEqual(self.limiter.take_token('other', 2, 3), 0)
+        mock_time.return_value = 1010.0
+        self.assertEqual(self.limiter.take_token('host', 2, 3), 0)
+
+    @mock.patch('pacifica.notifications.ratelimit.time')
+    def test_in_flight(self, mock_time):
+        """Test the leases are capped, released and expire."""
+        mock_time.return_value = 1000.0
+        self.assertEqual(self.limiter.acquire_lease('host', 0), (None, 0))
+        first, wait = self.limiter.acquire_lease('host', 2)
+        self.assertEqual(wait, 0)
+        second, _wait = self.limiter.acquire_lease('host', 2)
+        self.assertEqual(self.limiter.acquire_lease('host', 2), (None, 1.0))
+        self.limiter.release('host', first)
+        third, wait = self.limiter.acquire_lease('host', 2)
+        self.assertTrue(third and not wait)
+        mock_time.return_value = 1031.0
+        self.assertTrue(self.limiter.acquire_lease('host', 2)[0])
+        self.limiter.release('host', second)
+        self.limiter.release('host', None)
+
+    def test_shared(self):
+        """Test two limiters on the same redis share the cap."""
+        other = RedisRateLimiter('redis://127.0.0.1:6379/2', 30, 'pacifica-notifications-test:')
+        lease, _wait = self.limiter.acquire_lease('host', 1)
+        self.assertEqual(other.acquire_lease('host', 1)[0], None)
+        other.release('host', lease)
+        self.assertTrue(other.acquire_lease('host', 1)[0])
+
+
+@mock.patch('pacifica.notifications.tasks.update_log_match')
+@mock.patch('pacifica.notifications.tasks.SESSIONS')
+class TestRouteEventLimits(TestCase):
+    """Test route_event holds events over the limits."""
+
+    eventmatch = {
+        'uuid': 'a-uuid', 'target_url': 'http://example.com/', 'extensions': {}, 'auth': {},
+        'rate_limit': 1, 'rate_burst': 1, 'max_in_flight': 1
+    }
+
+    def setUp(self):
+        """Use a fresh limiter and capture the redeliveries."""
+        self.limiter = RateLimiter()
+        for patcher in [
+                mock.patch.object(tasks, 'RATE_LIMITER', self.limiter),
+                mock.patch.object(tasks, 'BREAKER', CircuitBreaker(MemoryStore())),
+                mock.patch(
+                    'pacifica.notifications.claimcheck.ACTIVE_SUBSCRIPTIONS', active_subscriptions(self.eventmatch)
+                ),
+                mock.patch.object(tasks, 'DELIVERY_ENGINE', None),
+                mock.patch.object(tasks.route_event, 'apply_async')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_rate_limited(self, mock_sessions, _update_log_match):
+        """Test the second event is held with a reserved token."""
+        mock_sessions.post.return_value = PolicyDecision(200, 'ok')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid')
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid')
+        self.assertEqual(mock_sessions.post.call_count, 1)
+        call_args = tasks.route_event.apply_async.call_args
+        self.assertEqual(call_args[0][1], {'attempt': 0, 'reserved': True})
+        self.assertTrue(0.9 < call_args[1]['countdown'] <= 2)
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid', **call_args[0][1])
+        self.assertEqual(mock_sessions.post.call_count, 2)
+        self.assertEqual(self.limiter.acquire_lease('http://example.com', 1)[1], 0)
+
+    def test_in_flight_capped(self, mock_sessions, _update_log_match):
+        """Test an event is held while the host is at its in-flight cap."""
+        mock_sessions.post.return_value = PolicyDecision(200, 'ok')
+        lease, _wait = self.limiter.acquire_lease('http://example.com', 1)
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid', reserved=True)
+        self.assertFalse(mock_sessions.post.called)
+        self.assertEqual(tasks.route_event.apply_async.call_args[0][1], {'attempt': 0, 'reserved': True})
+        self.limiter.release('http://example.com', lease)
+        tasks.route_event(self.eventmatch, {}, 'elm-uuid', reserved=True)
+        self.assertEqual(mock_sessions.post.call_count, 1)
+        self.assertTrue(self.limiter.acquire_lease('http://example.com', 1)[0])
+
+
+class TestRateLimitMigration(TestCase):
+    """Test the schema update adding the limit columns."""
+
+    @eventmatch_droptables
+    def test_update_3_0_to_3_1(self):
+        """Test the columns are added to an existing eventmatch table."""
+        migrator = SchemaMigrator.from_database(DB)
+        migrate(*[
+            migrator.drop_column('eventmatch', column) for column in ['rate_limit', 'rate_burst', 'max_in_flight']
+        ])
+        self.assertFalse('rate_limit' in [column.name for column in DB.get_columns('eventmatch')])
+        OrmSync.update_3_0_to_3_1()
+        columns = [column.name for column in DB.get_columns('eventmatch')]
+        for column in ['rate_limit', 'rate_burst', 'max_in_flight']:
+            self.assertTrue(column in columns)
+        eventmatch = EventMatch.create(
+            name='limited', jsonpath='$', user='dmlb2001', target_url='http://x', rate_limit=0.5
+        )
+        self.assertEqual(eventmatch.to_hash()['rate_limit'], 0.5)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the batch event parsing and dispatch."""
+from io import BytesIO
+from json import dumps
+from unittest import TestCase
+import mock
+from cherrypy import HTTPError
+from pacifica.notifications.rest import ReceiveEvent, iter_json_array, iter_ndjson
+
+
+class TestBatchParsing(TestCase):
+    """Test the streaming batch parsers."""
+
+    events = [{'id': index, 'data': {'name': 'fé-{}'.format(index), 'size': 1.5}} for index in range(50)]
+
+    def test_json_array(self):
+        """Test the JSON array is parsed across small reads."""
+        body = dumps(self.events, ensure_ascii=False).encode('utf8')
+        for read_size in [1, 7, 64, 100000]:
+            self.assertEqual(list(iter_json_array(BytesIO(body), read_size=read_size)), self.events)
+
+    def test_json_array_first(self):
+        """Test bytes already read are used first."""
+        body = dumps([1234, 5678, 'x', None, True]).encode('utf8')
+        self.assertEqual(list(iter_json_array(BytesIO(body[3:]), body[:3], read_size=2)), [1234, 5678, 'x', None, True])
+
+    def test_json_array_split_numbers(self):
+        """Test numbers split at any byte across reads are decoded whole."""
+        body = b'[1.5e10,-3,2E-2,10,0.25, 7 ]'
+        for read_size in range(1, len(body) + 1):
+            self.assertEqual(list(iter_json_array(BytesIO(body), read_size=read_size)), [1.5e10, -3, 0.02, 10, 0.25, 7])
+        for first in range(1, 6):
+            self.assertEqual(list(iter_json_array(BytesIO(body[first:]), body[:first], 3))[:2], [1.5e10, -3])
+
+    def test_json_array_empty(self):
+        """Test an empty array."""
+        self.assertEqual(list(iter_json_array(BytesIO(b' [ \n ] '))), [])
+
+    def test_json_array_malformed(self):
+        """Test malformed arrays raise ValueError."""
+        for body in [b'', b'{}', b'[1,', b'[1 2]', b'[1,]', b'[{"a": }]', b'[1] x', b'[]]', b'[1][2]', b'[1.5e]']:
+            for read_size in [1, 2, 100]:
+                with self.assertRaises(ValueError):
+                    list(iter_json_array(BytesIO(body), read_size=read_size))
+
+    def test_ndjson(self):
+        """Test newline delimited JSON skipping blank lines."""
+        body = '\r\n'.join(dumps(event) for event in self.events) + '\n\n'
+        self.assertEqual(list(iter_ndjson(BytesIO(body.encode('utf8')))), self.events)
+
+
+class TestBatchDispatch(TestCase):
+    """Test the batch dispatch in chunks."""
+
+    @mock.patch('pacifica.notifications.rest.get_config')
+    @mock.patch('pacifica.notifications.rest.dispatch_events')
+    def test_chunks(self, mock_dispatch, mock_config):
+        """Test results are in order with one publish per chunk."""
+        mock_config.return_value.getint.return_value = 2
+        mock_dispatch.delay.side_effect = ['task-1', 'task-2']
+        with mock.patch.object(ReceiveEvent, 'event_json_schema', {'type': 'object'}):
+            results = ReceiveEvent._batch([{'a': 1}, 'bad', {'a': 2}, {'a': 3}])
+        self.assertEqual(mock_dispatch.delay.call_count, 2)
+        self.assertEqual([res.get('task_id') for res in results], ['task-1', None, 'task-1', 'task-2'])
+        self.assertTrue('error' in results[1])
+        sent = [uuid for call in mock_dispatch.delay.call_args_list for uuid, _event in call[0][0]]
+        self.assertEqual([res['event_log'] for res in results if 'event_log' in res], sent)
+
+    @mock.patch('pacifica.notifications.rest.dispatch_events')
+    def test_malformed(self, mock_dispatch):
+        """Test a malformed body before any event is a bad request."""
+        with self.assertRaises(HTTPError):
+            ReceiveEvent._batch(iter_json_array(BytesIO(b'[{]')))
+        mock_dispatch.delay.return_value = 'task-1'
+        results = ReceiveEvent._batch(iter_json_array(BytesIO(b'[{}, {]')))
+        self.assertEqual(results[0]['task_id'], 'task-1')
+        self.assertTrue('error' in results[1])
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the event log retention."""
+import os
+from datetime import datetime, time, timedelta
+from unittest import TestCase
+import mock
+from pacifica.notifications.orm import EventLog, EventLogMatch, EventMatch
+from pacifica.notifications.retention import enforce_retention, in_window, retention_enabled
+from pacifica.notifications.tasks import purge_retention
+from .common_test import eventmatch_droptables
+
+
+class TestRetention(TestCase):
+    """Test the retention policy is enforced."""
+
+    @staticmethod
+    def _create_events(days):
+        """Create an event with a match for each age in days."""
+        eventmatch = EventMatch.create(name='first', jsonpath='$', user='dmlb2001', target_url='http://127.0.0.1:8080')
+        for age in days:
+            event_log = EventLog.create(jsondata='{}', created=datetime.now() - timedelta(days=age))
+            EventLogMatch.create(
+                event_log=event_log, event_match=eventmatch,
+                policy_status_code='200', policy_resp_body='{}'
+            )
+
+    def test_in_window(self):
+        """Test the window including ones wrapping past midnight."""
+        self.assertTrue(in_window('', time(12)))
+        self.assertTrue(in_window('01:00-05:00', time(1)))
+        self.assertFalse(in_window('01:00-05:00', time(5)))
+        self.assertTrue(in_window('22:30-04:00', time(23)))
+        self.assertTrue(in_window('22:30-04:00', time(3, 59)))
+        self.assertFalse(in_window('22:30-04:00', time(22, 29)))
+
+    @mock.patch.dict(os.environ, {'RETENTION_MAX_AGE': '10'})
+    @eventmatch_droptables
+    def test_max_age(self):
+        """Test the events older than the maximum age are purged."""
+        self.assertTrue(retention_enabled())
+        self._create_events([1, 5, 11, 20, 30])
+        self.assertEqual(purge_retention(), {'events': 3, 'matches': 3, 'skipped': False})
+        self.assertEqual(EventLog.select().count(), 2)
+        self.assertEqual(EventLogMatch.select().count(), 2)
+
+    @mock.patch.dict(os.environ, {'RETENTION_MAX_ROWS': '3', 'RETENTION_CHUNK_SIZE': '1', 'RETENTION_SLEEP': '0'})
+    @eventmatch_droptables
+    def test_max_rows(self):
+        """Test only the newest events are kept."""
+        self._create_events([1, 2, 3, 4, 5])
+        self.assertEqual(enforce_retention(), {'events': 2, 'matches': 2, 'skipped': False})
+        oldest = EventLog.select().order_by(EventLog.created).first()
+        self.assertTrue(oldest.created > datetime.now() - timedelta(days=3, hours=1))
+
+    @mock.patch.dict(os.environ, {'RETENTION_MAX_AGE': '1', 'RETENTION_WINDOW': '01:00-05:00'})
+    @eventmatch_droptables
+    def test_window_closed(self):
+        """Test nothing is purged outside the window."""
+        self._create_events([5])
+        self.assertEqual(enforce_retention(datetime(2020, 1, 1, 12)), {'events': 0, 'matches': 0, 'skipped': True})
+        self.assertEqual(enforce_retention(datetime.now().replace(hour=2))['skipped'], False)
+        self.assertEqual(EventLog.select().count(), 0)
+
+    @eventmatch_droptables
+    def test_disabled(self):
+        """Test nothing is purged without a retention policy."""
+        self.assertFalse(retention_enabled())
+        self._create_events([100])
+        self.assertEqual(enforce_retention(), {'events': 0, 'matches': 0, 'skipped': False})
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the compiled JSON schema validators."""
+from json import loads
+from os.path import dirname, join
+from unittest import TestCase
+import jsonschema
+from jsonschema import ValidationError, SchemaError
+import mock
+from pacifica.notifications import rest
+from pacifica.notifications.rest import EventMatch, compiled_validator, load_json_schema, validate
+
+CLOUDEVENTS_SCHEMA = join(dirname(__file__), 'test_files', 'cloudevents-0.1.json')
+
+
+def sample_event():
+    """Return the sample ingest event."""
+    with open(join(dirname(__file__), 'test_files', 'events.json')) as event_fd:
+        return loads(event_fd.read())
+
+
+class TestCompiledValidator(TestCase):
+    """Test the validators are compiled once and validate like jsonschema."""
+
+    def test_compiled_once(self):
+        """Test the schema is checked once and a new schema object is compiled again."""
+        schema = {'type': 'object'}
+        with mock.patch.object(rest, 'validator_for', wraps=rest.validator_for) as validator_for:
+            for _index in range(3):
+                validate({}, schema)
+            self.assertEqual(validator_for.call_count, 1)
+            validate({}, {'type': 'object'})
+            self.assertEqual(validator_for.call_count, 2)
+        self.assertTrue(compiled_validator(EventMatch.json_schema) is compiled_validator(EventMatch.json_schema))
+
+    def test_same_errors(self):
+        """Test the error raised is the one jsonschema.validate raises."""
+        for obj in [
+                {'name': 1},
+                {'uuid': 'a', 'user': 'b', 'created': 'c', 'updated': 'd', 'deleted': None, 'version': 'e'},
+                {'auth': {'type': 'basic', 'basic': {}}}]:
+            with self.assertRaises(ValidationError) as expected:
+                jsonschema.validate(obj, EventMatch.json_schema)
+            with self.assertRaises(ValidationError) as raised:
+                validate(obj, EventMatch.json_schema)
+            self.assertEqual(raised.exception.message, expected.exception.message)
+        validate({'name': 'ok'}, EventMatch.json_schema)
+
+    def test_bad_schema(self):
+        """Test a bad schema is an error when compiled."""
+        with self.assertRaises(SchemaError):
+            compiled_validator({'type': 'nothing'})
+
+    def test_event_schema_file(self):
+        """Test a CloudEvents schema loaded from a file."""
+        self.assertEqual(load_json_schema(''), {})
+        schema = load_json_schema(CLOUDEVENTS_SCHEMA)
+        validate(sample_event(), schema)
+        with self.assertRaises(ValidationError):
+            validate(dict(sample_event(), eventID=''), schema)
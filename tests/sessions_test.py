@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the keep-alive session pool."""
+from unittest import TestCase
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from pacifica.notifications.sessions import SessionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Answer every post with an empty 200 keeping the connection open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Read the body and respond ok."""
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    # pylint: enable=invalid-name
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        """Don't log the requests."""
+
+
+class CookieHandler(KeepAliveHandler):
+    """Set a cookie named after the user and answer with the cookies sent."""
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Read the body and respond with the Cookie header."""
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = self.headers.get('Cookie', '').encode('utf8')
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'sid={}-session; Path=/'.format(self.path.rsplit('/', 1)[-1]))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    # pylint: enable=invalid-name
+
+
+class TestSessionPool(TestCase):
+    """Test the session pool against local servers."""
+
+    def setUp(self):
+        """Start two local servers."""
+        self.servers = []
+        for _index in range(2):
+            server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.urls = ['http://127.0.0.1:{}/'.format(server.server_address[1]) for server in self.servers]
+        self.pool = SessionPool(pool_connections=2, pool_maxsize=2)
+
+    def tearDown(self):
+        """Stop the servers and close the pool."""
+        self.pool.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_session_per_host(self):
+        """Test one session is kept per host."""
+        self.assertTrue(self.pool.session(self.urls[0]) is self.pool.session(self.urls[0] + 'events/user'))
+        self.assertFalse(self.pool.session(self.urls[0]) is self.pool.session(self.urls[1]))
+
+    def test_connection_reuse(self):
+        """Test the connections are reused between requests."""
+        for _index in range(5):
+            for url in self.urls:
+                self.assertEqual(self.pool.post(url, data='{}').text, 'ok')
+        stats = self.pool.stats()
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['new_connections'], 2)
+        self.assertEqual(stats['reused_connections'], 8)
+        self.assertEqual(len(stats['hosts']), 2)
+        key = 'host="{}"'.format(self.urls[0][:-1])
+        counters = {(name, series): value for name, value, series in self.pool.counters()}
+        self.assertEqual(counters[('notifications_http_requests_total', key)], 5)
+        self.assertEqual(counters[('notifications_http_connections_new_total', key)], 1)
+        self.assertEqual(counters[('notifications_http_connections_reused_total', key)], 4)
+        self.assertEqual(len(counters), 6)
+
+    def test_no_cookies(self):
+        """Test the cookies set for one user aren't sent with the posts of another."""
+        server = HTTPServer(('127.0.0.1', 0), CookieHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/events/'.format(server.server_address[1])
+        try:
+            self.assertEqual(self.pool.post(url + 'userA', data='{}').text, '')
+            self.assertEqual(self.pool.post(url + 'userB', data='{}').text, '')
+            self.assertEqual(len(self.pool.session(url).cookies), 0)
+        finally:
+            self.pool.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_close(self):
+        """Test closing drops the sessions and their stats."""
+        self.pool.post(self.urls[0], data='{}')
+        self.pool.close()
+        self.assertEqual(self.pool.stats(), {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'hosts': {}})
+        self.assertEqual(self.pool.post(self.urls[0], data='{}').status_code, 200)
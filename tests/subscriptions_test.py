@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the active subscriptions snapshot."""
+from unittest import TestCase
+from datetime import datetime
+from itertools import product
+from random import Random
+from pacifica.notifications.orm import EventMatch, NotificationSystem
+from pacifica.notifications.jsonpath import parse, find
+from pacifica.notifications.subscriptions import ActiveSubscriptions, SubscriptionIndex
+from .common_test import eventmatch_droptables
+
+
+def _create_eventmatch(name, jsonpath='$.data'):
+    """Create an eventmatch and bump the generation."""
+    with EventMatch.atomic():
+        eventmatch = EventMatch.create(
+            name=name, jsonpath=jsonpath, user='dmlb2001',
+            target_url='http://127.0.0.1:8080'
+        )
+        NotificationSystem.bump_generation()
+    return eventmatch
+
+
+class TestActiveSubscriptions(TestCase):
+    """Test the active subscriptions snapshot."""
+
+    @eventmatch_droptables
+    def test_generation_reload(self):
+        """Test the snapshot reloads only when the generation changes."""
+        subs = ActiveSubscriptions(check_interval=0)
+        self.assertEqual(subs.get(), [])
+        first = _create_eventmatch('first')
+        snapshot = subs.get()
+        self.assertEqual([sub[0]['uuid'] for sub in snapshot], [str(first.uuid)])
+        self.assertTrue(subs.get() is snapshot)
+        # a change without a generation bump is not seen
+        EventMatch.create(name='hidden', jsonpath='$.data', user='dmlb2001', target_url='http://127.0.0.1:8080')
+        self.assertTrue(subs.get() is snapshot)
+        with EventMatch.atomic():
+            first.disabled = datetime.now()
+            first.save()
+            NotificationSystem.bump_generation()
+        self.assertEqual([sub[0]['name'] for sub in subs.get()], ['hidden'])
+
+    @eventmatch_droptables
+    def test_check_interval(self):
+        """Test the generation isn't checked again within the interval."""
+        subs = ActiveSubscriptions(check_interval=3600)
+        self.assertEqual(subs.get(), [])
+        _create_eventmatch('first')
+        self.assertEqual(subs.get(), [])
+        subs.invalidate()
+        self.assertEqual(len(subs.get()), 1)
+
+    @eventmatch_droptables
+    def test_lookup(self):
+        """Test the lookup reloads for new eventmatches and skips inactive ones."""
+        subs = ActiveSubscriptions(check_interval=3600)
+        first = _create_eventmatch('first')
+        self.assertEqual([sub['name'] for sub in subs.lookup([str(first.uuid)])], ['first'])
+        second = _create_eventmatch('second')
+        self.assertEqual(
+            [sub['name'] for sub in subs.lookup([str(second.uuid), 'missing', str(first.uuid)])],
+            ['second', 'first']
+        )
+
+    @eventmatch_droptables
+    def test_bump_without_row(self):
+        """Test the generation row is created on first bump."""
+        NotificationSystem.delete().execute()
+        self.assertEqual(NotificationSystem.get_generation(), 0)
+        NotificationSystem.bump_generation()
+        NotificationSystem.bump_generation()
+        self.assertEqual(NotificationSystem.get_generation(), 2)
+
+
+class TestSubscriptionIndex(TestCase):
+    """Test the subscription index against brute force matching."""
+
+    expressions = [
+        '$',
+        '$.data',
+        '$.source',
+        '$["eventType"]',
+        '$.extensions.comExampleExtension',
+        '$..name',
+        '$.data.*[?(@.value = "Blah")].value',
+        '$.data[*].size',
+        '$[?(@.eventType = "org.pacifica.metadata.ingest")]',
+        '$[?(@.eventType = "org.pacifica.metadata.ingest")].data',
+        '$[?(@.eventType = "org.pacifica.metadata.other")]',
+        '$[?("org.pacifica.metadata.other" = @.eventType)]',
+        '$[?(@.eventType = "org.pacifica.metadata.ingest" and @.source = "/pacifica/metadata/ingest")]',
+        '$[?(@.source = "/pacifica/metadata/ingest" or @.source = "/other")]',
+        '$.extensions[?(@.comExampleExtension = "value")]',
+        '$.extensions[?($.source = "/other")]',
+        '$[?(@.count = 1)]',
+        '$[?(@.count = true)]',
+        '$[?(@.count != 1)]',
+        '$[?(@.data = "x")]',
+        '$[0]',
+    ]
+
+    def _events(self):
+        """Generate a set of events with varying shapes."""
+        rand = Random(1234)
+        event_types = ['org.pacifica.metadata.ingest', 'org.pacifica.metadata.other', 7, None]
+        sources = ['/pacifica/metadata/ingest', '/other', ['/list']]
+        for event_type, source in product(event_types, sources):
+            event_obj = {'eventType': event_type, 'source': source}
+            if rand.random() < 0.6:
+                event_obj['data'] = [
+                    {'value': rand.choice(['Blah', 'Foo', 1]), 'size': rand.randint(0, 10), 'name': 'a'}
+                    for _ in range(rand.randint(0, 3))
+                ]
+            if rand.random() < 0.5:
+                event_obj['extensions'] = rand.choice([{'comExampleExtension': 'value'}, {}, []])
+            if rand.random() < 0.5:
+                event_obj['count'] = rand.choice([1, 1.0, True, 2, '1'])
+            yield event_obj
+        yield []
+        yield 'event'
+
+    def test_brute_force(self):
+        """Test the index matches exactly what brute force matching does."""
+        subscriptions = [({'uuid': expr}, parse(expr)) for expr in self.expressions]
+        index = SubscriptionIndex(subscriptions)
+        for event_obj in self._events():
+            expected = [
+                eventmatch for eventmatch, jsonpath_expr in subscriptions
+                if find(jsonpath_expr, event_obj)
+            ]
+            self.assertEqual(index.match(event_obj), expected, event_obj)
+
+    def test_candidates_pruned(self):
+        """Test non matching literal constraints are never evaluated."""
+        subscriptions = [({'uuid': expr}, parse(expr)) for expr in self.expressions]
+        index = SubscriptionIndex(subscriptions)
+        candidates = [sub[0]['uuid'] for sub in index.candidates({'eventType': 'org.pacifica.metadata.other'})]
+        self.assertTrue('$[?("org.pacifica.metadata.other" = @.eventType)]' in candidates)
+        self.assertFalse('$[?(@.eventType = "org.pacifica.metadata.ingest")]' in candidates)
+        self.assertFalse('$.data' in candidates)
+        self.assertTrue('$..name' in candidates)